@@ -122,7 +122,7 @@ class Checkbox(model.buddy.Buddy, metaclass=model.buddy.Register):
         debug = {}
         if debugrecognition:
             # Run the recognition for this checkbox
-            self.obj.recognize.recognize()
+            self.obj.recognize.recognize(debug=True)
 
             debug = self.obj.recognize.debug
 
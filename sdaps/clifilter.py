@@ -20,8 +20,19 @@
 This modules contains a helper function to allow writing filter expressions
 on the command line of sdaps. Using this it is for example possible to create
 a report that only contains a subset of all filled out sheets.
+
+Parts of the expression that only look at sheet properties which are stored
+in the database (see :py:mod:`model.survey`) are also compiled to SQL, so
+that sheets which cannot match are never loaded.
 """
 
+import ast
+
+#: Sheet properties that are stored in columns of the sheets table
+_sql_columns = {'questionnaire_id', 'global_id', 'valid', 'recognized', 'verified'}
+#: The columns that always contain 0 or 1, the others are untyped
+_sql_bool_columns = {'valid', 'recognized', 'verified'}
+
 
 class Locals(object):
 
@@ -41,6 +52,113 @@ class Locals(object):
             raise KeyError
 
 
+def _sql_constant(node, column):
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        value = _sql_constant(node.operand, column)
+        if isinstance(value, str):
+            raise ValueError
+        return -value
+
+    if not isinstance(node, ast.Constant):
+        raise ValueError
+
+    # The bool columns have an integer affinity, so SQLite would convert
+    # strings that look like numbers while python does not.
+    if column in _sql_bool_columns:
+        types = (int, float)
+    else:
+        types = (int, float, str)
+
+    if not isinstance(node.value, types):
+        raise ValueError
+    return node.value
+
+
+def _to_sql(node):
+    """Compile the expression node to a SQL condition. Returns the condition,
+    its parameters and whether it is exact, it matches a superset of the
+    sheets otherwise. Raises ValueError if it cannot be compiled."""
+    if isinstance(node, ast.BoolOp):
+        parts = []
+        exact = True
+        for value in node.values:
+            try:
+                parts.append(_to_sql(value))
+            except ValueError:
+                # Leaving out a part of an "and" only matches more sheets
+                if isinstance(node.op, ast.Or):
+                    raise
+                exact = False
+
+        if not parts:
+            raise ValueError
+
+        op = ' AND ' if isinstance(node.op, ast.And) else ' OR '
+        return (op.join('(%s)' % part[0] for part in parts),
+                sum((part[1] for part in parts), ()),
+                exact and all(part[2] for part in parts))
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        where, params, exact = _to_sql(node.operand)
+        if not exact:
+            raise ValueError
+        return 'NOT (%s)' % where, params, True
+
+    if isinstance(node, ast.Name) and node.id in _sql_bool_columns:
+        return node.id, (), True
+
+    if isinstance(node, ast.Compare) and len(node.ops) == 1:
+        left = node.left
+        op = node.ops[0]
+        right = node.comparators[0]
+
+        if isinstance(op, (ast.Eq, ast.NotEq)):
+            if isinstance(right, ast.Name):
+                left, right = right, left
+            if not isinstance(left, ast.Name) or left.id not in _sql_columns:
+                raise ValueError
+
+            # IS and IS NOT compare NULL like python compares None
+            if isinstance(right, ast.Constant) and right.value is None:
+                value = None
+            else:
+                value = _sql_constant(right, left.id)
+
+            if isinstance(op, ast.Eq):
+                return '%s IS ?' % left.id, (value,), True
+            else:
+                return '%s IS NOT ?' % left.id, (value,), True
+
+        if isinstance(op, (ast.In, ast.NotIn)):
+            if not isinstance(left, ast.Name) or left.id not in _sql_columns:
+                raise ValueError
+            if not isinstance(right, (ast.Tuple, ast.List, ast.Set)) or not right.elts:
+                raise ValueError
+
+            values = tuple(_sql_constant(elt, left.id) for elt in right.elts)
+            # A NULL column would make the IN expression NULL
+            where = 'COALESCE(%s IN (%s), 0)' % (left.id, ', '.join('?' * len(values)))
+            if isinstance(op, ast.NotIn):
+                where = 'NOT ' + where
+            return where, values, True
+
+    raise ValueError
+
+
+def sql_prefilter(expression):
+    """Compile the parts of the filter expression that only use sheet
+    properties stored in the database to a SQL condition. Returns a tuple
+    of the condition and its parameters or None. The condition may match
+    more sheets than the expression, but never less."""
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+        where, params, exact = _to_sql(tree.body)
+    except (SyntaxError, ValueError):
+        return None
+
+    return where, params
+
+
 def clifilter(survey, expression):
     if expression is None or expression.strip() == '':
         return lambda: True
@@ -48,5 +166,9 @@ def clifilter(survey, expression):
     exp = compile(expression, '<string>', 'eval')
     globals = __builtins__
     locals = Locals(survey)
-    return lambda: eval(exp, globals, locals)
+    filter = lambda: eval(exp, globals, locals)
+    # Used by the survey to skip sheets, the filter is still evaluated for
+    # all other sheets.
+    filter.sql = sql_prefilter(expression)
+    return filter
 
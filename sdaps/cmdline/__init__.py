@@ -32,6 +32,7 @@ import_subparser = import_.add_subparsers(dest='format')
 import_subparser.required = True
 
 from . import info
+from . import migrate
 from . import recognize
 from . import reorder
 
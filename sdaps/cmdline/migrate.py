@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# SDAPS - Scripts for data acquisition with paper based surveys
+# Copyright(C) 2026, Benjamin Berg <benjamin@sipsolutions.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from sdaps import model
+from sdaps import script
+
+from sdaps.utils.ugettext import ugettext, ungettext
+_ = ugettext
+
+
+parser = script.add_project_subparser("migrate",
+    help=_("Convert the stored data to a different format."),
+    description=_("""This command upgrades the project database (which is
+    otherwise done the next time the project is modified) and changes the
+    format that the data of the sheets is stored in. The "binary" format is
+    smaller and faster, "json" is needed to open the project with older
+    versions of SDAPS."""))
+
+parser.add_argument('--codec',
+    choices=sorted(model.codec.codecs.keys()),
+    help=_("The format to store the sheets in."))
+
+parser.add_argument('--lazy',
+    action="store_true",
+    help=_("Only convert sheets when they are modified the next time."))
+
+
+@script.connect(parser)
+@script.logfile
+def migrate(cmdline):
+    survey = model.survey.Survey.load(cmdline['project'])
+
+    if cmdline['codec'] is not None:
+        survey.set_sheet_codec(cmdline['codec'], convert=not cmdline['lazy'])
+
+    survey.save()
@@ -19,6 +19,8 @@
 
 from sdaps import model
 from sdaps import script
+from sdaps import defs
+from sdaps import clifilter
 
 from sdaps.utils.ugettext import ugettext, ungettext
 _ = ugettext
@@ -35,25 +37,46 @@ parser.add_argument('--identify',
     action="store_true",
     default=False)
 
-parser.add_argument('--rerun', '-r',
+rerun_group = parser.add_mutually_exclusive_group()
+
+rerun_group.add_argument('--rerun', '-r',
     help=_("Rerun the recognition for all pages. The default is to skip all pages that were recognized or verified already."),
     action="store_true",
     default=False)
 
+rerun_group.add_argument('--incremental',
+    help=_("Rerun the recognition for pages whose image data or recognition settings changed since they were recognized. Verified pages are only rerun if the image data changed."),
+    action="store_true",
+    default=False)
+
+parser.add_argument('--jobs', '-j',
+    help=_("Number of worker processes to use for the recognition (default: 1). The results are written by the main process."),
+    type=int,
+    default=1)
+
+parser.add_argument('--warm-start',
+    help=_("Search the corner marks close to their position on the previous page of the same scan first. This is faster if all sheets were fed through the scanner in the same way."),
+    action="store_true",
+    default=defs.corner_mark_warm_start)
+
 @script.connect(parser)
 @script.logfile
 def recognize(cmdline):
     survey = model.survey.Survey.load(cmdline['project'])
     from sdaps import recognize
 
-    if not cmdline['rerun']:
-        filter = lambda : not (survey.sheet.verified or survey.sheet.recognized)
-    else:
+    if cmdline['rerun']:
         filter = lambda: True
+    elif cmdline['incremental']:
+        filter = lambda: survey.sheet.recognize.needs_recognition()
+    else:
+        filter = lambda : not (survey.sheet.verified or survey.sheet.recognized)
+        # Do not even load the sheets that were done already
+        filter.sql = clifilter.sql_prefilter('not (recognized or verified)')
 
     if cmdline['identify']:
-        return recognize.identify(survey, filter)
+        return recognize.identify(survey, filter, cmdline['jobs'], cmdline['warm_start'])
     else:
-        return recognize.recognize(survey, filter)
+        return recognize.recognize(survey, filter, cmdline['jobs'], cmdline['warm_start'])
 
 
@@ -47,6 +47,19 @@ corner_mark_max_length = 22 # mm
 # Basically a square area of this size will be searched in each corner.
 corner_mark_search_distance = 50 # mm
 
+# The corner marks are first searched on a copy of the image that is scaled
+# down by up to 2^levels, and only measured at full resolution. If this fails,
+# the full resolution search is done. Set to 0 to always search at full
+# resolution.
+corner_mark_pyramid_levels = 3
+
+# Search the corner marks close to where they were on the previous image of
+# the same scan first. This helps with long runs of sheets that were fed
+# through the scanner in the same way. Can also be enabled using --warm-start.
+corner_mark_warm_start = False
+# How far away from the previous position the corner mark may be.
+corner_mark_warm_start_distance = 5 # mm
+
 # Corner Boxes ============================================
 
 # What corners are filled for each page, this is choosen so that
@@ -101,8 +114,26 @@ code128_vpad = 4.02 # mm
 code128_text_font = 'Courier'
 code128_text_font_size = 9 # pt
 
+# Barcode Reading ==========================================
+
+# How barcodes are decoded. "library" calls into libzbar directly, "zbarimg"
+# runs the zbarimg tool for every barcode and "auto" uses the library if it
+# is available and falls back to zbarimg otherwise.
+barcode_decoder = 'auto'
+
 # Checkbox ================================================
 
+# The checkbox masks are cached and shared between boxes (and sheets) with
+# the same geometry. For this the page matrix is rounded to this precision
+# (in pixel per mm).
+checkbox_mask_matrix_precision = 0.001
+
+# Always calculate all the checkbox metrics. Otherwise the expensive metrics
+# (line removal and white areas) are skipped if the coverage alone already
+# gives a quality that they cannot improve on. The result is the same, but
+# the skipped metrics are not stored.
+checkbox_metrics_full = False
+
 checkbox_metrics = {}
 
 # The metrics is a mapping from the value to the quality and expected
@@ -114,6 +145,8 @@ checkbox_metrics = {}
 # insert two dummy points with zero quality. To try and find better
 # values have a look at the output of "boxgallery". Any suggestions
 # for improvements(also algorithmic wise) are always welcome!
+# The metrics are evaluated in the order given here, an earlier one wins if
+# the quality is equal. coverage has to be the first one.
 checkbox_metrics['checkcorrect'] = {}
 checkbox_metrics['checkcorrect']['coverage'] = \
     [(0, 0, 1.0), (0.02, 0, 0.9), (0.05, 0, 0.3), (0.05, 1, 0.3),
@@ -165,6 +198,11 @@ textbox_scan_height = 2.0 # mm
 # be considered writing.
 textbox_scan_coverage = 0.06
 
+# Build a summed-area table of the textbox area when scanning it, so that
+# every coverage test is a constant time operation. The table needs 4 bytes
+# per pixel of the textbox and is freed right after the scan.
+textbox_scan_integral_image = True
+
 # Minimum size in mm for a textbox to be considered filled in.
 # This is usefull because otherwise small dirt dots will be considered writing.
 textbox_minimum_writing_width = 5 # mm
@@ -190,6 +228,30 @@ image_line_width = 24.4/72. # mm
 # The coverage that the line needs to have for recognition
 image_line_coverage = 0.35
 
+# The number of pages that are decoded in the background during recognition.
+# Set to 0 to disable this.
+image_prefetch = 4
+
+# Only decode the parts of the pages that are needed to identify them (the
+# corner marks and the IDs) when running "identify" on its own. This needs
+# support from the style, the whole page is loaded otherwise.
+identify_partial_load = True
+
+# Margin around the identification regions that is decoded in addition.
+identify_partial_margin = 10 # mm
+
+# During recognition, write the results of the finished sheets to the
+# database after this many sheets or seconds (None to only write at the end).
+# This keeps the memory usage flat and a crash only loses the recent sheets.
+checkpoint_sheets = 1000
+checkpoint_seconds = 300
+
+# The format that the sheets of new projects are stored in, either "json" or
+# "binary". "binary" is smaller and faster to load, but older versions of
+# SDAPS cannot read it. Existing projects are converted using
+# "sdaps migrate --codec".
+sheet_codec = 'json'
+
 
 # Allowed characters in code 128 barcodes (only ascii for now)
 c128_chars = [chr(i) for i in range(32, 127)] #+ [u'È', u'É', u'Ê', u'Ë', u'Ì', u'Í', u'Î', u'Ï', u'Ð', u'Ñ', u'Ò', u'Ó']
@@ -52,7 +52,8 @@ set_magic_values(defs.corner_mark_min_length,
                  defs.corner_mark_max_length,
                  defs.image_line_width,
                  defs.corner_mark_search_distance,
-                 defs.image_line_coverage)
+                 defs.image_line_coverage,
+                 defs.corner_mark_pyramid_levels)
 
 # Offset into corners, not valid for C API which has +1 as offset!
 TOP_LEFT = 0
@@ -60,32 +61,72 @@ TOP_RIGHT = 1
 BOTTOM_RIGHT = 2
 BOTTOM_LEFT = 3
 
-def calculate_matrix(surface, matrix, mm_x, mm_y, mm_width, mm_height):
-    """Detect the transformation matrix
+def find_corner_markers(surface, matrix, hints=None):
+    """Find the four corner marks
 
-    This runs a detection for the corner marks that denote the bounding box
-    given by mm_x, mm_y, mm_width, mm_height in the surface. The passed matrix
-    is used for to estimate the resolution of the image.
+    Returns a list with the positions of the corner marks in px in the order
+    top left, top right, bottom right, bottom left. Corners that could not be
+    found are None. The passed matrix is used to estimate the resolution of
+    the image.
 
-    This function returns a new cairo matrix or raises an error otherwise.
+    *hints* may be a list of positions in the same format, for example the
+    result for the previous image of the same scan. Each corner is first
+    searched for close to its hint, and in the whole corner otherwise.
     """
-    found_corners = 0
-
     corners = []
 
     for i in (1, 2, 3, 4):
+        if hints is not None and hints[i - 1] is not None:
+            try:
+                corners.append(find_corner_marker_near(surface, matrix, i, hints[i - 1],
+                                                       defs.corner_mark_warm_start_distance))
+                continue
+            except AssertionError:
+                pass
+
         try:
-            corners.append(find_corner_marker (surface, matrix, i))
-            found_corners += 1
-        except:
+            corners.append(find_corner_marker(surface, matrix, i))
+        except AssertionError:
             corners.append(None)
 
+    return corners
+
+
+def calculate_matrix(surface, matrix, mm_x, mm_y, mm_width, mm_height, hints=None):
+    """Detect the transformation matrix
+
+    This runs a detection for the corner marks that denote the bounding box
+    given by mm_x, mm_y, mm_width, mm_height in the surface. The passed matrix
+    is used for to estimate the resolution of the image. See
+    :py:func:`find_corner_markers` for *hints*.
+
+    This function returns a new cairo matrix or raises an error otherwise.
+    """
+    corners = find_corner_markers(surface, matrix, hints)
+
     # We need at least 3 corners to do anything
-    assert found_corners >= 3
+    assert corners.count(None) <= 1
 
     return matrix_from_corners_2d(corners, mm_x, mm_y, mm_width, mm_height)
 
 
+def rotate_matrix_180(matrix, px_width, px_height, mm_x, mm_y, mm_width, mm_height):
+    """Adjust a matrix for an image that was rotated by 180 degree
+
+    Takes the px to mm matrix as returned by :py:func:`calculate_matrix` for
+    an image of the given size in pixel and the bounding box of the corner
+    marks in mm. Returns the matrix that would have been found if the same
+    image had been rotated by 180 degree before the corner marks were
+    detected, ie. the corner marks swap places.
+    """
+    # Rotation of the image around its center in pixel space
+    rotate_px = cairo.Matrix(-1, 0, 0, -1, px_width, px_height)
+    # Rotation around the center of the corner marks in mm space
+    rotate_mm = cairo.Matrix(-1, 0, 0, -1, 2 * mm_x + mm_width, 2 * mm_y + mm_height)
+
+    return rotate_px.multiply(matrix).multiply(rotate_mm)
+
+
 def matrix_from_corners_2d(corners, mm_x, mm_y, mm_width, mm_height):
     """Calculate the transformation matrix from bounding box corners
 
@@ -18,6 +18,8 @@
 
 /*#include <gdk-pixbuf/gdk-pixbuf.h>*/
 #include <tiffio.h>
+#include <glib/gstdio.h>
+#include <unistd.h>
 #include "image.h"
 #include <math.h>
 #include "surface.h"
@@ -29,6 +31,7 @@ gdouble sdaps_line_max_length = 20+2;
 gdouble sdaps_line_width = 1/72*25.4;
 gdouble sdaps_corner_mark_search_distance = 50;
 gdouble sdaps_line_coverage = 0.65;
+gint sdaps_corner_mark_pyramid_levels = 3;
 
 gboolean sdaps_create_debug_surface = FALSE;
 gint sdaps_debug_surface_ox;
@@ -77,28 +80,436 @@ disable_libtiff_warnings (void)
 	TIFFSetWarningHandler(NULL);
 }
 
-cairo_surface_t*
-get_a1_from_tiff (const char *filename, gint page, gboolean rotated)
+/* Pool of open TIFF files. Recognizing a multipage TIFF accesses one page
+ * after the other, reopening the file and walking the directory chain from
+ * the start every time makes that quadratic in the number of pages. Instead
+ * we keep the file open and remember the offset of every directory that
+ * we have seen so far, so that any page can be reached with a single seek. */
+#define TIFF_POOL_SIZE 4
+
+typedef struct {
+	gchar *filename;
+	TIFF *tiff;
+	/* Offsets of the directories, one per page (toff_t) */
+	GArray *offsets;
+	/* The whole directory chain has been read */
+	gboolean complete;
+	gboolean in_use;
+	gboolean pooled;
+	guint64 last_use;
+	/* To detect modified files, and forked processes as these share the
+	 * file offset with the parent. */
+	GStatBuf stat;
+	pid_t pid;
+} TiffHandle;
+
+/* Protects the pool, an acquired handle can be used without holding it. */
+static GMutex tiff_pool_lock;
+static TiffHandle tiff_pool[TIFF_POOL_SIZE];
+static guint64 tiff_pool_counter = 0;
+
+static void
+tiff_handle_close (TiffHandle *handle)
+{
+	if (handle->tiff)
+		TIFFClose(handle->tiff);
+	if (handle->offsets)
+		g_array_free(handle->offsets, TRUE);
+	g_free(handle->filename);
+
+	handle->filename = NULL;
+	handle->tiff = NULL;
+	handle->offsets = NULL;
+	handle->complete = FALSE;
+	handle->in_use = FALSE;
+}
+
+static gboolean
+tiff_handle_valid (TiffHandle *handle, GStatBuf *stat)
+{
+	return handle->pid == getpid() &&
+	       handle->stat.st_dev == stat->st_dev &&
+	       handle->stat.st_ino == stat->st_ino &&
+	       handle->stat.st_size == stat->st_size &&
+	       handle->stat.st_mtime == stat->st_mtime;
+}
+
+/* Reads further directories until *page* is indexed (or the end of the
+ * file is reached if page is negative). */
+static gboolean
+tiff_handle_index (TiffHandle *handle, gint page)
+{
+	toff_t offset;
+
+	if (handle->offsets->len == 0) {
+		/* Freshly opened, i.e. on the first directory */
+		offset = TIFFCurrentDirOffset(handle->tiff);
+		g_array_append_val(handle->offsets, offset);
+	}
+
+	while (!handle->complete && (page < 0 || (guint) page >= handle->offsets->len)) {
+		offset = g_array_index(handle->offsets, toff_t, handle->offsets->len - 1);
+		if (TIFFCurrentDirOffset(handle->tiff) != offset && !TIFFSetSubDirectory(handle->tiff, offset))
+			return FALSE;
+
+		if (!TIFFReadDirectory(handle->tiff)) {
+			handle->complete = TRUE;
+			break;
+		}
+
+		offset = TIFFCurrentDirOffset(handle->tiff);
+		g_array_append_val(handle->offsets, offset);
+	}
+
+	return page < 0 || (guint) page < handle->offsets->len;
+}
+
+static void
+tiff_handle_release (TiffHandle *handle)
+{
+	if (handle->pooled) {
+		g_mutex_lock(&tiff_pool_lock);
+		handle->in_use = FALSE;
+		g_mutex_unlock(&tiff_pool_lock);
+	} else {
+		tiff_handle_close(handle);
+		g_free(handle);
+	}
+}
+
+/* Returns a handle with the TIFF set to the given page (if page is not
+ * negative). The handle needs to be returned using tiff_handle_release. */
+static TiffHandle*
+tiff_handle_acquire (const char *filename, gint page)
+{
+	TiffHandle *handle = NULL;
+	GStatBuf stat;
+	gint i;
+
+	if (g_stat(filename, &stat) != 0)
+		return NULL;
+
+	g_mutex_lock(&tiff_pool_lock);
+
+	for (i = 0; i < TIFF_POOL_SIZE; i++) {
+		TiffHandle *cur = &tiff_pool[i];
+
+		if (cur->filename == NULL || cur->in_use || strcmp(cur->filename, filename) != 0)
+			continue;
+
+		if (!tiff_handle_valid(cur, &stat)) {
+			tiff_handle_close(cur);
+			continue;
+		}
+
+		handle = cur;
+		break;
+	}
+
+	if (handle == NULL) {
+		/* Find a slot, throwing out the least recently used file. */
+		for (i = 0; i < TIFF_POOL_SIZE; i++) {
+			TiffHandle *cur = &tiff_pool[i];
+
+			if (cur->in_use)
+				continue;
+			if (handle == NULL || cur->filename == NULL ||
+			    (handle->filename != NULL && cur->last_use < handle->last_use))
+				handle = cur;
+		}
+
+		if (handle) {
+			tiff_handle_close(handle);
+			handle->pooled = TRUE;
+		} else {
+			handle = g_new0(TiffHandle, 1);
+			handle->pooled = FALSE;
+		}
+
+		/* Claim the slot, the file is opened without holding the lock. */
+		handle->filename = g_strdup(filename);
+		handle->offsets = g_array_new(FALSE, FALSE, sizeof(toff_t));
+		handle->complete = FALSE;
+		handle->stat = stat;
+		handle->pid = getpid();
+	}
+
+	handle->in_use = TRUE;
+	handle->last_use = ++tiff_pool_counter;
+
+	g_mutex_unlock(&tiff_pool_lock);
+
+	if (handle->tiff == NULL) {
+		handle->tiff = TIFFOpen(filename, "r");
+		if (handle->tiff == NULL) {
+			/* Give up the slot again */
+			g_mutex_lock(&tiff_pool_lock);
+			tiff_handle_close(handle);
+			g_mutex_unlock(&tiff_pool_lock);
+			if (!handle->pooled)
+				g_free(handle);
+			return NULL;
+		}
+	}
+
+	if (page >= 0) {
+		if (!tiff_handle_index(handle, page) ||
+		    !TIFFSetSubDirectory(handle->tiff, g_array_index(handle->offsets, toff_t, page))) {
+			tiff_handle_release(handle);
+			return NULL;
+		}
+	}
+
+	return handle;
+}
+
+/* Closes all pooled files that are not in use. If filename is given, only
+ * handles of that file are closed. */
+static void
+tiff_pool_clear (const char *filename)
+{
+	gint i;
+
+	g_mutex_lock(&tiff_pool_lock);
+
+	for (i = 0; i < TIFF_POOL_SIZE; i++) {
+		TiffHandle *cur = &tiff_pool[i];
+
+		if (cur->filename == NULL || cur->in_use)
+			continue;
+		if (filename != NULL && strcmp(cur->filename, filename) != 0)
+			continue;
+
+		tiff_handle_close(cur);
+	}
+
+	g_mutex_unlock(&tiff_pool_lock);
+}
+
+void
+clear_tiff_cache (void)
+{
+	tiff_pool_clear(NULL);
+}
+
+/* Whether any of the rows first to last (inclusive, in file orientation)
+ * has been requested. The row ranges are pairs of the first and last row in
+ * the orientation of the returned surface, NULL requests all rows. */
+static gboolean
+rows_requested (const gint *row_ranges, gint range_count, guint32 height, gboolean rotated, guint32 first, guint32 last)
+{
+	gint start, end, tmp;
+	gint i;
+
+	if (row_ranges == NULL)
+		return TRUE;
+
+	for (i = 0; i < range_count; i++) {
+		start = row_ranges[2 * i];
+		end = row_ranges[2 * i + 1];
+
+		if (rotated) {
+			tmp = (gint) height - 1 - end;
+			end = (gint) height - 1 - start;
+			start = tmp;
+		}
+
+		if (start <= (gint) last && end >= (gint) first)
+			return TRUE;
+	}
+
+	return FALSE;
+}
+
+/* Reads bilevel data directly from the strips into the A1 surface. Returns
+ * NULL if the page is stored in a way that this is not possible. */
+static cairo_surface_t*
+read_a1_bilevel (TIFF *tiff, gboolean rotated, const gint *row_ranges, gint range_count)
+{
+	cairo_surface_t *surface;
+	guint8 *s_pixels;
+	guint8 *strip_data;
+	int s_stride;
+	guint32 width, height;
+	guint32 rows_per_strip;
+	guint16 bits_per_sample, samples_per_pixel;
+	guint16 photometric, orientation;
+	tmsize_t scanline;
+	guint8 last_mask;
+	guint32 strip, rows;
+	guint32 y, row;
+	tmsize_t i;
+
+	if (TIFFIsTiled(tiff))
+		return NULL;
+
+	TIFFGetFieldDefaulted(tiff, TIFFTAG_BITSPERSAMPLE, &bits_per_sample);
+	TIFFGetFieldDefaulted(tiff, TIFFTAG_SAMPLESPERPIXEL, &samples_per_pixel);
+	TIFFGetFieldDefaulted(tiff, TIFFTAG_ORIENTATION, &orientation);
+	if (bits_per_sample != 1 || samples_per_pixel != 1 || orientation != ORIENTATION_TOPLEFT)
+		return NULL;
+
+	if (!TIFFGetField(tiff, TIFFTAG_PHOTOMETRIC, &photometric))
+		return NULL;
+	if (photometric != PHOTOMETRIC_MINISWHITE && photometric != PHOTOMETRIC_MINISBLACK)
+		return NULL;
+
+	TIFFGetField(tiff, TIFFTAG_IMAGEWIDTH, &width);
+	TIFFGetField(tiff, TIFFTAG_IMAGELENGTH, &height);
+	TIFFGetFieldDefaulted(tiff, TIFFTAG_ROWSPERSTRIP, &rows_per_strip);
+	rows_per_strip = MIN(rows_per_strip, height);
+
+	scanline = (width + 7) / 8;
+	if (TIFFScanlineSize(tiff) != scanline)
+		return NULL;
+
+	surface = cairo_image_surface_create(CAIRO_FORMAT_A1, width, height);
+	if (cairo_surface_status(surface) != CAIRO_STATUS_SUCCESS) {
+		cairo_surface_destroy(surface);
+		return NULL;
+	}
+	s_pixels = cairo_image_surface_get_data(surface);
+	s_stride = cairo_image_surface_get_stride(surface);
+
+	/* Mask for the valid pixels in the last byte of a row. */
+#if G_BYTE_ORDER == G_LITTLE_ENDIAN
+	last_mask = width % 8 ? 0xff >> (8 - width % 8) : 0xff;
+#else
+	last_mask = width % 8 ? 0xff << (8 - width % 8) : 0xff;
+#endif
+
+	strip_data = g_malloc(TIFFStripSize(tiff));
+
+	for (strip = 0, y = 0; y < height; strip++, y += rows_per_strip) {
+		rows = MIN(rows_per_strip, height - y);
+
+		/* Strips that are not needed simply stay white. */
+		if (!rows_requested(row_ranges, range_count, height, rotated, y, y + rows - 1))
+			continue;
+
+		/* Like TIFFReadRGBAImage we simply use whatever could be decoded
+		 * in case of an error. */
+		memset(strip_data, 0, rows * scanline);
+		TIFFReadEncodedStrip(tiff, strip, strip_data, rows * scanline);
+
+		for (row = 0; row < rows; row++) {
+			guint8 *dest = s_pixels + (y + row) * s_stride;
+
+			/* libtiff takes care of the FillOrder, decoded data always
+			 * has the first pixel in the most significant bit. */
+			memcpy(dest, strip_data + row * scanline, scanline);
+
+			/* Set pixels are black */
+			if (photometric == PHOTOMETRIC_MINISBLACK) {
+				for (i = 0; i < scanline; i++)
+					dest[i] = ~dest[i];
+			}
+
+#if G_BYTE_ORDER == G_LITTLE_ENDIAN
+			/* Cairo has the first pixel in the least significant bit */
+			TIFFReverseBits(dest, scanline);
+#endif
+			dest[scanline - 1] &= last_mask;
+		}
+	}
+
+	g_free(strip_data);
+
+	cairo_surface_mark_dirty(surface);
+
+	if (rotated)
+		surface_rotate_180(surface);
+
+	return surface;
+}
+
+/* Reads the requested strips by converting them to RGBA and thresholding
+ * them. Only works for stripped images in the default orientation, returns
+ * NULL otherwise. */
+static cairo_surface_t*
+read_a1_rgba_strips (TIFF *tiff, gboolean rotated, const gint *row_ranges, gint range_count)
 {
-	TIFF* tiff;
 	cairo_surface_t *surface;
 	guint32 *s_pixels;
 	guint32 *t_pixels;
 	guint32 *t_row;
-	int s_stride, t_stride;
-	int width, height;
+	int s_stride;
+	guint32 width, height;
+	guint32 rows_per_strip, rows;
+	guint16 orientation;
+	guint32 x, y, row;
 	BARREL_VARS
 
-	int x, y;
+	if (TIFFIsTiled(tiff))
+		return NULL;
 
-	tiff = TIFFOpen(filename, "r");
-	if (tiff == NULL)
+	TIFFGetFieldDefaulted(tiff, TIFFTAG_ORIENTATION, &orientation);
+	if (orientation != ORIENTATION_TOPLEFT)
 		return NULL;
 
-	if (!TIFFSetDirectory(tiff, page)) {
-		TIFFClose(tiff);
+	TIFFGetField(tiff, TIFFTAG_IMAGEWIDTH, &width);
+	TIFFGetField(tiff, TIFFTAG_IMAGELENGTH, &height);
+	TIFFGetFieldDefaulted(tiff, TIFFTAG_ROWSPERSTRIP, &rows_per_strip);
+	rows_per_strip = MIN(rows_per_strip, height);
+
+	surface = cairo_image_surface_create(CAIRO_FORMAT_A1, width, height);
+	if (cairo_surface_status(surface) != CAIRO_STATUS_SUCCESS) {
+		cairo_surface_destroy(surface);
 		return NULL;
 	}
+	s_pixels = (guint32*) cairo_image_surface_get_data(surface);
+	s_stride = cairo_image_surface_get_stride(surface);
+
+	t_pixels = g_new(guint32, width * rows_per_strip);
+
+	for (y = 0; y < height; y += rows_per_strip) {
+		rows = MIN(rows_per_strip, height - y);
+
+		if (!rows_requested(row_ranges, range_count, height, rotated, y, y + rows - 1))
+			continue;
+
+		memset(t_pixels, 0xff, sizeof(guint32) * width * rows);
+		TIFFReadRGBAStrip(tiff, y, t_pixels);
+
+		/* The strip raster has its origin in the lower left corner. */
+		for (row = 0; row < rows; row++) {
+			guint32 *t_p;
+
+			t_row = t_pixels + (rows - row - 1) * width;
+			t_p = t_row;
+
+			BARREL_START_ROW((char*)s_pixels + (y + row) * s_stride)
+			for (x = 0; x < width; x++) {
+				BARREL_STORE_BIT(!(TIFFGetR(*t_p) >> 7));
+				t_p = t_p + 1;
+			}
+			BARREL_FLUSH
+		}
+	}
+
+	g_free(t_pixels);
+
+	cairo_surface_mark_dirty(surface);
+
+	if (rotated)
+		surface_rotate_180(surface);
+
+	return surface;
+}
+
+/* Reads any page by converting it to RGBA and thresholding it. */
+static cairo_surface_t*
+read_a1_rgba (TIFF *tiff, gboolean rotated)
+{
+	cairo_surface_t *surface;
+	guint32 *s_pixels;
+	guint32 *t_pixels;
+	guint32 *t_row;
+	int s_stride, t_stride;
+	int width, height;
+	BARREL_VARS
+
+	int x, y;
 
 	TIFFGetField(tiff, TIFFTAG_IMAGEWIDTH, &width);
 	TIFFGetField(tiff, TIFFTAG_IMAGELENGTH, &height);
@@ -128,13 +539,42 @@ get_a1_from_tiff (const char *filename, gint page, gboolean rotated)
 	}
 
 	g_free(t_pixels);
-	TIFFClose(tiff);
 
 	cairo_surface_mark_dirty(surface);
 
 	return surface;
 }
 
+cairo_surface_t*
+get_a1_from_tiff_partial (const char *filename, gint page, gboolean rotated, const gint *row_ranges, gint range_count)
+{
+	TiffHandle *handle;
+	cairo_surface_t *surface;
+
+	handle = tiff_handle_acquire(filename, page);
+	if (handle == NULL)
+		return NULL;
+
+	/* Bilevel images (e.g. CCITT G4 as created by "add") can be copied over
+	 * directly, only use the (slow and memory hungry) RGBA conversion for
+	 * anything else. */
+	surface = read_a1_bilevel(handle->tiff, rotated, row_ranges, range_count);
+	if (surface == NULL && row_ranges != NULL)
+		surface = read_a1_rgba_strips(handle->tiff, rotated, row_ranges, range_count);
+	if (surface == NULL)
+		surface = read_a1_rgba(handle->tiff, rotated);
+
+	tiff_handle_release(handle);
+
+	return surface;
+}
+
+cairo_surface_t*
+get_a1_from_tiff (const char *filename, gint page, gboolean rotated)
+{
+	return get_a1_from_tiff_partial(filename, page, rotated, NULL, 0);
+}
+
 gboolean
 write_a1_to_tiff (const char *filename, cairo_surface_t *surf)
 {
@@ -152,6 +592,9 @@ write_a1_to_tiff (const char *filename, cairo_surface_t *surf)
 	stride = cairo_image_surface_get_stride(surf);
 	data = (guint8*) cairo_image_surface_get_data(surf);
 
+	/* Pooled handles would not see the new page. */
+	tiff_pool_clear(filename);
+
 	/* We create a new TIFF file if it doesn't exist yet, otherwise we append
 	 * to it. */
 	tiff = TIFFOpen(filename, "a");
@@ -206,6 +649,7 @@ BAIL_WRITE_A1:
 cairo_surface_t*
 get_rgb24_from_tiff (const char *filename, gint page, gboolean rotated)
 {
+	TiffHandle *handle;
 	TIFF* tiff;
 	cairo_surface_t *surface;
 	guint32 *s_pixels;
@@ -216,14 +660,10 @@ get_rgb24_from_tiff (const char *filename, gint page, gboolean rotated)
 
 	int x, y;
 
-	tiff = TIFFOpen(filename, "r");
-	if (tiff == NULL)
-		return NULL;
-
-	if (!TIFFSetDirectory(tiff, page)) {
-		TIFFClose(tiff);
+	handle = tiff_handle_acquire(filename, page);
+	if (handle == NULL)
 		return NULL;
-	}
+	tiff = handle->tiff;
 
 	TIFFGetField(tiff, TIFFTAG_IMAGEWIDTH, &width);
 	TIFFGetField(tiff, TIFFTAG_IMAGELENGTH, &height);
@@ -251,7 +691,7 @@ get_rgb24_from_tiff (const char *filename, gint page, gboolean rotated)
 	}
 
 	g_free(t_pixels);
-	TIFFClose(tiff);
+	tiff_handle_release(handle);
 
 	cairo_surface_mark_dirty(surface);
 
@@ -261,36 +701,120 @@ get_rgb24_from_tiff (const char *filename, gint page, gboolean rotated)
 gint
 get_tiff_page_count (const char *filename)
 {
-	TIFF* tiff;
+	TiffHandle *handle;
 	gint pages;
 
-	tiff = TIFFOpen(filename, "r");
-	if (tiff == NULL)
+	handle = tiff_handle_acquire(filename, -1);
+	if (handle == NULL)
 		return 0;
 
-	pages = TIFFNumberOfDirectories(tiff);
+	if (tiff_handle_index(handle, -1))
+		pages = handle->offsets->len;
+	else
+		pages = 0;
 
-	TIFFClose(tiff);
+	tiff_handle_release(handle);
 
 	return pages;
 }
 
+/* Returns a hex SHA1 checksum over the size and the raw (still compressed)
+ * strip or tile data of the page, or NULL on error. This is much cheaper
+ * than decoding the page. The caller needs to g_free the result. */
+gchar*
+get_tiff_page_checksum (const char *filename, gint page)
+{
+	TiffHandle *handle;
+	TIFF *tiff;
+	GChecksum *checksum;
+	gchar *result = NULL;
+	guint8 *buf = NULL;
+	tmsize_t buf_size = 0;
+	tmsize_t size;
+	guint32 width = 0, height = 0;
+	guint64 *byte_counts;
+	guint32 i, count;
+
+	handle = tiff_handle_acquire(filename, page);
+	if (handle == NULL)
+		return NULL;
+	tiff = handle->tiff;
+
+	TIFFGetField(tiff, TIFFTAG_IMAGEWIDTH, &width);
+	TIFFGetField(tiff, TIFFTAG_IMAGELENGTH, &height);
+
+	checksum = g_checksum_new(G_CHECKSUM_SHA1);
+	g_checksum_update(checksum, (guchar*) &width, sizeof(width));
+	g_checksum_update(checksum, (guchar*) &height, sizeof(height));
+
+	if (TIFFIsTiled(tiff)) {
+		count = TIFFNumberOfTiles(tiff);
+		if (!TIFFGetField(tiff, TIFFTAG_TILEBYTECOUNTS, &byte_counts))
+			goto out;
+	} else {
+		count = TIFFNumberOfStrips(tiff);
+		if (!TIFFGetField(tiff, TIFFTAG_STRIPBYTECOUNTS, &byte_counts))
+			goto out;
+	}
+
+	for (i = 0; i < count; i++) {
+		if ((tmsize_t) byte_counts[i] > buf_size) {
+			buf_size = byte_counts[i];
+			buf = g_realloc(buf, buf_size);
+		}
+
+		if (TIFFIsTiled(tiff))
+			size = TIFFReadRawTile(tiff, i, buf, byte_counts[i]);
+		else
+			size = TIFFReadRawStrip(tiff, i, buf, byte_counts[i]);
+		if (size < 0)
+			goto out;
+
+		g_checksum_update(checksum, buf, size);
+	}
+
+	result = g_strdup(g_checksum_get_string(checksum));
+
+out:
+	g_free(buf);
+	g_checksum_free(checksum);
+	tiff_handle_release(handle);
+
+	return result;
+}
+
+gboolean
+get_tiff_size (const char *filename, gint page, gint *width, gint *height)
+{
+	TiffHandle *handle;
+	guint32 w = 0, h = 0;
+
+	handle = tiff_handle_acquire(filename, page);
+	if (handle == NULL)
+		return FALSE;
+
+	TIFFGetField(handle->tiff, TIFFTAG_IMAGEWIDTH, &w);
+	TIFFGetField(handle->tiff, TIFFTAG_IMAGELENGTH, &h);
+	*width = w;
+	*height = h;
+
+	tiff_handle_release(handle);
+	return TRUE;
+}
+
 gboolean
 get_tiff_resolution (const char *filename, gint page, gdouble *xresolution, gdouble *yresolution)
 {
+	TiffHandle *handle;
 	TIFF* tiff;
 	float xres = 0.0;
 	float yres = 0.0;
 	guint16 unit = RESUNIT_NONE;
 
-	tiff = TIFFOpen(filename, "r");
-	if (tiff == NULL)
-		return FALSE;
-
-	if (!TIFFSetDirectory(tiff, page)) {
-		TIFFClose(tiff);
+	handle = tiff_handle_acquire(filename, page);
+	if (handle == NULL)
 		return FALSE;
-	}
+	tiff = handle->tiff;
 
 	TIFFGetField(tiff, TIFFTAG_XRESOLUTION, &xres);
 	TIFFGetField(tiff, TIFFTAG_YRESOLUTION, &yres);
@@ -308,7 +832,7 @@ get_tiff_resolution (const char *filename, gint page, gdouble *xresolution, gdou
 		*yresolution = 0;
 	}
 
-	TIFFClose(tiff);
+	tiff_handle_release(handle);
 	return TRUE;
 }
 
@@ -352,6 +876,102 @@ transform_distance_to_pixel(cairo_matrix_t *matrix, gdouble distance)
 	return (gint) ceil(MAX(dx, dy));
 }
 
+/* The area a line was followed in, see follow_line(). */
+typedef struct {
+	gint start_x;
+	gint start_y;
+	gint end_x;
+	gint end_y;
+} LineSegment;
+
+/* Calculate the exact position of a line from the weighted center of two
+ * segments at a quarter and three quarters between start and end. */
+static void
+fit_line(cairo_surface_t *surface,
+         gint             start_x,
+         gint             start_y,
+         gint             end_x,
+         gint             end_y,
+         gint             x_dir,
+         gint             y_dir,
+         gint             line_width,
+         gint             line_length,
+         gdouble         *x1,
+         gdouble         *y1,
+         gdouble         *x2,
+         gdouble         *y2)
+{
+	gint offset;
+	gint x, y;
+	gdouble w1_x, w1_y;
+	gdouble w2_x, w2_y;
+	gdouble weight;
+
+	x = (start_x * 3 + end_x) / 4;
+	y = (start_y * 3 + end_y) / 4;
+	w1_x = 0;
+	w1_y = 0;
+	weight = 0;
+
+	for (offset = - 3 - line_width; offset <= 3 + line_width; offset++) {
+		gint seg_weight;
+		seg_weight = count_black_pixel(surface,
+		                               x + offset * y_dir - MAX(ABS((line_length / 2 - line_width * 2) * x_dir), 1) / 2,
+		                               y + offset * x_dir - MAX(ABS((line_length / 2 - line_width * 2) * y_dir), 1) / 2,
+		                               MAX(ABS((line_length / 2 - line_width * 2) * x_dir), 1),
+		                               MAX(ABS((line_length / 2 - line_width * 2) * y_dir), 1));
+
+		if (weight == 0) { /* this prevents a division by zero if seg_weight is 0 too. */
+			weight = seg_weight;
+			w1_x = x + offset * y_dir + 0.5;
+			w1_y = y + offset * x_dir + 0.5;
+		} else {
+			gdouble seg_x, seg_y;
+			seg_x = x + offset * y_dir + 0.5;
+			seg_y = y + offset * x_dir + 0.5;
+
+			w1_x = w1_x * weight / (weight + seg_weight) + seg_x * seg_weight / (weight + seg_weight);
+			w1_y = w1_y * weight / (weight + seg_weight) + seg_y * seg_weight / (weight + seg_weight);
+			weight += seg_weight;
+		}
+	}
+
+	x = (start_x + end_x * 3) / 4;
+	y = (start_y + end_y * 3) / 4;
+	w2_x = 0;
+	w2_y = 0;
+	weight = 0;
+
+	for (offset = - 3 - line_width; offset <= 3 + line_width; offset++) {
+		gint seg_weight;
+		seg_weight = count_black_pixel(surface,
+		                               x + offset * y_dir - MAX(ABS((line_length / 2 - line_width * 2) * x_dir), 1) / 2,
+		                               y + offset * x_dir - MAX(ABS((line_length / 2 - line_width * 2) * y_dir), 1) / 2,
+		                               MAX(ABS((line_length / 2 - line_width * 2) * x_dir), 1),
+		                               MAX(ABS((line_length / 2 - line_width * 2) * y_dir), 1));
+
+		if (weight == 0) { /* this prevents a division by zero if seg_weight is 0 too. */
+			weight = seg_weight;
+			w2_x = x + offset * y_dir + 0.5;
+			w2_y = y + offset * x_dir + 0.5;
+		} else {
+			gdouble seg_x, seg_y;
+			seg_x = x + offset * y_dir + 0.5;
+			seg_y = y + offset * x_dir + 0.5;
+
+			w2_x = w2_x * weight / (weight + seg_weight) + seg_x * seg_weight / (weight + seg_weight);
+			w2_y = w2_y * weight / (weight + seg_weight) + seg_y * seg_weight / (weight + seg_weight);
+			weight += seg_weight;
+		}
+	}
+
+	/* got two points, now extrapolate them to the line start/end. */
+	*x1 = w1_x - (w2_x - w1_x) / 2.0;
+	*y1 = w1_y - (w2_y - w1_y) / 2.0;
+	*x2 = w2_x - (w1_x - w2_x) / 2.0;
+	*y2 = w2_y - (w1_y - w2_y) / 2.0;
+}
+
 static gboolean
 follow_line(cairo_surface_t *surface,
             gint             x_start,
@@ -361,6 +981,7 @@ follow_line(cairo_surface_t *surface,
             gint             line_width,
             gint             line_length,
             gint             line_max_length,
+            LineSegment     *segment,
             gdouble         *x1,
             gdouble         *y1,
             gdouble         *x2,
@@ -568,74 +1189,13 @@ follow_line(cairo_surface_t *surface,
 	found_line = length >= line_length;
 
 	if (found_line) {
-		gint offset;
-		gdouble w1_x, w1_y;
-		gdouble w2_x, w2_y;
-		gdouble weight;
-
-		x = (start_x * 3 + end_x) / 4;
-		y = (start_y * 3 + end_y) / 4;
-		w1_x = 0;
-		w1_y = 0;
-		weight = 0;
-
-		for (offset = - 3 - line_width; offset <= 3 + line_width; offset++) {
-			gint seg_weight;
-			seg_weight = count_black_pixel(surface,
-			                               x + offset * y_dir - MAX(ABS((line_length / 2 - line_width * 2) * x_dir), 1) / 2,
-			                               y + offset * x_dir - MAX(ABS((line_length / 2 - line_width * 2) * y_dir), 1) / 2,
-			                               MAX(ABS((line_length / 2 - line_width * 2) * x_dir), 1),
-			                               MAX(ABS((line_length / 2 - line_width * 2) * y_dir), 1));
-
-			if (weight == 0) { /* this prevents a division by zero if seg_weight is 0 too. */
-				weight = seg_weight;
-				w1_x = x + offset * y_dir + 0.5;
-				w1_y = y + offset * x_dir + 0.5;
-			} else {
-				gdouble seg_x, seg_y;
-				seg_x = x + offset * y_dir + 0.5;
-				seg_y = y + offset * x_dir + 0.5;
-
-				w1_x = w1_x * weight / (weight + seg_weight) + seg_x * seg_weight / (weight + seg_weight);
-				w1_y = w1_y * weight / (weight + seg_weight) + seg_y * seg_weight / (weight + seg_weight);
-				weight += seg_weight;
-			}
-		}
-
-		x = (start_x + end_x * 3) / 4;
-		y = (start_y + end_y * 3) / 4;
-		w2_x = 0;
-		w2_y = 0;
-		weight = 0;
-
-		for (offset = - 3 - line_width; offset <= 3 + line_width; offset++) {
-			gint seg_weight;
-			seg_weight = count_black_pixel(surface,
-			                               x + offset * y_dir - MAX(ABS((line_length / 2 - line_width * 2) * x_dir), 1) / 2,
-			                               y + offset * x_dir - MAX(ABS((line_length / 2 - line_width * 2) * y_dir), 1) / 2,
-			                               MAX(ABS((line_length / 2 - line_width * 2) * x_dir), 1),
-			                               MAX(ABS((line_length / 2 - line_width * 2) * y_dir), 1));
-
-			if (weight == 0) { /* this prevents a division by zero if seg_weight is 0 too. */
-				weight = seg_weight;
-				w2_x = x + offset * y_dir + 0.5;
-				w2_y = y + offset * x_dir + 0.5;
-			} else {
-				gdouble seg_x, seg_y;
-				seg_x = x + offset * y_dir + 0.5;
-				seg_y = y + offset * x_dir + 0.5;
-
-				w2_x = w2_x * weight / (weight + seg_weight) + seg_x * seg_weight / (weight + seg_weight);
-				w2_y = w2_y * weight / (weight + seg_weight) + seg_y * seg_weight / (weight + seg_weight);
-				weight += seg_weight;
-			}
-		}
+		segment->start_x = start_x;
+		segment->start_y = start_y;
+		segment->end_x = end_x;
+		segment->end_y = end_y;
 
-		/* got two points, now extrapolate them to the line start/end. */
-		*x1 = w1_x - (w2_x - w1_x) / 2.0;
-		*y1 = w1_y - (w2_y - w1_y) / 2.0;
-		*x2 = w2_x - (w1_x - w2_x) / 2.0;
-		*y2 = w2_y - (w1_y - w2_y) / 2.0;
+		fit_line(surface, start_x, start_y, end_x, end_y, x_dir, y_dir,
+		         line_width, line_length, x1, y1, x2, y2);
 	}
 
 FOLLOW_LINE_BAIL:
@@ -659,6 +1219,31 @@ calc_intersection(gdouble  l1a_x,    gdouble l1a_y,
 
 #define DIST(x1, y1, x2, y2) sqrt(((x1) - (x2))*((x1) - (x2)) + ((y1) - (y2))*((y1) - (y2)))
 
+/* Check whether a marker position is too close to the border of the image. */
+static gboolean
+position_on_border(cairo_surface_t *surface,
+                   gdouble          x,
+                   gdouble          y,
+                   gint             line_width)
+{
+	gint width, height;
+
+	width = cairo_image_surface_get_width (surface);
+	height = cairo_image_surface_get_height (surface);
+
+	if (x - 3*line_width <= 0)
+		return TRUE;
+	if (x + 3*line_width >= width)
+		return TRUE;
+
+	if (y - 3*line_width <= 0)
+		return TRUE;
+	if (y + 3*line_width >= height)
+		return TRUE;
+
+	return FALSE;
+}
+
 static gboolean
 test_corner_marker(cairo_surface_t *surface,
                    gint             x,
@@ -668,6 +1253,8 @@ test_corner_marker(cairo_surface_t *surface,
                    gint             line_width,
                    gint             line_length,
                    gint             line_max_length,
+                   LineSegment     *h_segment,
+                   LineSegment     *v_segment,
                    gdouble         *x_result,
                    gdouble         *y_result)
 {
@@ -675,17 +1262,16 @@ test_corner_marker(cairo_surface_t *surface,
 	gboolean h_found_line;
 	gdouble v_x1, v_x2, v_y1, v_y2;
 	gboolean v_found_line;
-	gint width, height;
 
 	/* We just try to find both right away, even though we can only
 	 * expect to find one of them. */
 	h_found_line = follow_line(surface, x, y, x_dir, 0,
 	                           line_width, line_length, line_max_length,
-	                           &h_x1, &h_y1, &h_x2, &h_y2);
+	                           h_segment, &h_x1, &h_y1, &h_x2, &h_y2);
 
 	v_found_line = follow_line(surface, x, y, 0, y_dir,
 	                           line_width, line_length, line_max_length,
-	                           &v_x1, &v_y1, &v_x2, &v_y2);
+	                           v_segment, &v_x1, &v_y1, &v_x2, &v_y2);
 
 	if (!(h_found_line || v_found_line))
 		return FALSE;
@@ -694,22 +1280,22 @@ test_corner_marker(cairo_surface_t *surface,
 		if (y_dir < 0)
 			h_found_line = follow_line(surface, v_x1, v_y1, x_dir, 0,
 			                           line_width, line_length, line_max_length,
-			                           &h_x1, &h_y1, &h_x2, &h_y2);
+			                           h_segment, &h_x1, &h_y1, &h_x2, &h_y2);
 		else
 			h_found_line = follow_line(surface, v_x2, v_y2, x_dir, 0,
 			                           line_width, line_length, line_max_length,
-			                           &h_x1, &h_y1, &h_x2, &h_y2);
+			                           h_segment, &h_x1, &h_y1, &h_x2, &h_y2);
 	}
 
 	if (!v_found_line) {
 		if (x_dir < 0)
 			v_found_line = follow_line(surface, h_x1, h_y1, 0, y_dir,
 			                           line_width, line_length, line_max_length,
-			                           &v_x1, &v_y1, &v_x2, &v_y2);
+			                           v_segment, &v_x1, &v_y1, &v_x2, &v_y2);
 		else
 			v_found_line = follow_line(surface, h_x2, h_y2, 0, y_dir,
 			                           line_width, line_length, line_max_length,
-			                           &v_x1, &v_y1, &v_x2, &v_y2);
+			                           v_segment, &v_x1, &v_y1, &v_x2, &v_y2);
 	}
 
 	if (!v_found_line || !h_found_line)
@@ -726,21 +1312,7 @@ test_corner_marker(cairo_surface_t *surface,
 	                  v_x1, v_y1, v_x2, v_y2,
 	                  x_result, y_result);
 
-	/* Check that the resulting position is not on the border of the image. */
-	width = cairo_image_surface_get_width (surface);
-	height = cairo_image_surface_get_height (surface);
-
-	if (*x_result - 3*line_width <= 0)
-		return FALSE;
-	if (*x_result + 3*line_width >= width)
-		return FALSE;
-
-	if (*y_result - 3*line_width <= 0)
-		return FALSE;
-	if (*y_result + 3*line_width >= height)
-		return FALSE;
-
-	return TRUE;
+	return !position_on_border(surface, *x_result, *y_result, line_width);
 }
 
 static gboolean
@@ -753,6 +1325,8 @@ real_find_corner_marker(cairo_surface_t *surface,
                         gint             line_width,
                         gint             line_length,
                         gint             line_max_length,
+                        LineSegment     *h_segment,
+                        LineSegment     *v_segment,
                         gdouble         *x_result,
                         gdouble         *y_result)
 {
@@ -784,6 +1358,7 @@ real_find_corner_marker(cairo_surface_t *surface,
 			if ((old_coverage > (line_width * line_width) * LINE_COVERAGE) && (old_coverage > coverage)) {
 				if (test_corner_marker(surface, x, y, -x_dir, -y_dir,
 				                       line_width, line_length, line_max_length,
+				                       h_segment, v_segment,
 				                       x_result, y_result))
 					return TRUE;
 			}
@@ -808,6 +1383,7 @@ real_find_corner_marker(cairo_surface_t *surface,
 			if ((old_coverage > (line_width * line_width) * LINE_COVERAGE) && (old_coverage > coverage)) {
 				if (test_corner_marker(surface, x, y, -x_dir, -y_dir,
 				                       line_width, line_length, line_max_length,
+				                       h_segment, v_segment,
 				                       x_result, y_result))
 					return TRUE;
 			}
@@ -818,6 +1394,100 @@ real_find_corner_marker(cairo_surface_t *surface,
 }
 
 
+/* Cosine of the largest deviation from a right angle between the two lines of
+ * a corner marker (about 2 degree). */
+#define CORNER_MAX_COS_ANGLE 0.035
+
+/* Search on a reduced surface first, and then measure the lines that were
+ * found there at full resolution. Returns FALSE if the marker could not be
+ * located this way, the full search needs to be done then. */
+static gboolean
+find_corner_marker_reduced(cairo_surface_t *surface,
+                           gint             x_start,
+                           gint             y_start,
+                           gint             x_dir,
+                           gint             y_dir,
+                           gint             search_distance,
+                           gint             line_width,
+                           gint             line_length,
+                           gint             line_max_length,
+                           gdouble         *x_result,
+                           gdouble         *y_result)
+{
+	cairo_surface_t *reduced;
+	LineSegment h_segment, v_segment;
+	gdouble h_x1, h_x2, h_y1, h_y2;
+	gdouble v_x1, v_x2, v_y1, v_y2;
+	gdouble x, y;
+	gint max_level;
+	gint level = 0;
+	gint factor;
+
+	max_level = MIN(sdaps_corner_mark_pyramid_levels, SURFACE_PYRAMID_LEVELS);
+
+	/* The lines need to stay at least two pixels wide. */
+	while ((level < max_level) && ((line_width >> (level + 1)) >= 2))
+		level++;
+
+	if (level == 0)
+		return FALSE;
+
+	factor = 1 << level;
+	if (line_length / factor < 4)
+		return FALSE;
+
+	reduced = surface_get_reduced(surface, level);
+
+	/* Lines get up to one pixel longer because of the reduction. */
+	if (!real_find_corner_marker(reduced,
+	                             x_start / factor, y_start / factor,
+	                             x_dir, y_dir,
+	                             search_distance / factor + 1,
+	                             line_width / factor,
+	                             line_length / factor,
+	                             line_max_length / factor + 2,
+	                             &h_segment, &v_segment,
+	                             &x, &y))
+		return FALSE;
+
+	/* Following the lines takes nearly all of the time, so only their exact
+	 * position is measured again at full resolution. */
+	fit_line(surface,
+	         h_segment.start_x * factor + factor / 2, h_segment.start_y * factor + factor / 2,
+	         h_segment.end_x * factor + factor / 2, h_segment.end_y * factor + factor / 2,
+	         x_dir, 0, line_width, line_length,
+	         &h_x1, &h_y1, &h_x2, &h_y2);
+	fit_line(surface,
+	         v_segment.start_x * factor + factor / 2, v_segment.start_y * factor + factor / 2,
+	         v_segment.end_x * factor + factor / 2, v_segment.end_y * factor + factor / 2,
+	         0, y_dir, line_width, line_length,
+	         &v_x1, &v_y1, &v_x2, &v_y2);
+
+	/* The segment ends from the reduced image are only accurate to a few
+	 * pixels, which moves the windows the lines are measured in. Measure
+	 * again between the ends of the fitted lines. */
+	fit_line(surface, h_x1, h_y1, h_x2, h_y2, x_dir, 0, line_width, line_length,
+	         &h_x1, &h_y1, &h_x2, &h_y2);
+	fit_line(surface, v_x1, v_y1, v_x2, v_y2, 0, y_dir, line_width, line_length,
+	         &v_x1, &v_y1, &v_x2, &v_y2);
+
+	/* A line drifted away while it was followed if the two lines are not
+	 * perpendicular. */
+	if (fabs((h_x2 - h_x1) * (v_x2 - v_x1) + (h_y2 - h_y1) * (v_y2 - v_y1)) >
+	    CORNER_MAX_COS_ANGLE * DIST(h_x1, h_y1, h_x2, h_y2) * DIST(v_x1, v_y1, v_x2, v_y2))
+		return FALSE;
+
+	calc_intersection(h_x1, h_y1, h_x2, h_y2,
+	                  v_x1, v_y1, v_x2, v_y2,
+	                  x_result, y_result);
+
+	/* The estimate can only be off by a few pixels, otherwise the lines
+	 * were not measured correctly. */
+	if (DIST(x * factor, y * factor, *x_result, *y_result) > line_width + 2 * factor)
+		return FALSE;
+
+	return !position_on_border(surface, *x_result, *y_result, line_width);
+}
 
 /* Find corner marker */
 gboolean
@@ -834,6 +1504,7 @@ find_corner_marker(cairo_surface_t *surface,
 	gint dx, dy;
 	gint start_x, start_y;
 	gint search_distance;
+	LineSegment h_segment, v_segment;
 
 	line_width = transform_distance_to_pixel(matrix, sdaps_line_width);
 	line_length = transform_distance_to_pixel(matrix, sdaps_line_min_length);
@@ -872,7 +1543,75 @@ find_corner_marker(cairo_surface_t *surface,
 			g_assert_not_reached();
 	}
 
-	return real_find_corner_marker(surface, start_x, start_y, dx, dy, search_distance, line_width, line_length, line_max_length, marker_x, marker_y);
+	if (find_corner_marker_reduced(surface, start_x, start_y, dx, dy, search_distance, line_width, line_length, line_max_length, marker_x, marker_y))
+		return TRUE;
+
+	return real_find_corner_marker(surface, start_x, start_y, dx, dy, search_distance, line_width, line_length, line_max_length, &h_segment, &v_segment, marker_x, marker_y);
+}
+
+/* Find corner marker close to a known position, e.g. the position on the
+ * previous image of the same scan. Only markers that are at most distance
+ * away from the position are found. */
+gboolean
+find_corner_marker_near(cairo_surface_t *surface,
+                        cairo_matrix_t  *matrix,
+                        gint             corner,
+                        gdouble          x,
+                        gdouble          y,
+                        gdouble          distance,
+                        gdouble         *marker_x,
+                        gdouble         *marker_y)
+{
+	gint line_width;
+	gint line_length;
+	gint line_max_length;
+	gint dx, dy;
+	gint start_x, start_y;
+	gint px_distance;
+	gint search_distance;
+	gboolean found;
+	LineSegment h_segment, v_segment;
+
+	line_width = transform_distance_to_pixel(matrix, sdaps_line_width);
+	line_length = transform_distance_to_pixel(matrix, sdaps_line_min_length);
+	line_max_length = transform_distance_to_pixel(matrix, sdaps_line_max_length);
+	px_distance = transform_distance_to_pixel(matrix, distance);
+
+	switch (corner) {
+		case 1:
+			dx = 1;
+			dy = 1;
+			break;
+		case 2:
+			dx = -1;
+			dy = 1;
+			break;
+		case 3:
+			dx = -1;
+			dy = -1;
+			break;
+		case 4:
+			dx = 1;
+			dy = -1;
+			break;
+		default:
+			g_assert_not_reached();
+	}
+
+	/* Start outside of the position, the search moves inwards in steps of
+	 * a quarter line length. */
+	start_x = x - dx * px_distance;
+	start_y = y - dy * px_distance;
+	search_distance = 2 * px_distance + line_length / 4;
+
+	found = find_corner_marker_reduced(surface, start_x, start_y, dx, dy, search_distance, line_width, line_length, line_max_length, marker_x, marker_y);
+	if (!found)
+		found = real_find_corner_marker(surface, start_x, start_y, dx, dy, search_distance, line_width, line_length, line_max_length, &h_segment, &v_segment, marker_x, marker_y);
+
+	if (!found)
+		return FALSE;
+
+	return DIST(x, y, *marker_x, *marker_y) <= px_distance;
 }
 
 cairo_matrix_t*
@@ -964,6 +1703,7 @@ find_box_corners(cairo_surface_t  *surface,
 	gint line_length;
 	gint line_max_length;
 	gint search_distance;
+	LineSegment h_segment, v_segment;
 
 	line_width = transform_distance_to_pixel(matrix, sdaps_line_width);
 
@@ -995,13 +1735,13 @@ find_box_corners(cairo_surface_t  *surface,
 	search_distance = line_length;
 	/* We have the corner pixel positions, now try to find them. */
 
-	if (!real_find_corner_marker(surface, px_x1 - 4*line_width, px_y1 - 4*line_width, 1, 1, search_distance, line_width, line_length, line_max_length, &px_x1, &px_y1))
+	if (!real_find_corner_marker(surface, px_x1 - 4*line_width, px_y1 - 4*line_width, 1, 1, search_distance, line_width, line_length, line_max_length, &h_segment, &v_segment, &px_x1, &px_y1))
 		return FALSE;
-	if (!real_find_corner_marker(surface, px_x2 + 4*line_width, px_y2 - 4*line_width, -1, 1, search_distance, line_width, line_length, line_max_length, &px_x2, &px_y2))
+	if (!real_find_corner_marker(surface, px_x2 + 4*line_width, px_y2 - 4*line_width, -1, 1, search_distance, line_width, line_length, line_max_length, &h_segment, &v_segment, &px_x2, &px_y2))
 		return FALSE;
-	if (!real_find_corner_marker(surface, px_x3 + 4*line_width, px_y3 + 4*line_width, -1, -1, search_distance, line_width, line_length, line_max_length, &px_x3, &px_y3))
+	if (!real_find_corner_marker(surface, px_x3 + 4*line_width, px_y3 + 4*line_width, -1, -1, search_distance, line_width, line_length, line_max_length, &h_segment, &v_segment, &px_x3, &px_y3))
 		return FALSE;
-	if (!real_find_corner_marker(surface, px_x4 - 4*line_width, px_y4 + 4*line_width, 1, -1, search_distance, line_width, line_length, line_max_length, &px_x4, &px_y4))
+	if (!real_find_corner_marker(surface, px_x4 - 4*line_width, px_y4 + 4*line_width, 1, -1, search_distance, line_width, line_length, line_max_length, &h_segment, &v_segment, &px_x4, &px_y4))
 		return FALSE;
 
 	/* Found the corners, convert them back and return. */
@@ -1022,30 +1762,46 @@ find_box_corners(cairo_surface_t  *surface,
 	return TRUE;
 }
 
-gdouble
-get_coverage(cairo_surface_t *surface,
-             cairo_matrix_t  *matrix,
-             gdouble          mm_x,
-             gdouble          mm_y,
-             gdouble          mm_width,
-             gdouble          mm_height)
+/* The pixel area that get_coverage tests. */
+static void
+coverage_area(cairo_matrix_t *matrix,
+              gdouble         mm_x,
+              gdouble         mm_y,
+              gdouble         mm_width,
+              gdouble         mm_height,
+              gint           *x,
+              gint           *y,
+              gint           *width,
+              gint           *height)
 {
-	gint x, y, width, height;
 	gdouble tmp_x, tmp_y;
-	gint black, all;
 
 	/* Transform to pixel. */
 	tmp_x = mm_x;
 	tmp_y = mm_y;
 	cairo_matrix_transform_point(matrix, &tmp_x, &tmp_y);
-	x = tmp_x;
-	y = tmp_y;
+	*x = tmp_x;
+	*y = tmp_y;
 
 	tmp_x = mm_width;
 	tmp_y = mm_height;
 	cairo_matrix_transform_distance(matrix, &tmp_x, &tmp_y);
-	width = tmp_x;
-	height = tmp_y;
+	*width = tmp_x;
+	*height = tmp_y;
+}
+
+gdouble
+get_coverage(cairo_surface_t *surface,
+             cairo_matrix_t  *matrix,
+             gdouble          mm_x,
+             gdouble          mm_y,
+             gdouble          mm_width,
+             gdouble          mm_height)
+{
+	gint x, y, width, height;
+	gint black, all;
+
+	coverage_area(matrix, mm_x, mm_y, mm_width, mm_height, &x, &y, &width, &height);
 
 	black = count_black_pixel(surface, x, y, width, height);
 	all = width * height;
@@ -1064,11 +1820,211 @@ get_coverage(cairo_surface_t *surface,
 	return black / (gdouble) all;
 }
 
-gdouble
-get_masked_coverage(cairo_surface_t *surface,
-                    cairo_surface_t *mask,
-                    gint             x,
-                    gint             y)
+/* Tests one window of the textbox scan and grows the bounding box. The
+ * pixels are counted using the integral image if there is one, this gives
+ * the same result as get_coverage. */
+static void
+textbox_test_window(cairo_surface_t *surface,
+                    IntegralImage   *integral,
+                    cairo_matrix_t  *matrix,
+                    gdouble          x,
+                    gdouble          y,
+                    gdouble          test_width,
+                    gdouble          test_height,
+                    gdouble          min_coverage,
+                    gboolean        *found,
+                    gdouble         *bbox)
+{
+	gdouble bbox_x, bbox_y, end;
+	gdouble coverage;
+
+	if (integral) {
+		gint px_x, px_y, px_width, px_height;
+
+		coverage_area(matrix, x, y, test_width, test_height, &px_x, &px_y, &px_width, &px_height);
+		coverage = integral_image_count_black_pixel(integral, surface, px_x, px_y, px_width, px_height) / (gdouble) (px_width * px_height);
+	} else {
+		coverage = get_coverage(surface, matrix, x, y, test_width, test_height);
+	}
+
+	if (!(coverage > min_coverage))
+		return;
+
+	if (!*found) {
+		*found = TRUE;
+		bbox[0] = x;
+		bbox[1] = y;
+		bbox[2] = test_width;
+		bbox[3] = test_height;
+		return;
+	}
+
+	bbox_x = x < bbox[0] ? x : bbox[0];
+	bbox_y = y < bbox[1] ? y : bbox[1];
+
+	end = x + test_width;
+	bbox[2] = (end > bbox[0] + bbox[2] ? end : bbox[0] + bbox[2]) - bbox_x;
+	end = y + test_height;
+	bbox[3] = (end > bbox[1] + bbox[3] ? end : bbox[1] + bbox[3]) - bbox_y;
+
+	bbox[0] = bbox_x;
+	bbox[1] = bbox_y;
+}
+
+/* Tests the windows along a line from (x, y) to (dest_x, dest_y). */
+static void
+textbox_test_edge(cairo_surface_t *surface,
+                  IntegralImage   *integral,
+                  cairo_matrix_t  *matrix,
+                  gdouble          x,
+                  gdouble          y,
+                  gdouble          dest_x,
+                  gdouble          dest_y,
+                  gdouble          step,
+                  gdouble          test_width,
+                  gdouble          test_height,
+                  gdouble          min_coverage,
+                  gboolean        *found,
+                  gdouble         *bbox)
+{
+	gdouble dist_x, dist_y;
+	gdouble length;
+	gint i, steps;
+
+	dist_x = dest_x - x;
+	dist_y = dest_y - y;
+
+	length = sqrt(dist_x * dist_x + dist_y * dist_y);
+	steps = length / step;
+	for (i = 0; i < steps; i++) {
+		textbox_test_window(surface, integral, matrix,
+		                    x + dist_x * i / (length / step),
+		                    y + dist_y * i / (length / step),
+		                    test_width, test_height, min_coverage, found, bbox);
+	}
+	textbox_test_window(surface, integral, matrix, dest_x, dest_y, test_width, test_height, min_coverage, found, bbox);
+}
+
+/* Scans the quadrilateral given by the corners (top left, top right, bottom
+ * right, bottom left) for writing. Small windows stepped over the inside
+ * and along the outline (staying padding away from it) are tested for
+ * their coverage. Returns TRUE and the bounding box of all windows that
+ * are covered more than min_coverage if there are any.
+ * With use_integral, the pixels are counted using a summed-area table of
+ * the area of the quadrilateral. The windows overlap a lot, so this is much
+ * cheaper than counting every window. */
+gboolean
+find_textbox_writing(cairo_surface_t *surface,
+                     cairo_matrix_t  *matrix,
+                     gdouble          corners[4][2],
+                     gdouble          step_x,
+                     gdouble          step_y,
+                     gdouble          test_width,
+                     gdouble          test_height,
+                     gdouble          padding,
+                     gdouble          min_coverage,
+                     gboolean         use_integral,
+                     gdouble         *bbox)
+{
+	gdouble x0 = corners[0][0], y0 = corners[0][1];
+	gdouble x1 = corners[1][0], y1 = corners[1][1];
+	gdouble x2 = corners[2][0], y2 = corners[2][1];
+	gdouble x3 = corners[3][0], y3 = corners[3][1];
+	gdouble m0, m1, m2, m3;
+	gdouble top, bottom, left, right;
+	gdouble x, y, l;
+	IntegralImage *integral = NULL;
+	gboolean found = FALSE;
+
+	m0 = (y1 - y0) / (x1 - x0);
+	m1 = (x2 - x1) / (y2 - y1);
+	m2 = (y3 - y2) / (x3 - x2);
+	m3 = (x0 - x3) / (y0 - y3);
+
+	top = MIN(y0, y1);
+	bottom = MAX(y2, y3);
+	left = MIN(x0, x3);
+	right = MAX(x1, x2);
+
+	/* The debug surface is drawn by get_coverage */
+	if (use_integral && !sdaps_create_debug_surface) {
+		gdouble px[4][2];
+		gdouble min_x, min_y, max_x, max_y;
+		gint i;
+
+		/* All windows lie within the bounding box of the corners. One
+		 * pixel is added around it as the windows are truncated to whole
+		 * pixels, other windows are counted directly. */
+		for (i = 0; i < 4; i++) {
+			px[i][0] = i == 0 || i == 3 ? left : right;
+			px[i][1] = i < 2 ? top : bottom;
+			cairo_matrix_transform_point(matrix, &px[i][0], &px[i][1]);
+		}
+		min_x = MIN(MIN(px[0][0], px[1][0]), MIN(px[2][0], px[3][0]));
+		min_y = MIN(MIN(px[0][1], px[1][1]), MIN(px[2][1], px[3][1]));
+		max_x = MAX(MAX(px[0][0], px[1][0]), MAX(px[2][0], px[3][0]));
+		max_y = MAX(MAX(px[0][1], px[1][1]), MAX(px[2][1], px[3][1]));
+
+		integral = integral_image_new(surface, floor(min_x) - 1, floor(min_y) - 1,
+		                              ceil(max_x) - floor(min_x) + 2, ceil(max_y) - floor(min_y) + 2);
+	}
+
+	/* The inside */
+	for (y = top; y + test_height < bottom; y += step_y) {
+		for (x = left; x + test_width < right; x += step_x) {
+			l = y0 + m0 * (x - x0);
+			if (!(l + padding < y))
+				continue;
+
+			l = y2 + m2 * (x - x2);
+			if (!(l - padding > y + test_height))
+				continue;
+
+			l = x1 + m1 * (y - y1);
+			if (!(l - padding > x + test_width))
+				continue;
+
+			l = x3 + m3 * (y - y3);
+			if (!(l + padding < x))
+				continue;
+
+			textbox_test_window(surface, integral, matrix, x, y, test_width, test_height, min_coverage, &found, bbox);
+		}
+	}
+
+	/* Top, bottom, left and right along the outline */
+	textbox_test_edge(surface, integral, matrix,
+	                  x0 + padding, y0 + padding,
+	                  x1 - padding - test_width, y1 + padding,
+	                  step_x, test_width, test_height, min_coverage, &found, bbox);
+	textbox_test_edge(surface, integral, matrix,
+	                  x3 + padding, y3 - padding - test_height,
+	                  x2 - padding - test_width, y2 - padding - test_height,
+	                  step_x, test_width, test_height, min_coverage, &found, bbox);
+	textbox_test_edge(surface, integral, matrix,
+	                  x0 + padding, y0 + padding,
+	                  x3 + padding, y3 - padding - test_height,
+	                  step_y, test_width, test_height, min_coverage, &found, bbox);
+	textbox_test_edge(surface, integral, matrix,
+	                  x1 - padding - test_width, y1 + padding,
+	                  x2 - padding - test_width, y2 - padding - test_height,
+	                  step_y, test_width, test_height, min_coverage, &found, bbox);
+
+	if (integral)
+		integral_image_free(integral);
+
+	return found;
+}
+
+/* The masked functions below are split into the real work, which only draws
+ * on a debug surface if one is passed, and the public function that creates
+ * the debug surface if requested. get_checkbox_metrics uses the former, so it
+ * never touches the global debug surface. */
+static gdouble
+real_get_masked_coverage(cairo_surface_t *surface,
+                         cairo_surface_t *mask,
+                         gint             x,
+                         gint             y)
 {
 	gint width, height;
 	gint black, all;
@@ -1079,9 +2035,25 @@ get_masked_coverage(cairo_surface_t *surface,
 	all = count_black_pixel(mask, 0, 0, width, height);
 	black = count_black_pixel_masked(surface, mask, x, y);
 
+	return black / (gdouble) all;
+}
+
+gdouble
+get_masked_coverage(cairo_surface_t *surface,
+                    cairo_surface_t *mask,
+                    gint             x,
+                    gint             y)
+{
 	if (sdaps_create_debug_surface) {
-		cairo_surface_t *surf = debug_surface_create(x, y, width, height, 0, 0, 0, 0);
-		cairo_t *cr = cairo_create(surf);
+		gint width, height;
+		cairo_surface_t *surf;
+		cairo_t *cr;
+
+		width = cairo_image_surface_get_width(mask);
+		height = cairo_image_surface_get_height(mask);
+
+		surf = debug_surface_create(x, y, width, height, 0, 0, 0, 0);
+		cr = cairo_create(surf);
 
 		cairo_set_source_rgba(cr, 1, 0, 0, 0.5);
 		cairo_mask_surface(cr, mask, 0, 0);
@@ -1090,21 +2062,19 @@ get_masked_coverage(cairo_surface_t *surface,
 		cairo_surface_flush(surf);
 	}
 
-	return black / (gdouble) all;
+	return real_get_masked_coverage(surface, mask, x, y);
 }
 
-/* First removes the number of lines, and then calculates the coverage of what
- * is left. */
-gdouble
-get_masked_coverage_without_lines(cairo_surface_t *surface,
-                                  cairo_surface_t *mask,
-                                  gint             x,
-                                  gint             y,
-                                  gdouble          line_width,
-                                  gint             line_count)
+static gdouble
+real_get_masked_coverage_without_lines(cairo_surface_t *surface,
+                                       cairo_surface_t *mask,
+                                       gint             x,
+                                       gint             y,
+                                       gdouble          line_width,
+                                       gint             line_count,
+                                       cairo_surface_t *debug_surf)
 {
 	cairo_surface_t *tmp_surface;
-	cairo_surface_t *debug_surf;
 	gint width, height;
 	gdouble result;
 	gint i, all;
@@ -1116,17 +2086,6 @@ get_masked_coverage_without_lines(cairo_surface_t *surface,
 
 	tmp_surface = surface_copy_masked(surface, mask, x, y);
 
-	debug_surf = debug_surface_create(x, y, width, height, 0, 0, 0, 0);
-	if (debug_surf) {
-		cairo_t *cr;
-		cr = cairo_create(debug_surf);
-		cairo_set_source_rgba(cr, 0, 0, 1, 0.5);
-		cairo_mask_surface(cr, mask, 0, 0);
-
-		cairo_destroy(cr);
-		cairo_surface_flush(debug_surf);
-	}
-
 #if 0
 	/* Something like this could be used to filter the image first.
 	 * Obviously, for that to work, the size of the surface needs to be
@@ -1155,19 +2114,50 @@ get_masked_coverage_without_lines(cairo_surface_t *surface,
 	return result;
 }
 
-guint
-get_masked_white_area_count(cairo_surface_t *surface,
-                            cairo_surface_t *mask,
-                            gint             x,
-                            gint             y,
-                            gdouble          min_size,
-                            gdouble          max_size,
-                            gdouble         *filled_area)
+/* First removes the number of lines, and then calculates the coverage of what
+ * is left. */
+gdouble
+get_masked_coverage_without_lines(cairo_surface_t *surface,
+                                  cairo_surface_t *mask,
+                                  gint             x,
+                                  gint             y,
+                                  gdouble          line_width,
+                                  gint             line_count)
 {
-	cairo_surface_t *tmp_surface;
-	cairo_surface_t *backup_surface;
 	cairo_surface_t *debug_surf;
-	cairo_t *backup_cr;
+	gint width, height;
+
+	width = cairo_image_surface_get_width(mask);
+	height = cairo_image_surface_get_height(mask);
+
+	debug_surf = debug_surface_create(x, y, width, height, 0, 0, 0, 0);
+	if (debug_surf) {
+		cairo_t *cr;
+		cr = cairo_create(debug_surf);
+		cairo_set_source_rgba(cr, 0, 0, 1, 0.5);
+		cairo_mask_surface(cr, mask, 0, 0);
+
+		cairo_destroy(cr);
+		cairo_surface_flush(debug_surf);
+	}
+
+	return real_get_masked_coverage_without_lines(surface, mask, x, y, line_width, line_count, debug_surf);
+}
+
+static guint
+real_get_masked_white_area_count(cairo_surface_t *surface,
+                                 cairo_surface_t *mask,
+                                 gint             x,
+                                 gint             y,
+                                 gdouble          min_size,
+                                 gdouble          max_size,
+                                 gdouble         *filled_area,
+                                 cairo_surface_t *debug_surf)
+{
+	cairo_surface_t *tmp_surface;
+	cairo_surface_t *backup_surface = NULL;
+	GArray *areas;
+	guint i;
 	gint width, height;
 	guint result = 0;
 	guint min_size_px;
@@ -1185,13 +2175,10 @@ get_masked_white_area_count(cairo_surface_t *surface,
 	tmp_surface = surface_inverted_copy_masked(surface, mask, x, y);
 
 	/* Debug images */
-	debug_surf = debug_surface_create(x, y, width, height, 0, 0, 0, 0);
 	if (debug_surf != NULL) {
 		cairo_t *debug_cr;
 
 		backup_surface = surface_copy(tmp_surface);
-		backup_cr = cairo_create(backup_surface);
-		cairo_set_operator(backup_cr, CAIRO_OPERATOR_SOURCE);
 
 		debug_cr = cairo_create(debug_surf);
 		cairo_set_source_rgba(debug_cr, 0, 0, 1, 0.5);
@@ -1203,33 +2190,109 @@ get_masked_white_area_count(cairo_surface_t *surface,
 
 	*filled_area = 0;
 
-	for (y = 0; y < height; y++) {
-		for (x = 0; x < width; x++) {
-			if (debug_surf != NULL) {
-				cairo_set_source_surface(backup_cr, tmp_surface, 0, 0);
-				cairo_paint(backup_cr);
-			}
+	areas = flood_fill_all(tmp_surface, 1);
+	for (i = 0; i < areas->len; i++) {
+		FloodFillArea *area = &g_array_index(areas, FloodFillArea, i);
 
-			guint area = flood_fill(tmp_surface, NULL, x, y, 1);
-			if ((area >= min_size_px) && (area <= max_size_px)) {
-				result += 1;
-				*filled_area += area / ((gdouble) all);
+		if ((area->size >= min_size_px) && (area->size <= max_size_px)) {
+			result += 1;
+			*filled_area += area->size / ((gdouble) all);
 
-				/* Flood fill again, this time also mark the area on the debug surface. */
-				if (debug_surf)
-					flood_fill(backup_surface, debug_surf, x, y, 1);
-			}
+			/* Flood fill again on the untouched copy, this time also
+			 * marking the area on the debug surface. */
+			if (debug_surf != NULL)
+				flood_fill(backup_surface, debug_surf, area->x, area->y, 1);
 		}
 	}
+	g_array_free(areas, TRUE);
 
-	if (debug_surf != NULL) {
+	if (debug_surf != NULL)
 		cairo_surface_destroy(backup_surface);
-		cairo_destroy(backup_cr);
-	}
 
 	cairo_surface_destroy(tmp_surface);
 
 	return result;
 }
 
+guint
+get_masked_white_area_count(cairo_surface_t *surface,
+                            cairo_surface_t *mask,
+                            gint             x,
+                            gint             y,
+                            gdouble          min_size,
+                            gdouble          max_size,
+                            gdouble         *filled_area)
+{
+	cairo_surface_t *debug_surf;
+	gint width, height;
+
+	width = cairo_image_surface_get_width(mask);
+	height = cairo_image_surface_get_height(mask);
+
+	debug_surf = debug_surface_create(x, y, width, height, 0, 0, 0, 0);
+
+	return real_get_masked_white_area_count(surface, mask, x, y, min_size, max_size, filled_area, debug_surf);
+}
+
+/* Does everything the recognition of a checkbox needs from the image for all
+ * the given boxes. This is the same as calling calculate_correction_matrix_masked
+ * with the outline mask and then get_masked_coverage,
+ * get_masked_coverage_without_lines (3 lines) and get_masked_white_area_count
+ * (5% to 100%) with the inner mask at the corrected position, except that
+ * no debug surfaces are created. */
+void
+get_checkbox_metrics(cairo_surface_t *surface,
+                     cairo_matrix_t  *matrix,
+                     CheckboxMetrics *boxes,
+                     gint             count,
+                     gdouble          remove_line_width,
+                     const gdouble   *final_ranges,
+                     gint             final_range_count)
+{
+	cairo_matrix_t *correction;
+	CheckboxMetrics *box;
+	gdouble x, y;
+	gint px_x, px_y;
+	gint i, j;
+
+	for (i = 0; i < count; i++) {
+		box = &boxes[i];
+
+		/* The position is passed as float when this is done from python,
+		 * do the same to get identical results. */
+		correction = calculate_correction_matrix_masked(surface, box->outline, matrix,
+		                                                (gfloat) box->mm_x, (gfloat) box->mm_y,
+		                                                &box->covered);
+
+		x = box->mm_x;
+		y = box->mm_y;
+		cairo_matrix_transform_point(correction, &x, &y);
+		g_free(correction);
+
+		box->x = x + box->outline_xoff;
+		box->y = y + box->outline_yoff;
+
+		x = box->x + box->inner_xoff;
+		y = box->y + box->inner_yoff;
+		cairo_matrix_transform_point(matrix, &x, &y);
+		px_x = x;
+		px_y = y;
+
+		box->coverage = real_get_masked_coverage(surface, box->inner, px_x, px_y);
+
+		/* The other metrics cannot change the result if the coverage is in
+		 * one of the final ranges (pairs of lower and upper bound). */
+		for (j = 0; j < final_range_count; j++) {
+			if ((box->coverage >= final_ranges[2 * j]) && (box->coverage <= final_ranges[2 * j + 1]))
+				break;
+		}
+		if (j < final_range_count) {
+			box->coverage_without_lines = -1;
+			box->white_area_coverage = -1;
+			continue;
+		}
 
+		box->coverage_without_lines = real_get_masked_coverage_without_lines(surface, box->inner, px_x, px_y, remove_line_width, 3, NULL);
+		real_get_masked_white_area_count(surface, box->inner, px_x, px_y, 0.05, 1.0, &box->white_area_coverage, NULL);
+	}
+}
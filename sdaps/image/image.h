@@ -25,6 +25,7 @@ extern gdouble sdaps_line_max_length;
 extern gdouble sdaps_line_width;
 extern gdouble sdaps_corner_mark_search_distance;
 extern gdouble sdaps_line_coverage;
+extern gint sdaps_corner_mark_pyramid_levels;
 
 extern gboolean sdaps_create_debug_surface;
 extern gint sdaps_debug_surface_ox;
@@ -37,6 +38,9 @@ disable_libtiff_warnings (void);
 cairo_surface_t*
 get_a1_from_tiff (const char *filename, gint page, gboolean rotated);
 
+cairo_surface_t*
+get_a1_from_tiff_partial (const char *filename, gint page, gboolean rotated, const gint *row_ranges, gint range_count);
+
 gboolean
 write_a1_to_tiff (const char *filename, cairo_surface_t *surf);
 
@@ -46,15 +50,27 @@ get_rgb24_from_tiff (const char *filename, gint page, gboolean rotated);
 gint
 get_tiff_page_count (const char *filename);
 
+gchar*
+get_tiff_page_checksum (const char *filename, gint page);
+
+gboolean
+get_tiff_size (const char *filename, gint page, gint *width, gint *height);
+
 gboolean
 get_tiff_resolution (const char *filename, gint page, gdouble *xresolution, gdouble *yresolution);
 
 gboolean
 check_tiff_monochrome (const char *filename);
 
+void
+clear_tiff_cache (void);
+
 gboolean
 find_corner_marker(cairo_surface_t *surface, cairo_matrix_t *matrix, gint corner, gdouble *marker_x, gdouble *marker_y);
 
+gboolean
+find_corner_marker_near(cairo_surface_t *surface, cairo_matrix_t *matrix, gint corner, gdouble x, gdouble y, gdouble distance, gdouble *marker_x, gdouble *marker_y);
+
 cairo_matrix_t*
 calculate_matrix(cairo_surface_t *surface, cairo_matrix_t *matrix, gdouble mm_x, gdouble mm_y, gdouble mm_width, gdouble mm_height);
 
@@ -68,6 +84,11 @@ find_box_corners(cairo_surface_t *surface, cairo_matrix_t *matrix, gdouble mm_x,
 gdouble
 get_coverage(cairo_surface_t *surface, cairo_matrix_t *matrix, gdouble mm_x, gdouble mm_y, gdouble mm_width, gdouble mm_height);
 
+gboolean
+find_textbox_writing(cairo_surface_t *surface, cairo_matrix_t *matrix, gdouble corners[4][2],
+                     gdouble step_x, gdouble step_y, gdouble test_width, gdouble test_height,
+                     gdouble padding, gdouble min_coverage, gboolean use_integral, gdouble *bbox);
+
 gdouble
 get_masked_coverage(cairo_surface_t *surface, cairo_surface_t *mask, gint x, gint y);
 
@@ -77,3 +98,28 @@ get_masked_coverage_without_lines(cairo_surface_t *surface, cairo_surface_t *mas
 guint
 get_masked_white_area_count(cairo_surface_t *surface, cairo_surface_t *mask, gint x, gint y, gdouble min_size, gdouble max_size, gdouble *filled_area);
 
+/* A checkbox for get_checkbox_metrics. The masks are the ones used by the
+ * recognition, the offsets are the position of the box in the mask (mm). */
+typedef struct {
+	/* Input */
+	cairo_surface_t *outline;
+	gdouble outline_xoff;
+	gdouble outline_yoff;
+	cairo_surface_t *inner;
+	gdouble inner_xoff;
+	gdouble inner_yoff;
+	gdouble mm_x;
+	gdouble mm_y;
+
+	/* Output, the corrected position and the metrics. The expensive metrics
+	 * are negative if they were skipped. */
+	gdouble x;
+	gdouble y;
+	gdouble covered;
+	gdouble coverage;
+	gdouble coverage_without_lines;
+	gdouble white_area_coverage;
+} CheckboxMetrics;
+
+void
+get_checkbox_metrics(cairo_surface_t *surface, cairo_matrix_t *matrix, CheckboxMetrics *boxes, gint count, gdouble remove_line_width, const gdouble *final_ranges, gint final_range_count);
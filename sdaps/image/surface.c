@@ -19,6 +19,24 @@
 #include "surface.h"
 
 #define WORD_COUNT_BITS(x) __builtin_popcount(x)
+#define WORD64_COUNT_BITS(x) __builtin_popcountll(x)
+
+/* Combine two consecutive words of an A1 row into one 64 bit word that has
+ * the pixels in the same order. */
+#if G_BYTE_ORDER == G_BIG_ENDIAN
+#define JOIN_WORDS(_first, _second) (((guint64) (_first) << 32) | (guint64) (_second))
+#else
+#define JOIN_WORDS(_first, _second) ((guint64) (_first) | ((guint64) (_second) << 32))
+#endif
+
+/* The pixel counting is the innermost loop of all the recognition. Let the
+ * compiler create versions using the popcnt instruction and AVX2, the best
+ * one is selected at runtime. */
+#if defined(__GNUC__) && !defined(__clang__) && defined(__x86_64__) && defined(__linux__)
+#define COUNT_TARGET_CLONES __attribute__((target_clones("avx2", "popcnt", "default")))
+#else
+#define COUNT_TARGET_CLONES
+#endif
 
 cairo_surface_t*
 surface_copy_partial(cairo_surface_t *surface, int x, int y, int width, int height)
@@ -118,6 +136,88 @@ surface_inverted_copy_masked(cairo_surface_t *surface, cairo_surface_t *mask, gi
 }
 
 
+/* Reverses the bit order of a word, ie. mirrors the 32 pixels it contains. */
+static guint32
+reverse_word(guint32 w)
+{
+	w = ((w >> 1) & 0x55555555) | ((w & 0x55555555) << 1);
+	w = ((w >> 2) & 0x33333333) | ((w & 0x33333333) << 2);
+	w = ((w >> 4) & 0x0f0f0f0f) | ((w & 0x0f0f0f0f) << 4);
+	w = ((w >> 8) & 0x00ff00ff) | ((w & 0x00ff00ff) << 8);
+	w = (w >> 16) | (w << 16);
+
+	return w;
+}
+
+/* Stores the mirrored row src with words words into dest. pad is the number
+ * of unused pixels at the end of the last word. */
+static void
+mirror_row(guint32 *dest, guint32 *src, gint words, gint pad)
+{
+	gint i;
+
+	for (i = 0; i < words; i++)
+		dest[i] = reverse_word(src[words - 1 - i]);
+
+	if (pad == 0)
+		return;
+
+	/* The padding is at the start of the row now, move the pixels back to
+	 * the start (clearing the padding at the end again). */
+	for (i = 0; i < words; i++) {
+#if G_BYTE_ORDER == G_BIG_ENDIAN
+		dest[i] = dest[i] << pad;
+		if (i + 1 < words)
+			dest[i] |= dest[i + 1] >> (32 - pad);
+#else
+		dest[i] = dest[i] >> pad;
+		if (i + 1 < words)
+			dest[i] |= dest[i + 1] << (32 - pad);
+#endif
+	}
+}
+
+void
+surface_rotate_180(cairo_surface_t *surface)
+{
+	gint width, height, stride;
+	gint words, pad;
+	guint32 *pixels;
+	guint32 *top, *bottom;
+	gint y;
+
+	g_assert(cairo_image_surface_get_format(surface) == CAIRO_FORMAT_A1);
+
+	surface_clear_pyramid(surface);
+	cairo_surface_flush(surface);
+
+	width = cairo_image_surface_get_width(surface);
+	height = cairo_image_surface_get_height(surface);
+	stride = cairo_image_surface_get_stride(surface) / 4;
+	pixels = (guint32*) cairo_image_surface_get_data(surface);
+
+	words = (width + 31) / 32;
+	pad = words * 32 - width;
+
+	top = g_new(guint32, words);
+	bottom = g_new(guint32, words);
+
+	/* Swap the rows from the outside in, mirroring each of them. For an odd
+	 * height the center row is simply mirrored in place. */
+	for (y = 0; y < (height + 1) / 2; y++) {
+		mirror_row(top, pixels + y * stride, words, pad);
+		mirror_row(bottom, pixels + (height - 1 - y) * stride, words, pad);
+
+		memcpy(pixels + y * stride, bottom, words * 4);
+		memcpy(pixels + (height - 1 - y) * stride, top, words * 4);
+	}
+
+	g_free(top);
+	g_free(bottom);
+
+	cairo_surface_mark_dirty(surface);
+}
+
 /* Generic pixel routines */
 void
 set_pixels_unchecked(guint32* pixels, guint32 stride, gint x, gint y, gint width, gint height, int value)
@@ -168,6 +268,311 @@ get_pbm(cairo_surface_t *surface, void **data, gssize *length)
 	}
 }
 
+void
+get_y800(cairo_surface_t *surface, void **data, gssize *length)
+{
+	int width, height;
+	int s_stride;
+	unsigned char* s_pixel;
+	unsigned char* d_pixel;
+	int x, y;
+
+	*data = NULL;
+	*length = 0;
+
+	if (cairo_image_surface_get_format (surface) != CAIRO_FORMAT_A1)
+		return;
+
+	width = cairo_image_surface_get_width(surface);
+	height = cairo_image_surface_get_height(surface);
+	s_stride = cairo_image_surface_get_stride(surface);
+	s_pixel = cairo_image_surface_get_data(surface);
+
+	*length = width * height;
+	*data = g_malloc(*length);
+	d_pixel = *data;
+
+	for (y = 0; y < height; y++) {
+		for (x = 0; x < width; x++) {
+			/* Set pixels are black */
+			*(d_pixel + y*width + x) = GET_PIXEL(s_pixel, s_stride, x, y) ? 0x00 : 0xff;
+		}
+	}
+}
+
+/* Entry (x, y) of the table contains the number of black pixels above and
+ * left of the pixel (x, y) relative to the origin of the area, so the first
+ * row and column are zero. The rows are built one pixel word at a time,
+ * white words (i.e. most of them) only copy the row sum. */
+IntegralImage*
+integral_image_new(cairo_surface_t *surface, gint x, gint y, gint width, gint height)
+{
+	IntegralImage *integral;
+	guint32 *pixels;
+	guint32 *sums;
+	gint img_width, img_height, stride;
+	gint px, py, i;
+
+	g_assert(cairo_image_surface_get_format(surface) == CAIRO_FORMAT_A1);
+
+	cairo_surface_flush(surface);
+
+	img_width = cairo_image_surface_get_width(surface);
+	img_height = cairo_image_surface_get_height(surface);
+	stride = cairo_image_surface_get_stride(surface);
+	pixels = (guint32*) cairo_image_surface_get_data(surface);
+
+	/* Clip to the surface */
+	if (x < 0) {
+		width += x;
+		x = 0;
+	}
+	if (y < 0) {
+		height += y;
+		y = 0;
+	}
+	width = MAX(0, MIN(width, img_width - x));
+	height = MAX(0, MIN(height, img_height - y));
+
+	integral = g_new(IntegralImage, 1);
+	integral->x = x;
+	integral->y = y;
+	integral->width = width;
+	integral->height = height;
+	integral->sums = g_new0(guint32, (width + 1) * (height + 1));
+
+	sums = integral->sums + width + 1;
+	for (py = 0; py < height; py++) {
+		guint32 *row = pixels + (y + py) * (stride / 4);
+		guint32 *above = sums - (width + 1);
+		guint32 row_sum = 0;
+
+		px = 0;
+		while (px < width) {
+			gint bit = (x + px) & 0x1f;
+			gint count = MIN(32 - bit, width - px);
+			guint32 word = row[(x + px) >> 5];
+
+#if G_BYTE_ORDER == G_BIG_ENDIAN
+			word <<= bit;
+#else
+			word >>= bit;
+#endif
+			if (word == 0 && count == 32) {
+				/* Fixed length, so that the compiler vectorizes it */
+				for (i = 0; i < 32; i++)
+					sums[px + i + 1] = above[px + i + 1] + row_sum;
+			} else if (word == 0) {
+				for (i = 0; i < count; i++)
+					sums[px + i + 1] = above[px + i + 1] + row_sum;
+			} else {
+				for (i = 0; i < count; i++) {
+#if G_BYTE_ORDER == G_BIG_ENDIAN
+					row_sum += (word >> (31 - i)) & 0x1;
+#else
+					row_sum += (word >> i) & 0x1;
+#endif
+					sums[px + i + 1] = above[px + i + 1] + row_sum;
+				}
+			}
+
+			px += count;
+		}
+
+		sums += width + 1;
+	}
+
+	return integral;
+}
+
+void
+integral_image_free(IntegralImage *integral)
+{
+	g_free(integral->sums);
+	g_free(integral);
+}
+
+/* Same as count_black_pixel. Areas that are not fully inside the table are
+ * counted on the surface. */
+gint
+integral_image_count_black_pixel(IntegralImage *integral, cairo_surface_t *surface, gint x, gint y, gint width, gint height)
+{
+	guint32 *sums;
+	gint row;
+	gint img_width, img_height;
+
+	img_width = cairo_image_surface_get_width(surface);
+	img_height = cairo_image_surface_get_height(surface);
+
+	if (y < 0) {
+		height += y;
+		y = 0;
+	}
+	if (x < 0) {
+		width += x;
+		x = 0;
+	}
+	if ((width <= 0) || (height <= 0))
+		return 0;
+	if (x + width > img_width) {
+		width = img_width - x;
+	}
+	if (y + height > img_height) {
+		height = img_height - y;
+	}
+	if ((width <= 0) || (height <= 0))
+		return 0;
+
+	if (x < integral->x || y < integral->y ||
+	    x + width > integral->x + integral->width ||
+	    y + height > integral->y + integral->height)
+		return count_black_pixel_unchecked((guint32*) cairo_image_surface_get_data(surface),
+		                                   cairo_image_surface_get_stride(surface),
+		                                   x, y, width, height);
+
+	x -= integral->x;
+	y -= integral->y;
+	sums = integral->sums;
+	row = integral->width + 1;
+
+	return sums[(y + height) * row + x + width] - sums[y * row + x + width]
+	     - sums[(y + height) * row + x] + sums[y * row + x];
+}
+
+/* Reduced copies of an A1 surface, level n is scaled down by 2^n. A pixel of
+ * a reduced surface is black if any of the pixels it covers is black, so that
+ * thin lines survive the reduction. */
+typedef struct {
+	cairo_surface_t *levels[SURFACE_PYRAMID_LEVELS];
+} Pyramid;
+
+static cairo_user_data_key_t pyramid_key;
+
+static void
+pyramid_free(void *data)
+{
+	Pyramid *pyramid = data;
+	gint i;
+
+	for (i = 0; i < SURFACE_PYRAMID_LEVELS; i++) {
+		if (pyramid->levels[i])
+			cairo_surface_destroy(pyramid->levels[i]);
+	}
+	g_free(pyramid);
+}
+
+/* Moves the even bits of a word into the lower 16 bits. */
+static guint32
+compress_even_bits(guint32 v)
+{
+	v &= 0x55555555;
+	v = (v | (v >> 1)) & 0x33333333;
+	v = (v | (v >> 2)) & 0x0f0f0f0f;
+	v = (v | (v >> 4)) & 0x00ff00ff;
+	v = (v | (v >> 8)) & 0x0000ffff;
+
+	return v;
+}
+
+/* OR of each pair of horizontal pixels, packed into 16 pixels. */
+#if G_BYTE_ORDER == G_BIG_ENDIAN
+#define REDUCE_WORD(_w) compress_even_bits(((_w) | ((_w) << 1)) >> 1)
+#define REDUCE_JOIN(_first, _second) (((_first) << 16) | (_second))
+#else
+#define REDUCE_WORD(_w) compress_even_bits((_w) | ((_w) >> 1))
+#define REDUCE_JOIN(_first, _second) ((_first) | ((_second) << 16))
+#endif
+
+static cairo_surface_t*
+surface_reduce(cairo_surface_t *surface)
+{
+	cairo_surface_t *result;
+	guint32 *pixels, *r_pixels;
+	guint32 last_mask;
+	gint width, height, stride;
+	gint r_width, r_height, r_stride;
+	gint words;
+	gint x, y;
+
+	cairo_surface_flush(surface);
+
+	width = cairo_image_surface_get_width(surface);
+	height = cairo_image_surface_get_height(surface);
+	stride = cairo_image_surface_get_stride(surface);
+	pixels = (guint32*) cairo_image_surface_get_data(surface);
+
+	r_width = (width + 1) / 2;
+	r_height = (height + 1) / 2;
+	result = cairo_image_surface_create(CAIRO_FORMAT_A1, r_width, r_height);
+	cairo_surface_flush(result);
+	r_stride = cairo_image_surface_get_stride(result);
+	r_pixels = (guint32*) cairo_image_surface_get_data(result);
+
+	/* The padding bits at the end of a row are not necessarily white. */
+	words = (width + 31) / 32;
+#if G_BYTE_ORDER == G_BIG_ENDIAN
+	last_mask = 0xffffffff << (-width & 0x1f);
+#else
+	last_mask = 0xffffffff >> (-width & 0x1f);
+#endif
+
+	for (y = 0; y < r_height; y++) {
+		guint32 *row1 = pixels + 2 * y * (stride / 4);
+		guint32 *row2 = (2 * y + 1 < height) ? row1 + stride / 4 : row1;
+		guint32 *r_row = r_pixels + y * (r_stride / 4);
+
+		for (x = 0; x < (r_width + 31) / 32; x++) {
+			guint32 first = 0, second = 0;
+
+			if (2 * x < words) {
+				first = row1[2 * x] | row2[2 * x];
+				if (2 * x == words - 1)
+					first &= last_mask;
+			}
+			if (2 * x + 1 < words) {
+				second = row1[2 * x + 1] | row2[2 * x + 1];
+				if (2 * x + 1 == words - 1)
+					second &= last_mask;
+			}
+
+			r_row[x] = REDUCE_JOIN(REDUCE_WORD(first), REDUCE_WORD(second));
+		}
+	}
+
+	cairo_surface_mark_dirty(result);
+
+	return result;
+}
+
+cairo_surface_t*
+surface_get_reduced(cairo_surface_t *surface, gint level)
+{
+	Pyramid *pyramid;
+	gint i;
+
+	g_assert(cairo_image_surface_get_format(surface) == CAIRO_FORMAT_A1);
+	g_assert(level >= 1 && level <= SURFACE_PYRAMID_LEVELS);
+
+	pyramid = cairo_surface_get_user_data(surface, &pyramid_key);
+	if (pyramid == NULL) {
+		pyramid = g_new0(Pyramid, 1);
+		cairo_surface_set_user_data(surface, &pyramid_key, pyramid, pyramid_free);
+	}
+
+	for (i = 0; i < level; i++) {
+		if (pyramid->levels[i] == NULL)
+			pyramid->levels[i] = surface_reduce(i == 0 ? surface : pyramid->levels[i - 1]);
+	}
+
+	return pyramid->levels[level - 1];
+}
+
+void
+surface_clear_pyramid(cairo_surface_t *surface)
+{
+	cairo_surface_set_user_data(surface, &pyramid_key, NULL, NULL);
+}
+
 gint
 count_black_pixel(cairo_surface_t *surface, gint x, gint y, gint width, gint height)
 {
@@ -200,39 +605,44 @@ count_black_pixel(cairo_surface_t *surface, gint x, gint y, gint width, gint hei
 	return count_black_pixel_unchecked(pixels, stride, x, y, width, height);
 }
 
-gint
+COUNT_TARGET_CLONES gint
 count_black_pixel_unchecked(guint32* pixels, guint32 stride, gint x, gint y, gint width, gint height)
 {
+	guint32 start_mask;
+	guint32 end_mask;
+	gint start;
+	gint end;
 	gint y_pos;
+	gint pos;
 	guint black_pixel = 0;
 
-	for (y_pos = y; y_pos < y + height; y_pos++) {
-
-		guint32 start_mask;
-		guint32 end_mask;
-		int start;
-		int end;
-		int pos;
-
 #if G_BYTE_ORDER == G_BIG_ENDIAN
-		start_mask = 0xffffffff >> (x & 0x1f);
-		end_mask = (0xffffffff << (-(x + width) & 0x1f));
+	start_mask = 0xffffffff >> (x & 0x1f);
+	end_mask = (0xffffffff << (-(x + width) & 0x1f));
 #else
-		start_mask = 0xffffffff << (x & 0x1f);
-		end_mask = (0xffffffff >> (-(x + width) & 0x1f));
+	start_mask = 0xffffffff << (x & 0x1f);
+	end_mask = (0xffffffff >> (-(x + width) & 0x1f));
 #endif
-		start = x >> 5;
-		end = (x + width - 1) >> 5;
+	start = x >> 5;
+	end = (x + width - 1) >> 5;
+
+	for (y_pos = y; y_pos < y + height; y_pos++) {
+		guint32 *row = pixels + y_pos * (stride / 4);
 
 		if (start == end) {
-			black_pixel += WORD_COUNT_BITS(pixels[start + y_pos * stride / 4] & start_mask & end_mask);
-		} else {
-			black_pixel += WORD_COUNT_BITS(pixels[start + y_pos * stride / 4] & start_mask);
-			for (pos = start + 1; pos < end; pos++) {
-				black_pixel += WORD_COUNT_BITS(pixels[pos + y_pos * stride / 4]);
-			}
-			black_pixel += WORD_COUNT_BITS(pixels[end + y_pos * stride / 4] & end_mask);
+			black_pixel += WORD_COUNT_BITS(row[start] & start_mask & end_mask);
+			continue;
 		}
+
+		black_pixel += WORD_COUNT_BITS(row[start] & start_mask);
+
+		/* Full words, two at a time */
+		for (pos = start + 1; pos + 1 < end; pos += 2)
+			black_pixel += WORD64_COUNT_BITS(JOIN_WORDS(row[pos], row[pos + 1]));
+		if (pos < end)
+			black_pixel += WORD_COUNT_BITS(row[pos]);
+
+		black_pixel += WORD_COUNT_BITS(row[end] & end_mask);
 	}
 
 	return black_pixel;
@@ -277,38 +687,65 @@ count_black_pixel_masked(cairo_surface_t *surface, cairo_surface_t *mask, gint x
 	return count_black_pixel_masked_unchecked(pixels, stride, mask_pixels, mask_stride, x, y, width, height);
 }
 
-gint
+COUNT_TARGET_CLONES gint
 count_black_pixel_masked_unchecked(guint32* pixels, guint32 stride, guint32 *mask_pixels, guint32 mask_stride, gint x, gint y, gint width, gint height)
 {
+	guint32 end_mask;
+	guint32 curr_pixels;
+	guint64 curr_pixels64;
+	gint shift;
+	gint words;
+	gint last_word;
 	gint y_pos;
+	gint pos;
 	guint black_pixel = 0;
 
-	for (y_pos = 0; y_pos < height; y_pos++) {
-		guint32 end_mask;
-		guint32 curr_pixels;
-		int end;
-		int pos;
+#if G_BYTE_ORDER == G_BIG_ENDIAN
+	end_mask = (0xffffffff << (-width & 0x1f));
+#else
+	end_mask = (0xffffffff >> (-width & 0x1f));
+#endif
+	/* Words of the mask, and the last word of the image that is needed */
+	words = (width + 31) >> 5;
+	shift = x & 0x1f;
+	last_word = (shift + width - 1) >> 5;
 
+	for (y_pos = 0; y_pos < height; y_pos++) {
+		guint32 *row = pixels + (y_pos + y) * (stride / 4) + (x >> 5);
+		guint32 *mask_row = mask_pixels + y_pos * (mask_stride / 4);
+
+		/* Two words at a time, except for the last word of the mask. This
+		 * reads at most up to the last image word of the area. */
+		for (pos = 0; pos + 2 < words; pos += 2) {
+			curr_pixels64 = JOIN_WORDS(row[pos], row[pos + 1]);
+			if (shift) {
 #if G_BYTE_ORDER == G_BIG_ENDIAN
-		end_mask = (0xffffffff << (-width & 0x1f));
+				curr_pixels64 = (curr_pixels64 << shift) | ((guint64) row[pos + 2] >> (32 - shift));
 #else
-		end_mask = (0xffffffff >> (-width & 0x1f));
+				curr_pixels64 = (curr_pixels64 >> shift) | ((guint64) row[pos + 2] << (64 - shift));
 #endif
-		end = (width - 1) >> 5;
+			}
 
-		for (pos = 0; pos <= end; pos++) {
-			/* Note that a shift of 32 is not defined, it may also be 0. */
+			black_pixel += WORD64_COUNT_BITS(curr_pixels64 & JOIN_WORDS(mask_row[pos], mask_row[pos + 1]));
+		}
+
+		for (; pos < words; pos++) {
+			curr_pixels = row[pos];
+			if (shift) {
 #if G_BYTE_ORDER == G_BIG_ENDIAN
-			curr_pixels = pixels[(x / 32) + pos + (y_pos + y) * stride / 4] << (x % 32);
-			curr_pixels |= pixels[((x + 31) / 32) + pos + (y_pos + y) * stride / 4] >> (32 - (x % 32));
+				curr_pixels <<= shift;
+				if (pos + 1 <= last_word)
+					curr_pixels |= row[pos + 1] >> (32 - shift);
 #else
-			curr_pixels = pixels[(x / 32) + pos + (y_pos + y) * stride / 4] >> (x % 32);
-			curr_pixels |= pixels[((x + 31) / 32) + pos + (y_pos + y) * stride / 4] << (32 - (x % 32));
+				curr_pixels >>= shift;
+				if (pos + 1 <= last_word)
+					curr_pixels |= row[pos + 1] << (32 - shift);
 #endif
+			}
 
-			curr_pixels &= mask_pixels[pos + y_pos * mask_stride / 4];
+			curr_pixels &= mask_row[pos];
 
-			if (pos == end)
+			if (pos == words - 1)
 				curr_pixels &= end_mask;
 
 			black_pixel += WORD_COUNT_BITS(curr_pixels);
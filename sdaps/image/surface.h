@@ -50,9 +50,45 @@ surface_copy_masked(cairo_surface_t *surface, cairo_surface_t *mask, gint x, gin
 cairo_surface_t*
 surface_inverted_copy_masked(cairo_surface_t *surface, cairo_surface_t *mask, gint x, gint y);
 
+void
+surface_rotate_180(cairo_surface_t *surface);
+
+/* Summed-area table of the black pixels in a rectangular area of an A1
+ * surface, for counting the pixels of many overlapping areas. */
+typedef struct {
+	gint x;
+	gint y;
+	gint width;
+	gint height;
+	guint32 *sums;
+} IntegralImage;
+
+IntegralImage*
+integral_image_new(cairo_surface_t *surface, gint x, gint y, gint width, gint height);
+
+void
+integral_image_free(IntegralImage *integral);
+
+gint
+integral_image_count_black_pixel(IntegralImage *integral, cairo_surface_t *surface, gint x, gint y, gint width, gint height);
+
+/* Level n is scaled down by 2^n, pixels are black if any of the covered
+ * pixels is black. The returned surface is owned by the passed one and stays
+ * valid until the surface is modified. */
+#define SURFACE_PYRAMID_LEVELS 3
+
+cairo_surface_t*
+surface_get_reduced(cairo_surface_t *surface, gint level);
+
+void
+surface_clear_pyramid(cairo_surface_t *surface);
+
 void
 get_pbm(cairo_surface_t *surface, void **data, gssize *length);
 
+void
+get_y800(cairo_surface_t *surface, void **data, gssize *length);
+
 #if 0
 void
 a1_surface_write_to_png(cairo_surface_t* surface, gchar* filename);
@@ -121,6 +121,9 @@ kfill_modified(cairo_surface_t* surface, gint k)
 	cairo_surface_t *tmp_surface;
 	tmp_surface = surface_copy(surface);
 
+	/* The surface is modified in place. */
+	surface_clear_pyramid(surface);
+
 	img_width = cairo_image_surface_get_width(surface);
 	img_height = cairo_image_surface_get_height(surface);
 
@@ -154,27 +157,58 @@ kfill_modified(cairo_surface_t* surface, gint k)
 }
 
 static void
-mark_pixel(cairo_surface_t *debug_surf, gint x, gint y)
+mark_span(cairo_surface_t *debug_surf, gint x, gint y, gint length)
 {
 	cairo_t *cr;
 
 	cr = cairo_create(debug_surf);
 	cairo_set_source_rgba(cr, 1, 0, 0, 0.5);
-	cairo_rectangle(cr, x-0.5, y-0.5, 1, 1);
+	cairo_rectangle(cr, x-0.5, y-0.5, length, 1);
 	cairo_fill(cr);
 	cairo_destroy(cr);
 }
 
-/* XXX: This needs rather a lot of stack space ...
- * TODO: Rewrite in a saner and faster way.
- * Returns the size of the filled area. */
-guint
-flood_fill(cairo_surface_t *surface, cairo_surface_t *debug_surf, gint x, gint y, guint orig_color)
+typedef struct {
+	gint x;
+	gint y;
+} FloodFillSeed;
+
+/* Pushes one seed for every run of orig_color in row y between left and
+ * right (inclusive). */
+static void
+flood_fill_push_runs(GArray *stack, guint32 *pixels, guint stride, gint left, gint right, gint y, guint orig_color)
+{
+	FloodFillSeed seed;
+	gboolean in_run = FALSE;
+	gint x;
+
+	seed.y = y;
+	for (x = left; x <= right; x++) {
+		if (GET_PIXEL(pixels, stride, x, y) == orig_color) {
+			if (!in_run) {
+				seed.x = x;
+				g_array_append_val(stack, seed);
+				in_run = TRUE;
+			}
+		} else {
+			in_run = FALSE;
+		}
+	}
+}
+
+/* Scanline flood fill (4-connected) using an explicit stack. Every popped
+ * seed is extended to a whole run in its row which is then flipped at once,
+ * and the runs touching it in the rows above and below are pushed.
+ * The stack is only used as scratch space and is empty again on return. */
+static guint
+flood_fill_spans(cairo_surface_t *surface, cairo_surface_t *debug_surf, GArray *stack, gint x, gint y, guint orig_color)
 {
 	gint img_width, img_height;
 	guint stride;
 	guint32 *pixels;
-	guint result;
+	FloodFillSeed seed;
+	gint left, right;
+	guint result = 0;
 
 	img_width = cairo_image_surface_get_width(surface);
 	img_height = cairo_image_surface_get_height(surface);
@@ -182,42 +216,128 @@ flood_fill(cairo_surface_t *surface, cairo_surface_t *debug_surf, gint x, gint y
 	pixels = (guint32*) cairo_image_surface_get_data(surface);
 	stride = cairo_image_surface_get_stride(surface);
 
-	if (x < 0)
-		return 0;
-	if (y < 0)
-		return 0;
-
-	if (x >= img_width)
-		return 0;
-	if (y >= img_height)
+	if (x < 0 || y < 0 || x >= img_width || y >= img_height)
 		return 0;
 
 	if (GET_PIXEL(pixels, stride, x, y) != orig_color)
 		return 0;
 
-	/* Swap pixel value. */
-	SET_PIXEL(pixels, stride, x, y, !orig_color);
+	seed.x = x;
+	seed.y = y;
+	g_array_append_val(stack, seed);
 
-	result = 1;
+	while (stack->len > 0) {
+		seed = g_array_index(stack, FloodFillSeed, stack->len - 1);
+		g_array_set_size(stack, stack->len - 1);
 
-	result += flood_fill(surface, debug_surf, x+1, y, orig_color);
-	result += flood_fill(surface, debug_surf, x, y+1, orig_color);
-	result += flood_fill(surface, debug_surf, x-1, y, orig_color);
-	result += flood_fill(surface, debug_surf, x, y-1, orig_color);
+		/* Already filled through another run. */
+		if (GET_PIXEL(pixels, stride, seed.x, seed.y) != orig_color)
+			continue;
 
-	if (debug_surf != NULL)
-		mark_pixel(debug_surf, x, y);
+		left = seed.x;
+		while (left > 0 && GET_PIXEL(pixels, stride, left - 1, seed.y) == orig_color)
+			left--;
+		right = seed.x;
+		while (right < img_width - 1 && GET_PIXEL(pixels, stride, right + 1, seed.y) == orig_color)
+			right++;
+
+		for (x = left; x <= right; x++)
+			SET_PIXEL(pixels, stride, x, seed.y, !orig_color);
+		result += right - left + 1;
+
+		if (debug_surf != NULL)
+			mark_span(debug_surf, left, seed.y, right - left + 1);
+
+		if (seed.y > 0)
+			flood_fill_push_runs(stack, pixels, stride, left, right, seed.y - 1, orig_color);
+		if (seed.y < img_height - 1)
+			flood_fill_push_runs(stack, pixels, stride, left, right, seed.y + 1, orig_color);
+	}
 
 	return result;
 }
 
+/* Returns the size of the filled area. The pixels are only marked on the
+ * debug surface if one is given. */
+guint
+flood_fill(cairo_surface_t *surface, cairo_surface_t *debug_surf, gint x, gint y, guint orig_color)
+{
+	GArray *stack;
+	guint result;
+
+	stack = g_array_sized_new(FALSE, FALSE, sizeof(FloodFillSeed), 64);
+	result = flood_fill_spans(surface, debug_surf, stack, x, y, orig_color);
+	g_array_free(stack, TRUE);
+
+	return result;
+}
+
+/* Fills every area of orig_color on the surface and returns a GArray of
+ * FloodFillArea in scan order (top to bottom, left to right) with the
+ * first pixel of each area and its size. The caller frees the array. */
+GArray*
+flood_fill_all(cairo_surface_t *surface, guint orig_color)
+{
+	gint img_width, img_height;
+	guint stride;
+	guint32 *pixels;
+	GArray *stack;
+	GArray *areas;
+	FloodFillArea area;
+	gint x, y;
+
+	img_width = cairo_image_surface_get_width(surface);
+	img_height = cairo_image_surface_get_height(surface);
+
+	pixels = (guint32*) cairo_image_surface_get_data(surface);
+	stride = cairo_image_surface_get_stride(surface);
+
+	stack = g_array_sized_new(FALSE, FALSE, sizeof(FloodFillSeed), 64);
+	areas = g_array_new(FALSE, FALSE, sizeof(FloodFillArea));
+
+	for (y = 0; y < img_height; y++) {
+		for (x = 0; x < img_width; x++) {
+			if (GET_PIXEL(pixels, stride, x, y) != orig_color)
+				continue;
+
+			area.x = x;
+			area.y = y;
+			area.size = flood_fill_spans(surface, NULL, stack, x, y, orig_color);
+			g_array_append_val(areas, area);
+		}
+	}
+
+	g_array_free(stack, TRUE);
+
+	return areas;
+}
+
 
 /*************************************************
  * Hough transformation!
  *************************************************/
 
+/* The lookup tables only depend on the number of bins and the filter width,
+ * and are the same for (nearly) every checkbox. They are kept in a small
+ * cache and never freed once cached, so they can be shared between threads
+ * without any reference counting. */
+#define HOUGH_TABLE_CACHE_SIZE 32
+
+typedef struct {
+	guint angle_bins;
+	guint distance_bins;
+	gdouble sigma;
+
+	gdouble *cos_table;
+	gdouble *sin_table;
+
+	guint filter_length;
+	guint *filter;
+} hough_tables;
+
 typedef struct {
 	guint32 *data;
+	guint data_size;
 	guint angle_bins;
 	guint distance_bins;
 
@@ -225,8 +345,34 @@ typedef struct {
 
 	gdouble *cos_table;
 	gdouble *sin_table;
+
+	hough_tables *tables;
+	gboolean tables_cached;
 } hough_data;
 
+/* Protects the table cache, the cached tables themselves are read only. */
+static GMutex hough_tables_lock;
+static hough_tables *hough_tables_cache[HOUGH_TABLE_CACHE_SIZE];
+static guint hough_tables_cache_len = 0;
+
+/* One accumulator per thread that is handed out to the next transform once
+ * the previous one has been freed. */
+typedef struct {
+	guint32 *data;
+	guint size;
+} hough_accumulator;
+
+static void
+hough_accumulator_free(gpointer data)
+{
+	hough_accumulator *acc = data;
+
+	g_free(acc->data);
+	g_free(acc);
+}
+
+static GPrivate hough_accumulator_pool = G_PRIVATE_INIT(hough_accumulator_free);
+
 /* Adds a point to the hough transformation. A (gaussion) filter is applied
  * at the same time.
  * I guess this is slightly less efficient than filtering it later, but it
@@ -257,19 +403,19 @@ hough_add_point(hough_data *hough, guint x, guint y, guint filter_width, guint *
 }
 
 static void
-hough_create_lut(hough_data *hough)
+hough_create_lut(hough_tables *tables)
 {
 	guint angle_step;
 	gdouble angle;
 
-	hough->cos_table = g_new(gdouble, hough->angle_bins);
-	hough->sin_table = g_new(gdouble, hough->angle_bins);
+	tables->cos_table = g_new(gdouble, tables->angle_bins);
+	tables->sin_table = g_new(gdouble, tables->angle_bins);
 
-	for (angle_step = 0; angle_step < hough->angle_bins; angle_step++) {
-		angle = (2*G_PI * angle_step) / hough->angle_bins;
+	for (angle_step = 0; angle_step < tables->angle_bins; angle_step++) {
+		angle = (2*G_PI * angle_step) / tables->angle_bins;
 
-		hough->cos_table[angle_step] = cos(angle);
-		hough->sin_table[angle_step] = sin(angle);
+		tables->cos_table[angle_step] = cos(angle);
+		tables->sin_table[angle_step] = sin(angle);
 	}
 }
 
@@ -298,6 +444,59 @@ get_gaussion(gdouble sigma, guint **filter_coff)
 	return filt_length;
 }
 
+static void
+hough_tables_free(hough_tables *tables)
+{
+	g_free(tables->cos_table);
+	g_free(tables->sin_table);
+	g_free(tables->filter);
+	g_free(tables);
+}
+
+/* Returns the tables for the given parameters. *cached* is set to FALSE if
+ * the cache is full, the caller owns the tables in that case. */
+static hough_tables*
+hough_tables_get(guint angle_bins, guint distance_bins, gdouble sigma, gboolean *cached)
+{
+	hough_tables *tables;
+	guint i;
+
+	g_mutex_lock(&hough_tables_lock);
+	for (i = 0; i < hough_tables_cache_len; i++) {
+		tables = hough_tables_cache[i];
+
+		if (tables->angle_bins == angle_bins &&
+		    tables->distance_bins == distance_bins &&
+		    tables->sigma == sigma) {
+			g_mutex_unlock(&hough_tables_lock);
+			*cached = TRUE;
+			return tables;
+		}
+	}
+	g_mutex_unlock(&hough_tables_lock);
+
+	tables = g_new(hough_tables, 1);
+	tables->angle_bins = angle_bins;
+	tables->distance_bins = distance_bins;
+	tables->sigma = sigma;
+	hough_create_lut(tables);
+	tables->filter_length = get_gaussion(sigma, &tables->filter);
+
+	/* Another thread may have added the same tables in the meantime, that
+	 * only wastes a cache slot though. */
+	g_mutex_lock(&hough_tables_lock);
+	if (hough_tables_cache_len < HOUGH_TABLE_CACHE_SIZE) {
+		hough_tables_cache[hough_tables_cache_len] = tables;
+		hough_tables_cache_len++;
+		*cached = TRUE;
+	} else {
+		*cached = FALSE;
+	}
+	g_mutex_unlock(&hough_tables_lock);
+
+	return tables;
+}
+
 /* Hough transforms the image.
  *
  * */
@@ -308,12 +507,9 @@ hough_transform(cairo_surface_t *surface, guint angle_bins, guint distance_bins,
 	guint stride;
 	guint x, y;
 	guint32 *pixels;
-	guint filter_length;
-	guint *filter;
+	guint size;
+	hough_accumulator *acc;
 	hough_data *result = g_malloc(sizeof(hough_data));
-	result->data = NULL;
-	result->cos_table = NULL;
-	result->sin_table = NULL;
 
 	img_width = cairo_image_surface_get_width(surface);
 	img_height = cairo_image_surface_get_height(surface);
@@ -322,32 +518,60 @@ hough_transform(cairo_surface_t *surface, guint angle_bins, guint distance_bins,
 	result->distance_bins = distance_bins;
 	result->max_distance = (guint) sqrt(img_width*img_width + img_height*img_height);
 
-	result->data = g_malloc0(sizeof(*result->data) * result->angle_bins*result->distance_bins);
-	hough_create_lut(result);
+	result->tables = hough_tables_get(angle_bins, distance_bins,
+	                                  sigma_px * result->distance_bins / result->max_distance,
+	                                  &result->tables_cached);
+	result->cos_table = result->tables->cos_table;
+	result->sin_table = result->tables->sin_table;
+
+	/* Take the accumulator of this thread if it is not in use. */
+	size = result->angle_bins*result->distance_bins;
+	acc = g_private_get(&hough_accumulator_pool);
+	if (acc != NULL && acc->data != NULL && acc->size >= size) {
+		result->data = acc->data;
+		result->data_size = acc->size;
+		acc->data = NULL;
+		acc->size = 0;
+		memset(result->data, 0, sizeof(*result->data) * size);
+	} else {
+		result->data = g_malloc0(sizeof(*result->data) * size);
+		result->data_size = size;
+	}
 
 	pixels = (guint32*) cairo_image_surface_get_data(surface);
 	stride = cairo_image_surface_get_stride(surface);
 
-	filter_length = get_gaussion(sigma_px * result->distance_bins / result->max_distance, &filter);
-
 	for (y = 0; y < img_height; y++) {
 		for (x = 0; x < img_width; x++) {
 			if (GET_PIXEL(pixels, stride, x, y))
-				hough_add_point(result, x, y, filter_length, filter);
+				hough_add_point(result, x, y, result->tables->filter_length, result->tables->filter);
 		}
 	}
 
-	g_free(filter);
-
 	return result;
 }
 
 void
 hough_data_free(hough_data *data)
 {
-	g_free(data->data);
-	g_free(data->cos_table);
-	g_free(data->sin_table);
+	hough_accumulator *acc;
+
+	/* Hand the accumulator back to the thread, keeping the larger one. */
+	acc = g_private_get(&hough_accumulator_pool);
+	if (acc == NULL) {
+		acc = g_new0(hough_accumulator, 1);
+		g_private_set(&hough_accumulator_pool, acc);
+	}
+	if (acc->size < data->data_size) {
+		g_free(acc->data);
+		acc->data = data->data;
+		acc->size = data->data_size;
+	} else {
+		g_free(data->data);
+	}
+
+	if (!data->tables_cached)
+		hough_tables_free(data->tables);
 	g_free(data);
 }
 
@@ -488,6 +712,9 @@ thinzs_np(cairo_surface_t *surface)
 	cairo_surface_t *tmp_surface;
 	tmp_surface = surface_copy(surface);
 
+	/* The surface is modified in place. */
+	surface_clear_pyramid(surface);
+
 	img_width = cairo_image_surface_get_width(surface);
 	img_height = cairo_image_surface_get_height(surface);
 
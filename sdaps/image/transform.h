@@ -27,9 +27,18 @@ thinzs_np(cairo_surface_t *surface);
 void
 kfill_modified(cairo_surface_t* surface, gint k);
 
+typedef struct {
+	gint x;
+	gint y;
+	guint size;
+} FloodFillArea;
+
 guint
 flood_fill(cairo_surface_t *surface, cairo_surface_t *debug_surf, gint x, gint y, guint orig_color);
 
+GArray*
+flood_fill_all(cairo_surface_t *surface, guint orig_color);
+
 void
 remove_maximum_line(cairo_surface_t *surface, cairo_surface_t *debug_surf, gdouble width);
 
@@ -30,40 +30,67 @@ static PyObject *wrap_get_a1_from_tiff(PyObject *self, PyObject *args);
 static PyObject *wrap_write_a1_to_tiff(PyObject *self, PyObject *args);
 static PyObject *wrap_get_rgb24_from_tiff(PyObject *self, PyObject *args);
 static PyObject *wrap_find_corner_marker(PyObject *self, PyObject *args);
+static PyObject *wrap_find_corner_marker_near(PyObject *self, PyObject *args);
 static PyObject *wrap_calculate_correction_matrix_masked(PyObject *self, PyObject *args);
 static PyObject *wrap_find_box_corners(PyObject *self, PyObject *args);
 static PyObject *wrap_get_coverage(PyObject *self, PyObject *args);
+static PyObject *wrap_find_textbox_writing(PyObject *self, PyObject *args);
 static PyObject *wrap_get_masked_coverage(PyObject *self, PyObject *args);
 static PyObject *wrap_get_masked_coverage_without_lines(PyObject *self, PyObject *args);
 static PyObject *wrap_get_masked_white_area_count(PyObject *self, PyObject *args);
+static PyObject *wrap_get_checkbox_metrics(PyObject *self, PyObject *args);
 static PyObject *wrap_get_pbm(PyObject *self, PyObject *args);
+static PyObject *wrap_get_y800(PyObject *self, PyObject *args);
 static PyObject *sdaps_set_magic_values(PyObject *self, PyObject *args);
 static PyObject *enable_debug_surface_creation(PyObject *self, PyObject *args);
 static PyObject *get_debug_surface(PyObject *self, PyObject *args);
 static PyObject *wrap_get_tiff_page_count(PyObject *self, PyObject *args);
+static PyObject *wrap_get_tiff_size(PyObject *self, PyObject *args);
+static PyObject *wrap_get_tiff_page_checksum(PyObject *self, PyObject *args);
 static PyObject *wrap_get_tiff_resolution(PyObject *self, PyObject *args);
 static PyObject *wrap_check_tiff_monochrome(PyObject *self, PyObject *args);
+static PyObject *wrap_clear_tiff_cache(PyObject *self, PyObject *args);
 static PyObject *wrap_kfill_modified(PyObject *self, PyObject *args);
+static PyObject *wrap_rotate_180(PyObject *self, PyObject *args);
+
+/* The debug surface is global state, so the GIL is kept while it may be
+ * created. Otherwise it is released around the pure C code. */
+#define SDAPS_BEGIN_ALLOW_THREADS { \
+	PyThreadState *_save = NULL; \
+	if (!sdaps_create_debug_surface) \
+		_save = PyEval_SaveThread();
+#define SDAPS_END_ALLOW_THREADS \
+	if (_save) \
+		PyEval_RestoreThread(_save); \
+}
 
 static PyMethodDef image_methods[] = {
-	{"get_a1_from_tiff",  wrap_get_a1_from_tiff, METH_VARARGS, "Creates a cairo A1 surface from a monochrome tiff file."},
+	{"get_a1_from_tiff",  wrap_get_a1_from_tiff, METH_VARARGS, "Creates a cairo A1 surface from a monochrome tiff file. If a sequence of (first, last) row ranges is passed, only the strips containing these rows are decoded and everything else is left white."},
 	{"write_a1_to_tiff",  wrap_write_a1_to_tiff, METH_VARARGS, "Appends a new page to an existing tiff file or create a new tiff file containing the pixel data from the surface."},
 	{"get_rgb24_from_tiff",  wrap_get_rgb24_from_tiff, METH_VARARGS, "Creates a cairo RGB24 surface from a (monochrome) tiff file."},
 	{"get_tiff_page_count",  wrap_get_tiff_page_count, METH_VARARGS, "Returns the number of pages a multipage tiff contains."},
+	{"get_tiff_size", wrap_get_tiff_size, METH_VARARGS, "Retrieves the size in pixel of the given page of the tiff file without decoding it."},
+	{"get_tiff_page_checksum", wrap_get_tiff_page_checksum, METH_VARARGS, "Returns a checksum of the raw image data of the given page of the tiff file as a hex string, without decoding it."},
 	{"get_tiff_resolution", wrap_get_tiff_resolution, METH_VARARGS, "Retrieves the resolution from the given page of the tiff file (in dots per mm)."},
 	{"check_tiff_monochrome",  wrap_check_tiff_monochrome, METH_VARARGS, "Check whether all pages of the tiff are monochrome."},
+	{"clear_tiff_cache",  wrap_clear_tiff_cache, METH_VARARGS, "Closes all tiff files that are kept open for fast page access."},
 	{"find_corner_marker",  wrap_find_corner_marker, METH_VARARGS, "Searches for a corner marker. The third parameter should be an integer specifying the corner (1: top left, 2: top right, 3: bottom right, 4: bottom left."},
+	{"find_corner_marker_near",  wrap_find_corner_marker_near, METH_VARARGS, "Searches for a corner marker close to the given position (in pixel). Markers further away than the given distance (in mm) are not found."},
 	{"calculate_correction_matrix_masked",  wrap_calculate_correction_matrix_masked, METH_VARARGS, "Calculates a corrected transformation matrix for the mask at the given the top left corner."},
 	{"find_box_corners",  wrap_find_box_corners, METH_VARARGS, "Tries to find the actuall corners of a box in the milimeter space."},
 	{"get_coverage",  wrap_get_coverage, METH_VARARGS, "Calculates the black coverage in the given area."},
+	{"find_textbox_writing",  wrap_find_textbox_writing, METH_VARARGS, "Scans the quadrilateral given by its four corners for writing using small windows. Returns the bounding box of all windows with a higher coverage than requested, or None. The last argument enables counting the pixels using a summed-area table."},
 	{"get_masked_coverage",  wrap_get_masked_coverage, METH_VARARGS, "Calculates the black coverage in the given mask."},
 	{"get_masked_coverage_without_lines",  wrap_get_masked_coverage_without_lines, METH_VARARGS, "First removes the number of requested lines with the specified stroke width using a hough transformation. Then calculates the coverage. Works on the masked area."},
 	{"get_masked_white_area_count",  wrap_get_masked_white_area_count, METH_VARARGS, "Returns the number and overall size of white areas that are larger than the given percentage of the overall size. Works on the masked area."},
+	{"get_checkbox_metrics",  wrap_get_checkbox_metrics, METH_VARARGS, "Calculates the position correction and metrics of all the given checkboxes. Each box is a tuple (outline_mask, xoff, yoff, inner_mask, xoff, yoff, x, y), the result is a list of tuples (x, y, covered, coverage, coverage_without_lines, white_area_coverage). The optional final ranges are (lower, upper) coverage ranges in which the last two metrics are skipped and None."},
 	{"get_pbm",  wrap_get_pbm, METH_VARARGS, "Returns a byte string that contains a binary PBM data representation of the cairo A1 surface."},
+	{"get_y800",  wrap_get_y800, METH_VARARGS, "Returns a byte string that contains the cairo A1 surface as 8 bit grayscale (Y800) data with one byte per pixel."},
 	{"set_magic_values",  sdaps_set_magic_values, METH_VARARGS, "Sets some magic values for recognition."},
 	{"enable_debug_surface_creation",  enable_debug_surface_creation, METH_VARARGS, "Sets whether debug images should be created."},
 	{"get_debug_surface",  get_debug_surface, METH_VARARGS, "Returns the last created debug surface. Call immediately after a function that may create such a surface."},
 	{"kfill_modified",  wrap_kfill_modified, METH_VARARGS, "Run the modified KFill algorithm over the given A1 surface."},
+	{"rotate_180",  wrap_rotate_180, METH_VARARGS, "Rotates the given A1 surface by 180 degree in place."},
 	{NULL, NULL, 0, NULL} /* Sentinel */
 };
 
@@ -103,13 +130,39 @@ wrap_get_a1_from_tiff(PyObject *self, PyObject *args)
 {
 	cairo_surface_t *surface;
 	const char *filename = NULL;
+	PyObject *py_rows = NULL;
+	gint *row_ranges = NULL;
+	Py_ssize_t range_count = 0, i;
 	gboolean rotated;
 	gint page;
 
-	if (!PyArg_ParseTuple(args, "sii", &filename, &page, &rotated))
+	if (!PyArg_ParseTuple(args, "sii|O", &filename, &page, &rotated, &py_rows))
 		return NULL;
 
-	surface = get_a1_from_tiff(filename, page, rotated);
+	if (py_rows != NULL && py_rows != Py_None) {
+		py_rows = PySequence_Fast(py_rows, "The rows need to be a sequence of tuples.");
+		if (py_rows == NULL)
+			return NULL;
+
+		range_count = PySequence_Fast_GET_SIZE(py_rows);
+		row_ranges = g_new(gint, 2 * range_count + 1);
+
+		for (i = 0; i < range_count; i++) {
+			if (!PyArg_ParseTuple(PySequence_Fast_GET_ITEM(py_rows, i), "ii",
+			                      &row_ranges[2 * i], &row_ranges[2 * i + 1])) {
+				g_free(row_ranges);
+				Py_DECREF(py_rows);
+				return NULL;
+			}
+		}
+		Py_DECREF(py_rows);
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	surface = get_a1_from_tiff_partial(filename, page, rotated, row_ranges, range_count);
+	Py_END_ALLOW_THREADS
+
+	g_free(row_ranges);
 
 	if (surface) {
 		return PycairoSurface_FromSurface(surface, NULL);
@@ -124,12 +177,17 @@ wrap_write_a1_to_tiff(PyObject *self, PyObject *args)
 {
 	PycairoSurface *py_surface;
 	const char *filename = NULL;
+	gboolean success;
 
 	if (!PyArg_ParseTuple(args, "sO!", &filename,
 	                                   &PycairoImageSurface_Type, &py_surface))
 		return NULL;
 
-	if (!write_a1_to_tiff(filename, py_surface->surface)) {
+	Py_BEGIN_ALLOW_THREADS
+	success = write_a1_to_tiff(filename, py_surface->surface);
+	Py_END_ALLOW_THREADS
+
+	if (!success) {
 		PyErr_SetString(PyExc_AssertionError, "Error writing new page to TIFF file (append/create)!");
 		return NULL;
 	}
@@ -149,7 +207,9 @@ wrap_get_rgb24_from_tiff(PyObject *self, PyObject *args)
 	if (!PyArg_ParseTuple(args, "sii", &filename, &page, &rotated))
 		return NULL;
 
+	Py_BEGIN_ALLOW_THREADS
 	surface = get_rgb24_from_tiff(filename, page, rotated);
+	Py_END_ALLOW_THREADS
 
 	if (surface) {
 		return PycairoSurface_FromSurface(surface, NULL);
@@ -168,7 +228,9 @@ wrap_get_tiff_page_count(PyObject *self, PyObject *args)
 	if (!PyArg_ParseTuple(args, "s", &filename))
 		return NULL;
 
+	Py_BEGIN_ALLOW_THREADS
 	pages = get_tiff_page_count(filename);
+	Py_END_ALLOW_THREADS
 
 	if (pages >= 1) {
 		return Py_BuildValue("i", pages);
@@ -178,17 +240,71 @@ wrap_get_tiff_page_count(PyObject *self, PyObject *args)
 	}
 }
 
+static PyObject *
+wrap_get_tiff_size(PyObject *self, PyObject *args)
+{
+	const char *filename = NULL;
+	gint page;
+	gint width, height;
+	gboolean success;
+
+	if (!PyArg_ParseTuple(args, "si", &filename, &page))
+		return NULL;
+
+	Py_BEGIN_ALLOW_THREADS
+	success = get_tiff_size(filename, page, &width, &height);
+	Py_END_ALLOW_THREADS
+
+	if (success) {
+		return Py_BuildValue("ii", width, height);
+	} else {
+		PyErr_SetString(PyExc_AssertionError, "Could not retrieve the size of the tiff file and page.");
+		return NULL;
+	}
+}
+
+static PyObject *
+wrap_get_tiff_page_checksum(PyObject *self, PyObject *args)
+{
+	const char *filename = NULL;
+	gint page;
+	gchar *checksum;
+	PyObject *result;
+
+	if (!PyArg_ParseTuple(args, "si", &filename, &page))
+		return NULL;
+
+	Py_BEGIN_ALLOW_THREADS
+	checksum = get_tiff_page_checksum(filename, page);
+	Py_END_ALLOW_THREADS
+
+	if (checksum == NULL) {
+		PyErr_SetString(PyExc_AssertionError, "Could not read the image data of the tiff file and page.");
+		return NULL;
+	}
+
+	result = Py_BuildValue("s", checksum);
+	g_free(checksum);
+
+	return result;
+}
+
 static PyObject *
 wrap_get_tiff_resolution(PyObject *self, PyObject *args)
 {
 	const char *filename = NULL;
 	gint page;
 	gdouble xresolution, yresolution;
+	gboolean success;
 
 	if (!PyArg_ParseTuple(args, "si", &filename, &page))
 		return NULL;
 
-	if (get_tiff_resolution(filename, page, &xresolution, &yresolution)) {
+	Py_BEGIN_ALLOW_THREADS
+	success = get_tiff_resolution(filename, page, &xresolution, &yresolution);
+	Py_END_ALLOW_THREADS
+
+	if (success) {
 		return Py_BuildValue("dd", xresolution, yresolution);
 	} else {
 		PyErr_SetString(PyExc_AssertionError, "Could not retrieve the resolution for the tiff file and page.");
@@ -205,11 +321,25 @@ wrap_check_tiff_monochrome(PyObject *self, PyObject *args)
 	if (!PyArg_ParseTuple(args, "s", &filename))
 		return NULL;
 
+	Py_BEGIN_ALLOW_THREADS
 	monochrome = check_tiff_monochrome(filename);
+	Py_END_ALLOW_THREADS
 
 	return Py_BuildValue("i", monochrome);
 }
 
+static PyObject *
+wrap_clear_tiff_cache(PyObject *self, PyObject *args)
+{
+	if (!PyArg_ParseTuple(args, ""))
+		return NULL;
+
+	clear_tiff_cache();
+
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
 static PyObject *
 wrap_find_corner_marker(PyObject *self, PyObject *args)
 {
@@ -225,7 +355,40 @@ wrap_find_corner_marker(PyObject *self, PyObject *args)
 	                      &PycairoMatrix_Type, &py_matrix, &corner))
 		return NULL;
 
+	SDAPS_BEGIN_ALLOW_THREADS
 	success = find_corner_marker(py_surface->surface, &py_matrix->matrix, corner, &corner_x, &corner_y);
+	SDAPS_END_ALLOW_THREADS
+
+	if (success) {
+		result = Py_BuildValue("dd", corner_x, corner_y);
+		return result;
+	} else {
+		PyErr_SetString(PyExc_AssertionError, "Could not find corner marker!");
+		return NULL;
+	}
+}
+
+static PyObject *
+wrap_find_corner_marker_near(PyObject *self, PyObject *args)
+{
+	PyObject *result;
+	PycairoSurface *py_surface;
+	PycairoMatrix *py_matrix;
+	gint corner;
+	gdouble x, y;
+	gdouble distance;
+	gdouble corner_x, corner_y;
+	gboolean success;
+
+	if (!PyArg_ParseTuple(args, "O!O!i(dd)d",
+	                      &PycairoImageSurface_Type, &py_surface,
+	                      &PycairoMatrix_Type, &py_matrix, &corner,
+	                      &x, &y, &distance))
+		return NULL;
+
+	SDAPS_BEGIN_ALLOW_THREADS
+	success = find_corner_marker_near(py_surface->surface, &py_matrix->matrix, corner, x, y, distance, &corner_x, &corner_y);
+	SDAPS_END_ALLOW_THREADS
 
 	if (success) {
 		result = Py_BuildValue("dd", corner_x, corner_y);
@@ -254,7 +417,9 @@ wrap_calculate_correction_matrix_masked(PyObject *self, PyObject *args)
 	                      &mm_x, &mm_y))
 		return NULL;
 
+	SDAPS_BEGIN_ALLOW_THREADS
 	correction_matrix = calculate_correction_matrix_masked(py_surface->surface, py_mask->surface, &py_matrix->matrix, mm_x, mm_y, &covered);
+	SDAPS_END_ALLOW_THREADS
 
 	if (correction_matrix) {
 		result = PycairoMatrix_FromMatrix(correction_matrix);
@@ -281,8 +446,10 @@ wrap_find_box_corners(PyObject *self, PyObject *args)
 	                      &mm_x, &mm_y, &mm_width, &mm_height))
 		return NULL;
 
+	SDAPS_BEGIN_ALLOW_THREADS
 	success = find_box_corners(py_surface->surface, &py_matrix->matrix, mm_x, mm_y, mm_width, mm_height,
 	                           &mm_x1, &mm_y1, &mm_x2, &mm_y2, &mm_x3, &mm_y3, &mm_x4, &mm_y4);
+	SDAPS_END_ALLOW_THREADS
 
 	if (success) {
 		return Py_BuildValue("(dd)(dd)(dd)(dd)", mm_x1, mm_y1, mm_x2, mm_y2, mm_x3, mm_y3, mm_x4, mm_y4);
@@ -306,11 +473,48 @@ wrap_get_coverage(PyObject *self, PyObject *args)
 	                      &mm_x, &mm_y, &mm_width, &mm_height))
 		return NULL;
 
+	SDAPS_BEGIN_ALLOW_THREADS
 	coverage = get_coverage(py_surface->surface, &py_matrix->matrix, mm_x, mm_y, mm_width, mm_height);
+	SDAPS_END_ALLOW_THREADS
 
 	return Py_BuildValue("d", coverage);
 }
 
+static PyObject *
+wrap_find_textbox_writing(PyObject *self, PyObject *args)
+{
+	PycairoSurface *py_surface;
+	PycairoMatrix *py_matrix;
+	gdouble corners[4][2];
+	gdouble step_x, step_y, test_width, test_height;
+	gdouble padding, min_coverage;
+	gint use_integral;
+	gdouble bbox[4];
+	gboolean found;
+
+	if (!PyArg_ParseTuple(args, "O!O!((dd)(dd)(dd)(dd))ddddddi",
+	                      &PycairoImageSurface_Type, &py_surface,
+	                      &PycairoMatrix_Type, &py_matrix,
+	                      &corners[0][0], &corners[0][1], &corners[1][0], &corners[1][1],
+	                      &corners[2][0], &corners[2][1], &corners[3][0], &corners[3][1],
+	                      &step_x, &step_y, &test_width, &test_height,
+	                      &padding, &min_coverage, &use_integral))
+		return NULL;
+
+	SDAPS_BEGIN_ALLOW_THREADS
+	found = find_textbox_writing(py_surface->surface, &py_matrix->matrix, corners,
+	                             step_x, step_y, test_width, test_height,
+	                             padding, min_coverage, use_integral, bbox);
+	SDAPS_END_ALLOW_THREADS
+
+	if (found) {
+		return Py_BuildValue("dddd", bbox[0], bbox[1], bbox[2], bbox[3]);
+	} else {
+		Py_INCREF(Py_None);
+		return Py_None;
+	}
+}
+
 static PyObject *
 wrap_get_masked_coverage(PyObject *self, PyObject *args)
 {
@@ -325,7 +529,9 @@ wrap_get_masked_coverage(PyObject *self, PyObject *args)
 	                      &x, &y))
 		return NULL;
 
+	SDAPS_BEGIN_ALLOW_THREADS
 	coverage = get_masked_coverage(py_surface->surface, py_mask->surface, x, y);
+	SDAPS_END_ALLOW_THREADS
 
 	return Py_BuildValue("d", coverage);
 }
@@ -346,7 +552,9 @@ wrap_get_masked_coverage_without_lines(PyObject *self, PyObject *args)
 	                      &x, &y, &line_width, &line_count))
 		return NULL;
 
+	SDAPS_BEGIN_ALLOW_THREADS
 	coverage = get_masked_coverage_without_lines(py_surface->surface, py_mask->surface, x, y, line_width, line_count);
+	SDAPS_END_ALLOW_THREADS
 
 	return Py_BuildValue("d", coverage);
 }
@@ -367,11 +575,121 @@ wrap_get_masked_white_area_count(PyObject *self, PyObject *args)
 	                      &x, &y, &min_size, &max_size))
 		return NULL;
 
+	SDAPS_BEGIN_ALLOW_THREADS
 	count = get_masked_white_area_count(py_surface->surface, py_mask->surface, x, y, min_size, max_size, &filled_area);
+	SDAPS_END_ALLOW_THREADS
 
 	return Py_BuildValue("id", count, filled_area);
 }
 
+static PyObject *
+wrap_get_checkbox_metrics(PyObject *self, PyObject *args)
+{
+	PycairoSurface *py_surface;
+	PycairoMatrix *py_matrix;
+	PyObject *py_boxes;
+	PyObject *py_ranges = NULL;
+	PyObject *result = NULL;
+	CheckboxMetrics *boxes;
+	gdouble *final_ranges = NULL;
+	gdouble remove_line_width;
+	Py_ssize_t count, range_count = 0, i;
+
+	if (!PyArg_ParseTuple(args, "O!O!Od|O",
+	                      &PycairoImageSurface_Type, &py_surface,
+	                      &PycairoMatrix_Type, &py_matrix,
+	                      &py_boxes, &remove_line_width, &py_ranges))
+		return NULL;
+
+	if (py_ranges != NULL && py_ranges != Py_None) {
+		py_ranges = PySequence_Fast(py_ranges, "The final ranges need to be a sequence of tuples.");
+		if (py_ranges == NULL)
+			return NULL;
+
+		range_count = PySequence_Fast_GET_SIZE(py_ranges);
+		final_ranges = g_new(gdouble, 2 * range_count);
+
+		for (i = 0; i < range_count; i++) {
+			if (!PyArg_ParseTuple(PySequence_Fast_GET_ITEM(py_ranges, i), "dd",
+			                      &final_ranges[2 * i], &final_ranges[2 * i + 1])) {
+				g_free(final_ranges);
+				Py_DECREF(py_ranges);
+				return NULL;
+			}
+		}
+		Py_DECREF(py_ranges);
+	}
+
+	py_boxes = PySequence_Fast(py_boxes, "The boxes need to be a sequence of tuples.");
+	if (py_boxes == NULL) {
+		g_free(final_ranges);
+		return NULL;
+	}
+
+	count = PySequence_Fast_GET_SIZE(py_boxes);
+	boxes = g_new0(CheckboxMetrics, count);
+
+	for (i = 0; i < count; i++) {
+		PycairoSurface *py_outline;
+		PycairoSurface *py_inner;
+		CheckboxMetrics *box = &boxes[i];
+
+		if (!PyArg_ParseTuple(PySequence_Fast_GET_ITEM(py_boxes, i), "O!ddO!dddd",
+		                      &PycairoImageSurface_Type, &py_outline,
+		                      &box->outline_xoff, &box->outline_yoff,
+		                      &PycairoImageSurface_Type, &py_inner,
+		                      &box->inner_xoff, &box->inner_yoff,
+		                      &box->mm_x, &box->mm_y))
+			goto out;
+
+		/* Keep the masks alive without the GIL */
+		box->outline = cairo_surface_reference(py_outline->surface);
+		box->inner = cairo_surface_reference(py_inner->surface);
+	}
+
+	/* Never creates a debug surface */
+	Py_BEGIN_ALLOW_THREADS
+	get_checkbox_metrics(py_surface->surface, &py_matrix->matrix, boxes, count, remove_line_width, final_ranges, range_count);
+	Py_END_ALLOW_THREADS
+
+	result = PyList_New(count);
+	if (result == NULL)
+		goto out;
+
+	for (i = 0; i < count; i++) {
+		PyObject *item;
+
+		/* Skipped metrics are None */
+		if (boxes[i].coverage_without_lines < 0)
+			item = Py_BuildValue("ddddOO",
+			                     boxes[i].x, boxes[i].y, boxes[i].covered,
+			                     boxes[i].coverage,
+			                     Py_None, Py_None);
+		else
+			item = Py_BuildValue("dddddd",
+			                     boxes[i].x, boxes[i].y, boxes[i].covered,
+			                     boxes[i].coverage,
+			                     boxes[i].coverage_without_lines,
+			                     boxes[i].white_area_coverage);
+		if (item == NULL) {
+			Py_CLEAR(result);
+			goto out;
+		}
+		PyList_SET_ITEM(result, i, item);
+	}
+
+out:
+	for (i = 0; i < count; i++) {
+		cairo_surface_destroy(boxes[i].outline);
+		cairo_surface_destroy(boxes[i].inner);
+	}
+	g_free(boxes);
+	g_free(final_ranges);
+	Py_DECREF(py_boxes);
+
+	return result;
+}
+
 static PyObject *
 wrap_get_pbm(PyObject *self, PyObject *args)
 {
@@ -384,7 +702,30 @@ wrap_get_pbm(PyObject *self, PyObject *args)
 	                      &PycairoImageSurface_Type, &py_surface))
 		return NULL;
 
+	Py_BEGIN_ALLOW_THREADS
 	get_pbm(py_surface->surface, &data, &length);
+	Py_END_ALLOW_THREADS
+
+	result = Py_BuildValue("y#", data, length);
+	g_free (data);
+	return result;
+}
+
+static PyObject *
+wrap_get_y800(PyObject *self, PyObject *args)
+{
+	PycairoSurface *py_surface;
+	PyObject* result;
+	Py_ssize_t length = 0;
+	void *data = NULL;
+
+	if (!PyArg_ParseTuple(args, "O!",
+	                      &PycairoImageSurface_Type, &py_surface))
+		return NULL;
+
+	Py_BEGIN_ALLOW_THREADS
+	get_y800(py_surface->surface, &data, &length);
+	Py_END_ALLOW_THREADS
 
 	result = Py_BuildValue("y#", data, length);
 	g_free (data);
@@ -393,12 +734,13 @@ wrap_get_pbm(PyObject *self, PyObject *args)
 
 static PyObject *sdaps_set_magic_values(PyObject *self, PyObject *args)
 {
-	if (!PyArg_ParseTuple(args, "ddddd",
+	if (!PyArg_ParseTuple(args, "ddddd|i",
 	                      &sdaps_line_min_length,
 	                      &sdaps_line_max_length,
 	                      &sdaps_line_width,
 	                      &sdaps_corner_mark_search_distance,
-	                      &sdaps_line_coverage))
+	                      &sdaps_line_coverage,
+	                      &sdaps_corner_mark_pyramid_levels))
 		return NULL;
 
 	Py_INCREF(Py_None);
@@ -461,9 +803,32 @@ wrap_kfill_modified(PyObject *self, PyObject *args)
 		return NULL;
 	}
 
+	Py_BEGIN_ALLOW_THREADS
 	kfill_modified(py_surface->surface, k);
+	Py_END_ALLOW_THREADS
 
 	Py_INCREF(Py_None);
 	return Py_None;
 }
 
+static PyObject *
+wrap_rotate_180(PyObject *self, PyObject *args)
+{
+	PycairoSurface *py_surface;
+
+	if (!PyArg_ParseTuple(args, "O!",
+	                      &PycairoImageSurface_Type, &py_surface))
+		return NULL;
+
+	if (cairo_image_surface_get_format (py_surface->surface) != CAIRO_FORMAT_A1) {
+		PyErr_SetString(PyExc_AssertionError, "This function only works with A1 surfaces currently!");
+		return NULL;
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	surface_rotate_180(py_surface->surface);
+	Py_END_ALLOW_THREADS
+
+	Py_INCREF(Py_None);
+	return Py_None;
+}
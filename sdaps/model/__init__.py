@@ -62,6 +62,7 @@ the objects in the model.
 '''
 
 from . import buddy
+from . import codec
 from . import data
 from . import questionnaire
 from . import sheet
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+# SDAPS - Scripts for data acquisition with paper based surveys
+# Copyright(C) 2026, Benjamin Berg <benjamin@sipsolutions.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Serialization of sheets for the database
+
+Two codecs exist. "json" is the original format, written using
+:py:func:`sdaps.model.db.toJson`. "binary" packs the data objects as arrays
+in the order of the questionnaire, so that neither the IDs nor the attribute
+names and class names are repeated for every box.
+
+The codec used for writing is stored per survey. Reading works with all
+codecs, as the format of a row can be detected from its content. This means
+that a database may contain a mix of formats.
+'''
+
+import json
+import struct
+import sys
+import zlib
+from array import array
+
+from . import data as datamodule
+from . import db
+from .sheet import Sheet, Image
+
+
+class JSONCodec(object):
+
+    name = 'json'
+    version = 1
+
+    def __init__(self, questionnaire):
+        pass
+
+    def dump(self, sheet):
+        return json.dumps(sheet, default=db.toJson)
+
+    def load(self, state):
+        return db.fromJson(json.loads(state), Sheet)
+
+
+# Binary format
+# =============
+#
+# A header of _binary_magic and the version byte, followed by the values of
+# the tuple built in BinaryCodec.dump. Every value is written as a tag byte
+# and its data, see _encode. All numbers are little endian, this includes
+# the packed columns.
+#
+# Attributes that cannot be packed exactly (unexpected types, unknown data
+# objects, metrics in differing order) are stored as they are. Loading gives
+# a sheet with equal data, including the order of the metrics dicts.
+
+_binary_magic = b'SDB'
+
+_tag = struct.Struct('<B')
+_int = struct.Struct('<q')
+_float = struct.Struct('<d')
+_length = struct.Struct('<I')
+
+(_TAG_NONE, _TAG_FALSE, _TAG_TRUE, _TAG_INT, _TAG_BIGINT, _TAG_FLOAT,
+ _TAG_STR, _TAG_BYTES, _TAG_TUPLE, _TAG_LIST, _TAG_DICT) = range(11)
+
+_int_min = -2**63
+_int_max = 2**63 - 1
+
+
+def _encode(value, out):
+    """Append the encoding of *value* to the list *out*. Containers are
+    written as their length followed by their items (dicts: key, value)."""
+    kind = type(value)
+    if value is None:
+        out.append(_tag.pack(_TAG_NONE))
+    elif kind is bool:
+        out.append(_tag.pack(_TAG_TRUE if value else _TAG_FALSE))
+    elif kind is int:
+        if _int_min <= value <= _int_max:
+            out.append(_tag.pack(_TAG_INT) + _int.pack(value))
+        else:
+            data = str(value).encode('ascii')
+            out.append(_tag.pack(_TAG_BIGINT) + _length.pack(len(data)) + data)
+    elif kind is float:
+        out.append(_tag.pack(_TAG_FLOAT) + _float.pack(value))
+    elif kind is str:
+        data = value.encode('utf-8')
+        out.append(_tag.pack(_TAG_STR) + _length.pack(len(data)) + data)
+    elif kind is bytes:
+        out.append(_tag.pack(_TAG_BYTES) + _length.pack(len(value)) + value)
+    elif kind is tuple or kind is list:
+        out.append(_tag.pack(_TAG_TUPLE if kind is tuple else _TAG_LIST) + _length.pack(len(value)))
+        for item in value:
+            _encode(item, out)
+    elif kind is dict:
+        out.append(_tag.pack(_TAG_DICT) + _length.pack(len(value)))
+        for key, item in value.items():
+            _encode(key, out)
+            _encode(item, out)
+    else:
+        raise AssertionError('Cannot store values of type %s in a sheet!' % kind.__name__)
+
+
+def _decode(data, pos):
+    """Returns the value encoded at *pos* in *data* and the position after
+    it."""
+    tag = data[pos]
+    pos += 1
+    if tag == _TAG_NONE:
+        return None, pos
+    elif tag == _TAG_FALSE:
+        return False, pos
+    elif tag == _TAG_TRUE:
+        return True, pos
+    elif tag == _TAG_INT:
+        return _int.unpack_from(data, pos)[0], pos + _int.size
+    elif tag == _TAG_FLOAT:
+        return _float.unpack_from(data, pos)[0], pos + _float.size
+
+    length, = _length.unpack_from(data, pos)
+    pos += _length.size
+    if tag == _TAG_STR:
+        return str(data[pos:pos + length], 'utf-8'), pos + length
+    elif tag == _TAG_BYTES:
+        return bytes(data[pos:pos + length]), pos + length
+    elif tag == _TAG_BIGINT:
+        return int(str(data[pos:pos + length], 'ascii')), pos + length
+    elif tag == _TAG_TUPLE or tag == _TAG_LIST:
+        items = []
+        for i in range(length):
+            item, pos = _decode(data, pos)
+            items.append(item)
+        return (tuple(items) if tag == _TAG_TUPLE else items), pos
+    elif tag == _TAG_DICT:
+        items = dict()
+        for i in range(length):
+            key, pos = _decode(data, pos)
+            items[key], pos = _decode(data, pos)
+        return items, pos
+
+    raise AssertionError('Corrupt binary sheet data!')
+
+
+_sheet_attrs = ('survey_id', 'questionnaire_id', 'global_id', 'valid',
+                'quality', 'recognized', 'review_comment', 'fingerprint')
+
+# The kinds of data objects, 0 means that there is no data object
+_kind_classes = (None, datamodule.QObject, datamodule.Checkbox, datamodule.Textbox)
+_kinds = {cls: kind for kind, cls in enumerate(_kind_classes) if cls is not None}
+
+_box_attrs = ('state', 'metrics', 'quality', 'x', 'y', 'width', 'height')
+_kind_attrs = (None, {'review_comment'}, set(_box_attrs), set(_box_attrs + ('text',)))
+_data_private_attrs = ('_parent', '_dirty')
+
+
+def _tobytes(values, typecode):
+    packed = array(typecode, values)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _pack(values, typecode, pytype):
+    # Use a packed array if this is exact, the plain values otherwise
+    for value in values:
+        if type(value) is not pytype:
+            return tuple(values)
+    try:
+        return _tobytes(values, typecode)
+    except OverflowError:
+        return tuple(values)
+
+
+def _unpack(packed, typecode):
+    if isinstance(packed, bytes):
+        res = array(typecode)
+        res.frombytes(packed)
+        if sys.byteorder != 'little':
+            res.byteswap()
+        return res.tolist()
+    return list(packed)
+
+
+def _pack_metrics(metrics):
+    """Returns a tuple of the metric names, followed by one packed column for
+    each of them, where NaN means that the metric is not set.
+
+    The names are kept in the order they are first seen, as the order of the
+    metrics dict is significant (see Checkbox.classify). If the boxes do not
+    share one order, the dicts are stored as they are."""
+    keys = dict()
+    for m in metrics:
+        last = -1
+        for key, value in m.items():
+            # NaN is used for missing values
+            if type(value) is not float or value != value:
+                return tuple(metrics)
+            index = keys.setdefault(key, len(keys))
+            if index < last:
+                return tuple(metrics)
+            last = index
+
+    keys = tuple(keys)
+    nan = float('nan')
+    columns = tuple(_tobytes([m.get(key, nan) for m in metrics], 'd') for key in keys)
+
+    return (keys,) + columns
+
+
+def _unpack_metrics(packed, count):
+    if count == 0:
+        return []
+    if not isinstance(packed[0], tuple):
+        return [dict(m) for m in packed]
+
+    keys = packed[0]
+    metrics = [dict() for i in range(count)]
+    for key, column in zip(keys, packed[1:]):
+        for m, value in zip(metrics, _unpack(column, 'd')):
+            if value == value:
+                m[key] = value
+
+    return metrics
+
+
+def _public_attrs(obj, skip=()):
+    return {k: v for k, v in obj.__dict__.items() if not k.startswith('_') and k not in skip}
+
+
+class BinaryCodec(object):
+
+    name = 'binary'
+    version = 1
+
+    def __init__(self, questionnaire):
+        # The layout is the order of all objects that may have data. It
+        # cannot change once sheets exist, as the data is keyed by the IDs.
+        layout = []
+        for qobject in questionnaire.qobjects:
+            layout.append(qobject.id)
+            for box in qobject.boxes:
+                layout.append(box.id)
+
+        self._layout = layout
+        self._index = {oid: i for i, oid in enumerate(layout)}
+        self._layout_crc = zlib.crc32(repr(layout).encode('utf-8'))
+
+    def dump(self, sheet):
+        slots = [None] * len(self._layout)
+        extra = []
+
+        for key, obj in sheet.data.items():
+            index = self._index.get(key)
+            kind = _kinds.get(type(obj))
+            attrs = obj.__dict__
+
+            # Checking the private attributes that exist is a lot cheaper
+            # than filtering the dict
+            count = len(attrs)
+            for private in _data_private_attrs:
+                if private in attrs:
+                    count -= 1
+
+            if index is None or kind is None or count != len(_kind_attrs[kind]) or not _kind_attrs[kind].issubset(attrs):
+                extra.append((key, obj.__class__.__name__, _public_attrs(obj)))
+                continue
+
+            slots[index] = (kind, attrs)
+
+        kinds = bytearray(len(slots))
+        comments = []
+        boxes = []
+        texts = []
+        for index, slot in enumerate(slots):
+            if slot is None:
+                continue
+            kind, attrs = slot
+            kinds[index] = kind
+
+            if kind == 1:
+                comments.append(attrs['review_comment'])
+            else:
+                boxes.append(attrs)
+                if kind == 3:
+                    texts.append(attrs['text'])
+
+        payload = (
+            self._layout_crc,
+            tuple(getattr(sheet, attr) for attr in _sheet_attrs),
+            tuple(_public_attrs(img, Image._save_skip) for img in sheet.images),
+            bytes(kinds),
+            tuple(comments),
+            _pack([b['state'] for b in boxes], 'q', int),
+            _pack_metrics([b['metrics'] for b in boxes]),
+            _pack([b['quality'] for b in boxes], 'd', float),
+            _pack([b['x'] for b in boxes], 'd', float),
+            _pack([b['y'] for b in boxes], 'd', float),
+            _pack([b['width'] for b in boxes], 'd', float),
+            _pack([b['height'] for b in boxes], 'd', float),
+            tuple(texts),
+            tuple(extra),
+        )
+
+        out = [_binary_magic, bytes((self.version,))]
+        _encode(payload, out)
+        return b''.join(out)
+
+    def load(self, state):
+        if state[:len(_binary_magic)] != _binary_magic or state[len(_binary_magic)] != self.version:
+            raise AssertionError('Unsupported binary sheet format!')
+
+        try:
+            payload, end = _decode(memoryview(state), len(_binary_magic) + 1)
+        except (IndexError, struct.error, UnicodeDecodeError):
+            end = None
+        if end != len(state):
+            raise AssertionError('Corrupt binary sheet data!')
+
+        layout_crc, sheet_attrs, images, kinds, comments, states, metrics, \
+            qualities, xs, ys, widths, heights, texts, extra = payload
+
+        if layout_crc != self._layout_crc:
+            raise AssertionError('Sheet was stored for a different questionnaire!')
+
+        sheet = Sheet.__new__(Sheet)
+        sheet_dict = sheet.__dict__
+        sheet_dict['survey'] = None
+        sheet_dict.update(zip(_sheet_attrs, sheet_attrs))
+
+        sheet_dict['images'] = []
+        for attrs in images:
+            img = Image.__new__(Image)
+            img.__dict__.update(attrs)
+            img.__dict__['sheet'] = sheet
+            sheet_dict['images'].append(img)
+
+        columns = zip(_unpack(states, 'q'),
+                      _unpack_metrics(metrics, len(kinds) - kinds.count(0) - kinds.count(1)),
+                      _unpack(qualities, 'd'), _unpack(xs, 'd'), _unpack(ys, 'd'),
+                      _unpack(widths, 'd'), _unpack(heights, 'd'))
+        comments = iter(comments)
+        texts = iter(texts)
+
+        data = dict()
+        layout = self._layout
+        for index, kind in enumerate(kinds):
+            if not kind:
+                continue
+
+            cls = _kind_classes[kind]
+            obj = cls.__new__(cls)
+            if kind == 1:
+                obj.__dict__['review_comment'] = next(comments)
+            else:
+                obj.__dict__.update(zip(_box_attrs, next(columns)))
+                if kind == 3:
+                    obj.__dict__['text'] = next(texts)
+            data[layout[index]] = obj
+
+        for key, clsname, attrs in extra:
+            cls = getattr(datamodule, clsname)
+            obj = cls.__new__(cls)
+            obj.__dict__.update(attrs)
+            data[key] = obj
+
+        sheet_dict['data'] = data
+
+        return sheet
+
+
+codecs = {
+    JSONCodec.name: JSONCodec,
+    BinaryCodec.name: BinaryCodec,
+}
+
+
+def detect(state):
+    """Returns the name of the codec that *state* was written with."""
+    if isinstance(state, bytes) and state.startswith(_binary_magic):
+        return BinaryCodec.name
+    return JSONCodec.name
@@ -24,7 +24,8 @@ class Sheet(buddy.Object):
 
     _save_attrs = {'data', 'images', 'survey_id',
                    'questionnaire_id', 'global_id', 'valid',
-                   'quality', 'recognized', 'review_comment' }
+                   'quality', 'recognized', 'review_comment',
+                   'fingerprint' }
 
     def __init__(self):
         self.survey = None
@@ -38,6 +39,8 @@ class Sheet(buddy.Object):
         self.review_comment = None
 
         self.recognized = False
+        #: The inputs of the last recognition, see the recognize module
+        self.fingerprint = None
 
     def add_image(self, image):
         self.images.append(image)
@@ -72,6 +75,7 @@ class Sheet(buddy.Object):
         # Attributes that may not (yet) be present in the database
         self.survey = None
         self.review_comment = None
+        self.fingerprint = None
 
         _tmp = data['data']
         data['data'] = dict()
@@ -19,12 +19,14 @@
 import os
 import sys
 import struct
+import time
 
 import json
 import sqlite3
 import weakref
 from contextlib import closing
  
+from . import codec
 from . import db
 from . import questionnaire
 from .sheet import Sheet
@@ -57,6 +59,35 @@ CREATE TABLE sheets (
 );
 """
 
+# Migrations of the DB schema, each one upgrades to the version it is stored
+# at. The version is stored as user_version, new DBs are created with all
+# migrations applied.
+_db_migrations = [
+    None,
+    # 1: Copies of sheet properties, for lookups without decoding the JSON.
+    #    The IDs are stored as they are (int or string), i.e. untyped.
+    """
+ALTER TABLE sheets ADD COLUMN questionnaire_id;
+ALTER TABLE sheets ADD COLUMN global_id;
+ALTER TABLE sheets ADD COLUMN valid INTEGER;
+ALTER TABLE sheets ADD COLUMN recognized INTEGER;
+ALTER TABLE sheets ADD COLUMN verified INTEGER;
+CREATE INDEX sheets_questionnaire_id ON sheets (survey_rowid, questionnaire_id);
+CREATE INDEX sheets_global_id ON sheets (survey_rowid, global_id);
+""",
+    # 2: The codec (see the codec module) that sheets are written with. Note
+    #    that the "json" column of the sheets may hold any format.
+    """
+ALTER TABLE surveys ADD COLUMN sheet_codec TEXT;
+ALTER TABLE surveys ADD COLUMN sheet_codec_version INTEGER;
+""",
+]
+
+_db_sheet_columns = ('questionnaire_id', 'global_id', 'valid', 'recognized', 'verified')
+
+# Number of sheets that are fetched from the DB at once when iterating
+_db_batch_size = 100
+
 
 
 class Defs(object):
@@ -155,6 +186,14 @@ class Survey(object):
         self._loaded_sheets = weakref.WeakValueDictionary()
         self._dirty_sheets = []
         self._current_sheet = None
+        self._checkpoint_sheets = None
+        self._checkpoint_seconds = None
+        self._checkpoint_time = time.monotonic()
+        self._sheet_codec_name = defs.sheet_codec
+        self._sheet_codecs = dict()
+        # The schema version of the DB, see _db_migrate
+        self._db_version = 0
+        self._db_migrated = False
 
     def add_questionnaire(self, questionnaire):
         self.questionnaire = questionnaire
@@ -243,6 +282,19 @@ class Survey(object):
             survey._survey_rowid = 0
             survey._db = _db
 
+            # The DB is only upgraded when something is written
+            survey._db_version, = c.execute('PRAGMA user_version').fetchone()
+
+            if survey._db_version >= 2:
+                c.execute('SELECT sheet_codec, sheet_codec_version FROM surveys WHERE rowid=?', (survey_rowid,))
+                name, version = c.fetchone()
+
+                if name not in codec.codecs or version > codec.codecs[name].version:
+                    raise AssertionError('Sheets are stored in an unsupported format, the project was created with a newer SDAPS version!')
+                survey._sheet_codec_name = name
+            else:
+                survey._sheet_codec_name = codec.JSONCodec.name
+
         ##########
         # Load the info file
         config = configparser.ConfigParser()
@@ -260,6 +312,46 @@ class Survey(object):
 
         return survey
 
+    def _db_migrate(self):
+        """Upgrade the DB schema to the current version, and fill in the
+        sheet columns where they are missing. This may rewrite every sheet
+        row, so it is only done once before the first write (see
+        :py:meth:`save` and :py:meth:`checkpoint`)."""
+        if self._db_migrated:
+            return
+
+        with self._db as con:
+            c = con.cursor()
+            for i in range(self._db_version + 1, len(_db_migrations)):
+                # executescript would commit, so run the statements one by one
+                for statement in _db_migrations[i].split(';'):
+                    if statement.strip():
+                        c.execute(statement)
+
+                if i == 2:
+                    # Existing projects stay readable by older versions
+                    # until they are converted explicitly.
+                    c.execute('UPDATE surveys SET sheet_codec=?, sheet_codec_version=?',
+                              (codec.JSONCodec.name, codec.JSONCodec.version))
+
+            if self._db_version != len(_db_migrations) - 1:
+                c.execute('PRAGMA user_version = %i' % (len(_db_migrations) - 1))
+
+            # The columns are empty after migration 1, and older versions of
+            # SDAPS leave them empty for the sheets they add.
+            c.execute('SELECT rowid, json FROM sheets WHERE valid IS NULL OR recognized IS NULL OR verified IS NULL')
+            for rowid, state in c.fetchall():
+                sheet = self._get_sheet_codec(codec.detect(state)).load(state)
+                c.execute('UPDATE sheets SET %s WHERE rowid=?' % ', '.join('%s=?' % col for col in _db_sheet_columns),
+                          self._db_sheet_values(sheet) + (rowid,))
+
+        self._db_version = len(_db_migrations) - 1
+        self._db_migrated = True
+
+    def _db_sheet_values(self, sheet):
+        return (sheet.questionnaire_id, sheet.global_id, int(sheet.valid),
+                int(sheet.recognized), int(sheet.verified))
+
     def _db_get_sheet(self, rowid):
         try:
             return self._loaded_sheets[rowid]
@@ -269,8 +361,20 @@ class Survey(object):
         c = self._db.cursor()
         c.execute('SELECT json FROM sheets WHERE survey_rowid=? AND rowid=?', (self._survey_rowid, rowid))
 
-        data = json.loads(c.fetchone()[0])
-        sheet = db.fromJson(data, Sheet)
+        return self._db_load_sheet(rowid, c.fetchone()[0])
+
+    def _get_sheet_codec(self, name):
+        try:
+            return self._sheet_codecs[name]
+        except KeyError:
+            pass
+
+        sheet_codec = codec.codecs[name](self.questionnaire)
+        self._sheet_codecs[name] = sheet_codec
+        return sheet_codec
+
+    def _db_load_sheet(self, rowid, state):
+        sheet = self._get_sheet_codec(codec.detect(state)).load(state)
         sheet._rowid = rowid
         sheet.survey = self
         sheet.reinit_state()
@@ -278,6 +382,9 @@ class Survey(object):
         self._loaded_sheets[rowid] = sheet
         return sheet
 
+    def _db_dump_sheet(self, sheet):
+        return self._get_sheet_codec(self._sheet_codec_name).dump(sheet)
+
     def _db_save_sheet(self, cursor, sheet):
         if not sheet.dirty and sheet._rowid != -1:
             return
@@ -286,13 +393,18 @@ class Survey(object):
             cursor.execute('DELETE FROM sheets WHERE survey_rowid=? and rowid=?', (self._survey_rowid, sheet._rowid))
             return
 
-        tmp = json.dumps(sheet, default=db.toJson)
+        tmp = self._db_dump_sheet(sheet)
+        values = self._db_sheet_values(sheet)
         if sheet._rowid == -1:
-            cursor.execute('INSERT INTO sheets (survey_rowid, json) VALUES (?, ?)', (self._survey_rowid, tmp))
+            cursor.execute('INSERT INTO sheets (survey_rowid, json, %s) VALUES (?, ?, %s)' %
+                           (', '.join(_db_sheet_columns), ', '.join('?' * len(_db_sheet_columns))),
+                           (self._survey_rowid, tmp) + values)
             sheet._rowid = cursor.lastrowid
             self._loaded_sheets[sheet._rowid] = sheet
         else:
-            cursor.execute('UPDATE sheets SET json=? WHERE survey_rowid=? and rowid=?', (tmp, self._survey_rowid, sheet._rowid))
+            cursor.execute('UPDATE sheets SET json=?, %s WHERE survey_rowid=? and rowid=?' %
+                           ', '.join('%s=?' % col for col in _db_sheet_columns),
+                           (tmp,) + values + (self._survey_rowid, sheet._rowid))
 
         sheet._clear_dirty()
 
@@ -321,16 +433,21 @@ class Survey(object):
             raise AssertionError('DB file already exists!')
         survey._db = sqlite3.connect(dbfile)
         survey._db.executescript(_db_schema)
+        survey._db_migrate()
 
         return survey
 
     def save(self):
         import configparser
 
+        self._db_migrate()
+
         # Update the DB syncing out all changes
         with self._db as con:
             c = con.cursor()
-            c.execute('INSERT OR REPLACE INTO surveys (rowid, json) VALUES (?, ?)', (self._survey_rowid, json.dumps(self, default=db.toJson)))
+            c.execute('INSERT OR REPLACE INTO surveys (rowid, json, sheet_codec, sheet_codec_version) VALUES (?, ?, ?, ?)',
+                      (self._survey_rowid, json.dumps(self, default=db.toJson),
+                       self._sheet_codec_name, codec.codecs[self._sheet_codec_name].version))
 
             for sheet in self._dirty_sheets:
                  self._db_save_sheet(c, sheet)
@@ -389,6 +506,58 @@ class Survey(object):
         os.rename(os.path.join(self.survey_dir, '.info.tmp'), os.path.join(self.survey_dir, 'info'))
 
 
+    def close_db(self):
+        '''close the connection to the database until :py:meth:`open_db` is
+        called
+
+        A sqlite connection must not be used in more than one process, so it
+        needs to be closed while forking. Sheets that are not written yet stay
+        in memory.
+        '''
+        self._db.close()
+        self._db = None
+
+    def open_db(self):
+        '''open the connection to the database, see :py:meth:`close_db`
+        '''
+        self._db = sqlite3.connect(self.path('survey.sqlite'))
+
+    def checkpoint(self):
+        """Write all modified sheets except for the current one to the DB in
+        one transaction and drop the references to them, so that they can be
+        freed. The survey itself and the info file are only written by
+        :py:meth:`save`."""
+        self._db_migrate()
+
+        with self._db as con:
+            c = con.cursor()
+            for sheet in self._dirty_sheets:
+                 self._db_save_sheet(c, sheet)
+
+        self._dirty_sheets = []
+        self._checkpoint_time = time.monotonic()
+
+    def set_checkpoint_interval(self, sheets=None, seconds=None):
+        """Automatically call :py:meth:`checkpoint` when moving to another
+        sheet once *sheets* modified sheets are pending or *seconds* passed
+        since the last one. None disables the respective limit, by default
+        nothing is written before :py:meth:`save`."""
+        self._checkpoint_sheets = sheets
+        self._checkpoint_seconds = seconds
+        self._checkpoint_time = time.monotonic()
+
+    def _checkpoint_due(self):
+        if not self._dirty_sheets:
+            return False
+
+        if self._checkpoint_sheets is not None and len(self._dirty_sheets) >= self._checkpoint_sheets:
+            return True
+
+        if self._checkpoint_seconds is not None and time.monotonic() - self._checkpoint_time >= self._checkpoint_seconds:
+            return True
+
+        return False
+
     def path(self, *path):
         return os.path.join(self.survey_dir, *path)
 
@@ -405,17 +574,135 @@ class Survey(object):
     #: The currently selected sheet. Usually it will be changed by :py:meth:`iterate` or similar.
     sheet = property(get_sheet)
 
+    def _db_filter_rowids(self, cursor, filter):
+        """The rowids of all sheets in order. If the filter has a SQL
+        condition (see :py:mod:`clifilter`), sheets that cannot match are
+        left out."""
+        sql = getattr(filter, 'sql', None)
+        # The columns only exist once the DB has been upgraded
+        if sql is None or self._db_version < 1:
+            cursor.execute('SELECT rowid FROM sheets WHERE survey_rowid=? ORDER BY sort,rowid', (self._survey_rowid,))
+        else:
+            where, params = sql
+
+            # Sheets added by older versions of SDAPS have no columns set
+            # (valid is never NULL otherwise), the condition would be NULL.
+            where = '(%s) OR valid IS NULL' % where
+
+            # The columns of modified sheets may not be up to date yet
+            dirty = tuple(rowid for rowid, sheet in list(self._loaded_sheets.items()) if sheet.dirty)
+            if dirty:
+                where = '(%s) OR rowid IN (%s)' % (where, ', '.join('?' * len(dirty)))
+                params = params + dirty
+
+            cursor.execute('SELECT rowid FROM sheets WHERE survey_rowid=? AND (%s) ORDER BY sort,rowid' % where,
+                           (self._survey_rowid,) + params)
+
+        return [rowid for rowid, in cursor.fetchall()]
+
+    def _db_iter_sheets(self, rowids):
+        """Yield the sheets with the given rowids in order. Sheets that are
+        not loaded yet are fetched in batches, which is a lot cheaper than
+        one query per sheet. Rowids that do not exist (anymore) are
+        skipped."""
+        for start in range(0, len(rowids), _db_batch_size):
+            batch = rowids[start:start + _db_batch_size]
+
+            # Holds the references until the sheets are used
+            sheets = {}
+            missing = []
+            for rowid in batch:
+                sheet = self._loaded_sheets.get(rowid)
+                if sheet is not None:
+                    sheets[rowid] = sheet
+                else:
+                    missing.append(rowid)
+
+            states = {}
+            if missing:
+                c = self._db.cursor()
+                c.execute('SELECT rowid, json FROM sheets WHERE survey_rowid=? AND rowid IN (%s)' % ', '.join('?' * len(missing)),
+                          (self._survey_rowid,) + tuple(missing))
+                states = dict(c.fetchall())
+
+            for rowid in batch:
+                # The sheet may have been loaded while processing the batch,
+                # only decode it when it is needed.
+                sheet = self._loaded_sheets.get(rowid)
+                if sheet is None:
+                    state = states.pop(rowid, None)
+                    if state is None:
+                        continue
+                    sheet = self._db_load_sheet(rowid, state)
+                yield sheet
+
+    def iterate_sheets(self, rowids):
+        '''yield the sheets with the given rowids (see
+        :py:meth:`prefilter_rowids`) in order, without moving to them
+        '''
+        return self._db_iter_sheets(rowids)
+
     def iterate(self, function, filter=lambda: True, *args, **kwargs):
         '''call function once for each sheet
         '''
         with self._db as con:
             c = con.cursor()
-            c.execute('SELECT rowid FROM sheets WHERE survey_rowid=? ORDER BY sort,rowid', (self._survey_rowid,))
-            for sheetid, in c.fetchall():
-                self.goto_sheet(self._db_get_sheet(sheetid))
+            for sheet in self._db_iter_sheets(self._db_filter_rowids(c, filter)):
+                self.goto_sheet(sheet)
                 if filter():
                     function(*args, **kwargs)
 
+    def prefilter_rowids(self, filter=lambda: True):
+        '''return the rowids of all sheets that may match filter in order,
+        without loading the sheets
+
+        Only the SQL condition of the filter is used (see
+        :py:mod:`sdaps.clifilter`), so the filter itself still needs to be
+        called for every sheet.
+        '''
+        with self._db as con:
+            return self._db_filter_rowids(con.cursor(), filter)
+
+    def goto_rowid(self, rowid):
+        '''goto the sheet with the given rowid (see :py:meth:`prefilter_rowids`)
+        '''
+        self.goto_sheet(self._db_get_sheet(rowid))
+
+    def dump_sheet(self, sheet):
+        '''return the serialized state of the sheet as it is stored in the DB
+        '''
+        return self._db_dump_sheet(sheet)
+
+    def load_sheet(self, rowid, state):
+        '''replace the sheet with the given rowid by a state created using
+        :py:meth:`dump_sheet` (e.g. in another process) and goto it
+
+        The sheet is marked as modified, so it is written on the next
+        :py:meth:`save`.
+        '''
+        sheet = self._db_load_sheet(rowid, state)
+        sheet._dirty = True
+        self.goto_sheet(sheet)
+
+    def set_sheet_codec(self, name, convert=True):
+        '''write sheets using the codec *name* (see :py:mod:`sdaps.model.codec`)
+
+        With *convert* all sheets are rewritten, otherwise each sheet is
+        converted the next time it is modified. Either way the change is only
+        complete after :py:meth:`save`.
+        '''
+        if name not in codec.codecs:
+            raise AssertionError('Unknown sheet codec %s!' % name)
+
+        self._sheet_codec_name = name
+
+        if convert:
+            def mark_dirty():
+                self.sheet._dirty = True
+
+            self.set_checkpoint_interval(defs.checkpoint_sheets, defs.checkpoint_seconds)
+            self.iterate_progressbar(mark_dirty)
+
     @property
     def sheet_count(self):
         with self._db as con:
@@ -427,28 +714,42 @@ class Survey(object):
     def iterate_progressbar(self, function, filter=lambda: True, *args, **kwargs):
         '''call function once for each sheet and display a progressbar
         '''
-        with self._db as con:
-            c = con.cursor()
-            c.execute('SELECT count(*) FROM sheets WHERE survey_rowid=?', (self._survey_rowid,))
-            count = c.fetchone()[0]
+        def run(rowids):
+            for sheet in self._db_iter_sheets(rowids):
+                self.goto_sheet(sheet)
+                if filter():
+                    function(*args, **kwargs)
+                    yield True
+                else:
+                    yield False
 
-            # The old code used to first filter, and then run; but that is
-            # a bit ineffective in a way
-            print(ungettext('%i sheet', '%i sheets', count) % count)
-            if count == 0:
-                return
+        self.run_progressbar(run, filter)
 
-            log.progressbar.start(count)
+    def run_progressbar(self, run, filter=lambda: True):
+        '''display a progressbar while run processes the sheets
 
-            processed = 0
-            c.execute('SELECT rowid FROM sheets WHERE survey_rowid=? ORDER BY sort,rowid', (self._survey_rowid,))
-            for index, (sheetid,) in enumerate(c.fetchall()):
-                self.goto_sheet(self._db_get_sheet(sheetid))
-                if filter():
-                    function(*args, **kwargs)
-                    processed += 1
+        run is called with the rowids of the sheets that may match filter (see
+        :py:meth:`prefilter_rowids`) and has to yield once for every one of
+        them, True if the sheet was processed and False if it was skipped.
+        '''
+        count = self.sheet_count
+
+        # The old code used to first filter, and then run; but that is
+        # a bit ineffective in a way
+        print(ungettext('%i sheet', '%i sheets', count) % count)
+        if count == 0:
+            return
+
+        rowids = self.prefilter_rowids(filter)
+        # The progressbar cannot handle an empty range
+        log.progressbar.start(max(len(rowids), 1))
+
+        processed = 0
+        for index, done in enumerate(run(rowids)):
+            if done:
+                processed += 1
 
-                log.progressbar.update(index + 1)
+            log.progressbar.update(index + 1)
 
         print(_('Processed %i of %i sheets, took %f seconds') % (processed, count, log.progressbar.elapsed_time))
 
@@ -461,6 +762,9 @@ class Survey(object):
 
         self._current_sheet = sheet
 
+        if self._checkpoint_due():
+            self.checkpoint()
+
     def goto_nth_sheet(self, index):
         with self._db as con:
             c = con.cursor()
@@ -481,12 +785,27 @@ class Survey(object):
         except ValueError:
             pass
 
-        sheets = []
-        def found():
-            if self.sheet.questionnaire_id in qids:
-                sheets.append(self.sheet)
+        with self._db as con:
+            c = con.cursor()
+            if self._db_version < 1:
+                # The DB has not been upgraded yet, check every sheet
+                c.execute('SELECT rowid FROM sheets WHERE survey_rowid=? ORDER BY sort,rowid', (self._survey_rowid,))
+            else:
+                # Sheets added by older versions of SDAPS have no ID stored
+                c.execute('SELECT rowid FROM sheets WHERE survey_rowid=? AND (questionnaire_id IN (%s) OR questionnaire_id IS NULL) ORDER BY sort,rowid' %
+                          ', '.join('?' * len(qids)), (self._survey_rowid,) + tuple(qids))
+            rowids = [rowid for rowid, in c.fetchall()]
 
-        self.iterate(found)
+        # Modified sheets may not have been written to the DB yet
+        for rowid, sheet in list(self._loaded_sheets.items()):
+            if sheet.dirty and rowid not in rowids:
+                rowids.append(rowid)
+
+        sheets = []
+        for rowid in rowids:
+            sheet = self._db_get_sheet(rowid)
+            if sheet.questionnaire_id in qids:
+                sheets.append(sheet)
 
         if len(sheets) == 1:
             self.goto_sheet(sheets[0])
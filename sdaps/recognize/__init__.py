@@ -22,18 +22,133 @@ data. It reads the image data and tries to guess whether a checkbox is
 empty/checked/filled and finds the written area in a textfield.
 """
 
+import multiprocessing
+
 from sdaps import model
+from sdaps import image
+from sdaps import defs
+from sdaps import surface
 
 from . import buddies
 
 
-def recognize(survey, filter):
-    # iterate over sheets
-    survey.iterate_progressbar(survey.questionnaire.recognize.recognize, filter)
+def recognize(survey, filter, jobs=1, warm_start=None):
+    if warm_start is not None:
+        buddies.enable_warm_start(warm_start)
+
+    survey.set_checkpoint_interval(defs.checkpoint_sheets, defs.checkpoint_seconds)
+
+    if jobs > 1:
+        _iterate_parallel(survey, 'recognize', filter, jobs)
+    else:
+        # iterate over sheets
+        surface.start_prefetch(defs.image_prefetch)
+        try:
+            _iterate_prefetch(survey, survey.questionnaire.recognize.recognize, filter)
+        finally:
+            surface.stop_prefetch()
+    # Do not keep the scans open
+    image.clear_tiff_cache()
     survey.save()
 
-def identify(survey, filter):
-    # iterate over sheets
-    survey.iterate_progressbar(survey.questionnaire.recognize.identify, filter)
+def identify(survey, filter, jobs=1, warm_start=None):
+    if warm_start is not None:
+        buddies.enable_warm_start(warm_start)
+
+    survey.set_checkpoint_interval(defs.checkpoint_sheets, defs.checkpoint_seconds)
+
+    if jobs > 1:
+        _iterate_parallel(survey, 'identify', filter, jobs)
+    else:
+        # iterate over sheets, prefetching would decode the full pages
+        if not defs.identify_partial_load:
+            surface.start_prefetch(defs.image_prefetch)
+        try:
+            _iterate_prefetch(survey, survey.questionnaire.recognize.identify, filter)
+        finally:
+            surface.stop_prefetch()
+    # Do not keep the scans open
+    image.clear_tiff_cache()
     survey.save()
 
+def _iterate_prefetch(survey, function, filter):
+    """Like survey.iterate_progressbar, but the pages of the sheets that are
+    processed next are decoded in the background if prefetching was
+    started."""
+    def run(rowids):
+        for sheet in surface.prefetch_sheets(survey.iterate_sheets(rowids)):
+            survey.goto_sheet(sheet)
+            if filter():
+                function()
+                yield True
+            else:
+                yield False
+
+    survey.run_progressbar(run, filter)
+
+
+# The survey, the questionnaire buddy method and the filter of a worker
+# process.
+_worker_survey = None
+_worker_function = None
+_worker_filter = None
+
+def _worker_init(survey, function, filter):
+    global _worker_survey, _worker_function, _worker_filter
+
+    # The survey is the forked copy of the one of the parent process, so the
+    # filter refers to it. It needs its own DB connection, which is only read
+    # from. The parent writes all results, so never checkpoint here.
+    survey.open_db()
+    survey.set_checkpoint_interval()
+
+    _worker_survey = survey
+    _worker_function = getattr(survey.questionnaire.recognize, function)
+    _worker_filter = filter
+
+def _worker_run(rowid):
+    _worker_survey.goto_rowid(rowid)
+    if not _worker_filter():
+        return rowid, None
+
+    _worker_function()
+
+    sheet = _worker_survey.sheet
+    state = _worker_survey.dump_sheet(sheet)
+    # The parent process writes the result, forget about the changes here
+    sheet._clear_dirty()
+
+    return rowid, state
+
+def _iterate_parallel(survey, function, filter, jobs):
+    """Run the questionnaire buddy method *function* for every sheet matching
+    *filter* in *jobs* worker processes. The resulting sheet states are
+    loaded back in order, so that saving the survey afterwards gives the same
+    result as a serial run."""
+    def run(rowids):
+        # Only the SQL condition of the filter was checked for the rowids, the
+        # workers call the filter after loading the sheet.
+        if not rowids:
+            return
+
+        # Hand out a few sheets at a time to save round trips, but keep the
+        # chunks small so that the load stays balanced and the progress is
+        # updated regularly.
+        chunksize = max(1, min(8, len(rowids) // (4 * jobs)))
+
+        # The workers need to inherit the loaded modules (and the image module
+        # setup), so fork them. The DB connection must not be shared with them.
+        ctx = multiprocessing.get_context('fork')
+        survey.close_db()
+        try:
+            pool = ctx.Pool(jobs, _worker_init, (survey, function, filter))
+        finally:
+            survey.open_db()
+
+        with pool:
+            for rowid, state in pool.imap(_worker_run, rowids, chunksize):
+                if state is not None:
+                    survey.load_sheet(rowid, state)
+                yield state is not None
+
+    survey.run_progressbar(run, filter)
@@ -64,6 +64,12 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
         # Assume no (useful) global ID exists
         return None
 
+    def get_identify_regions(self):
+        """Return the regions (x, y, width, height in mm) that the other
+        functions look at, or None if the whole page is needed. Optional."""
+        # Nothing is read
+        return []
+
 # Example of using this to preload your own custom buddy. This assume a local run.
 # You can of course use the API directly too.
 if __name__ == '__main__':
@@ -17,7 +17,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import cairo
+import functools
+import hashlib
 import math
+import os
 
 from sdaps import model
 from sdaps import matrix
@@ -35,6 +38,60 @@ pt_to_mm = 25.4 / 72.0
 
 warned_multipage_not_correctly_scanned = False
 
+# Corner mark positions of the last image of each scan, by filename and image
+# size. None if the corner mark search should not be warm started.
+_warm_start_corners = {} if defs.corner_mark_warm_start else None
+
+def enable_warm_start(enable):
+    """Seed the corner mark search with the positions found on the previous
+    image of the same scan."""
+    global _warm_start_corners
+
+    _warm_start_corners = {} if enable else None
+
+
+# The global settings that the recognition results depend on. Changing any
+# of them invalidates the fingerprint of already recognized sheets.
+_fingerprint_defs = (
+    'corner_mark_min_length', 'corner_mark_max_length',
+    'corner_mark_search_distance', 'corner_boxes', 'cornerbox_on_coverage',
+    'codebox_on_coverage', 'checkbox_metrics', 'find_box_corners_tolerance',
+    'textbox_scan_step_x', 'textbox_scan_step_y', 'textbox_scan_width',
+    'textbox_scan_height', 'textbox_scan_coverage',
+    'textbox_minimum_writing_width', 'textbox_minimum_writing_height',
+    'textbox_scan_padding', 'textbox_scan_uncorrected_padding',
+    'textbox_extra_padding', 'image_line_width', 'image_line_coverage',
+    'corner_mark_pyramid_levels', 'checkbox_mask_matrix_precision',
+    'checkbox_metrics_full',
+)
+
+# Page checksums calculated by Sheet.needs_recognition, keyed by the
+# filename, tiff page, size and mtime. The recognition stores them in the
+# fingerprint, so that it does not need to read the pages again.
+_page_checksums = {}
+
+def settings_fingerprint(survey):
+    """A checksum over the survey settings and the global defs that the
+    recognition results depend on."""
+    values = [survey.survey_id]
+    values.extend((slot, getattr(survey.defs, slot, None)) for slot in survey.defs.__slots__)
+    values.extend((name, getattr(defs, name)) for name in _fingerprint_defs)
+
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+def image_fingerprint(img, checksum=True):
+    """Returns [filename, tiff_page, size, mtime, checksum] for the image,
+    where the checksum only covers the raw data of the page. The checksum is
+    None if *checksum* is False. Returns None if the file cannot be read."""
+    filename = img.sheet.survey.path(img.filename)
+    try:
+        stat = os.stat(filename)
+        page_checksum = image.get_tiff_page_checksum(filename, img.tiff_page) if checksum else None
+    except (OSError, AssertionError):
+        return None
+
+    return [img.filename, img.tiff_page, stat.st_size, stat.st_mtime_ns, page_checksum]
+
 
 class Sheet(model.buddy.Buddy, metaclass=model.buddy.Register):
 
@@ -45,7 +102,10 @@ class Sheet(model.buddy.Buddy, metaclass=model.buddy.Register):
         model.buddy.Buddy.__init__(self, *args)
         self.filter_image = None
 
-    def recognize(self):
+    def recognize(self, partial=False):
+        """Identify the images of the sheet. If *partial* is set, only the
+        parts of the images that are needed for this are decoded if possible,
+        so the surfaces cannot be used for anything else afterwards."""
         global warned_multipage_not_correctly_scanned
 
         self.obj.valid = 1
@@ -56,7 +116,11 @@ class Sheet(model.buddy.Buddy, metaclass=model.buddy.Register):
         for image in self.obj.images:
             if not image.ignored:
                 image.rotated = 0
-                image.surface.load()
+                rows = image.recognize.identify_rows() if partial else None
+                if rows is None:
+                    image.surface.load()
+                else:
+                    image.surface.load_partial(rows)
 
         failed_pages = set()
 
@@ -88,14 +152,11 @@ class Sheet(model.buddy.Buddy, metaclass=model.buddy.Register):
         # Copy the rotation over (if required) and print warning if the rotation is unknown
         self.duplex_copy_image_attr(failed_pages, 'rotated', _("Neither %s, %i or %s, %i has a known rotation!"))
 
-        # Reload any image that is rotated.
+        # Rotate any image that is upside down (this also fixes the matrix).
         for page, image in enumerate(self.obj.images):
             if image.rotated and not image.ignored:
-                image.surface.load()
-                # And redo the whole matrix stuff ...
-                # XXX: It would be better to manipulate the matrix instead.
                 try:
-                    image.recognize.calculate_matrix()
+                    image.recognize.rotate()
                 except RecognitionError:
                     if duplex_mode:
                         log.warn(_('%s, %i: Matrix not recognized (again).') % (image.filename, image.tiff_page + 1))
@@ -285,6 +346,68 @@ class Sheet(model.buddy.Buddy, metaclass=model.buddy.Register):
         for image in self.obj.images:
             image.recognize.clean()
 
+    def update_fingerprint(self):
+        """Store the fingerprint of the images and settings that the sheet
+        is recognized with. The pages are not read for this, the checksum is
+        the one calculated by :py:meth:`needs_recognition`, or the previous
+        one if the file was not touched. Otherwise it is None."""
+        previous = dict()
+        if self.obj.fingerprint is not None:
+            for stored in self.obj.fingerprint['images']:
+                if stored is not None:
+                    previous[tuple(stored[:4])] = stored[4]
+
+        images = []
+        for img in self.obj.images:
+            current = image_fingerprint(img, checksum=False)
+            if current is not None:
+                key = tuple(current[:4])
+                current[4] = _page_checksums.pop(key, previous.get(key))
+            images.append(current)
+
+        self.obj.fingerprint = {
+            'settings': settings_fingerprint(self.obj.survey),
+            'images': images,
+        }
+
+    def needs_recognition(self):
+        """Whether the sheet has not been recognized yet, or its images or
+        the settings changed since. Verified sheets are only recognized again
+        if the images changed, so that manual changes are not thrown away
+        otherwise. Recognized sheets without a fingerprint are redone."""
+        fingerprint = self.obj.fingerprint
+
+        if not (self.obj.recognized or self.obj.verified):
+            return True
+        if fingerprint is None:
+            return not self.obj.verified
+
+        stored_images = fingerprint['images']
+        if len(stored_images) != len(self.obj.images):
+            return True
+
+        for img, stored in zip(self.obj.images, stored_images):
+            # Only calculate the checksum if the file has been touched
+            current = image_fingerprint(img, checksum=False)
+            if current is None or stored is None or current[:2] != stored[:2]:
+                return True
+            if current[2:4] == stored[2:4]:
+                continue
+
+            # Without a stored checksum the file counts as changed. The
+            # checksum is still remembered for update_fingerprint.
+            current = image_fingerprint(img)
+            if current is None:
+                return True
+            _page_checksums[tuple(current[:4])] = current[4]
+            if current[4] != stored[4]:
+                return True
+
+        if self.obj.verified:
+            return False
+
+        return fingerprint['settings'] != settings_fingerprint(self.obj.survey)
+
     def duplex_copy_image_attr(self, failed_pages, attr, error_msg=None):
         """If in duplex mode, this function will copy the given attribute
         from the image that defines it over to the one that does not.
@@ -316,6 +439,67 @@ class Sheet(model.buddy.Buddy, metaclass=model.buddy.Register):
             return img if img == self.filter_image else None
         return img
 
+    def recognize_checkboxes(self, checkboxes, full=None):
+        """Recognize the given checkboxes. All the boxes on one page are
+        analyzed with a single call into the image module.
+
+        :param full: Calculate all metrics, even if they cannot change the
+                     result. Defaults to ``defs.checkbox_metrics_full``.
+        """
+        if full is None:
+            full = defs.checkbox_metrics_full
+
+        if full:
+            final_ranges = None
+        else:
+            final_ranges = coverage_final_ranges(self.obj.survey.defs.checkmode)
+
+        pages = {}
+        for box in checkboxes:
+            img = self.get_page_image(box.page_number)
+
+            if img is None or img.recognize.matrix is None:
+                continue
+
+            pages.setdefault(box.page_number, (img, []))[1].append(box)
+
+        for img, boxes in pages.values():
+            matrix = img.recognize.matrix
+
+            # This is not the outline, but the width of the drawn stroke!
+            remove_line_width = 1.2 * pt_to_mm
+            remove_line_width_px = max(matrix.transform_distance(remove_line_width, remove_line_width))
+
+            descriptions = []
+            for box in boxes:
+                outline, outline_xoff, outline_yoff = box.recognize.get_outline_mask()
+                inner, inner_xoff, inner_yoff = box.recognize.get_inner_mask()
+
+                descriptions.append((outline, outline_xoff, outline_yoff,
+                                     inner, inner_xoff, inner_yoff,
+                                     box.x, box.y))
+
+            results = image.get_checkbox_metrics(img.surface.surface, matrix,
+                                                 descriptions, remove_line_width_px,
+                                                 final_ranges)
+
+            for box, (x, y, covered, coverage, cov_lines_removed, cov_min_size) in zip(boxes, results):
+                box.data.x = x
+                box.data.y = y
+                box.data.width = box.width
+                box.data.height = box.height
+
+                box.data.metrics['coverage'] = coverage
+                if cov_lines_removed is None:
+                    # Skipped, drop values from an earlier run
+                    box.data.metrics.pop('cov-lines-removed', None)
+                    box.data.metrics.pop('cov-min-size', None)
+                else:
+                    box.data.metrics['cov-lines-removed'] = cov_lines_removed
+                    box.data.metrics['cov-min-size'] = cov_min_size
+
+                box.recognize.classify(covered)
+
 
 class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
 
@@ -325,6 +509,9 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
     def __init__(self, *args):
         model.buddy.Buddy.__init__(self, *args)
 
+        self._barcode_surface = None
+        self._barcodes = {}
+
         if self.obj.sheet.survey.defs.style == "classic":
             from . import classic
         elif self.obj.sheet.survey.defs.style == "code128":
@@ -370,8 +557,52 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
             self.obj.global_id = self.obj.style.get_global_id()
 
     def clean(self):
+        self._barcode_surface = None
+        self._barcodes = {}
         self.obj.surface.clean()
 
+    def corner_mark_box(self):
+        """The bounding box (x, y, width, height) of the corner marks in mm."""
+        survey_defs = self.obj.sheet.survey.defs
+
+        return (survey_defs.corner_mark_left, survey_defs.corner_mark_top,
+                survey_defs.paper_width - survey_defs.corner_mark_left - survey_defs.corner_mark_right,
+                survey_defs.paper_height - survey_defs.corner_mark_top - survey_defs.corner_mark_bottom)
+
+    def identify_rows(self):
+        """The pixel row ranges of the unrotated image that are needed to
+        identify it, or None if the style cannot tell. These are bands at the
+        top and bottom of the image for the corner mark search and the
+        regions returned by the styles get_identify_regions. All ranges are
+        mirrored, so that they stay valid if the image turns out to be
+        rotated."""
+        get_regions = getattr(self.obj.style, 'get_identify_regions', None)
+        if get_regions is None:
+            return None
+
+        regions = get_regions()
+        if regions is None:
+            return None
+
+        width, height = self.obj.surface.get_size()
+        mm_to_px = self.obj.matrix.mm_to_px()
+        margin = defs.identify_partial_margin
+
+        # The corner marks are searched starting at the edges of the image
+        corner_px = abs(mm_to_px.transform_distance(
+            0, defs.corner_mark_search_distance + defs.corner_mark_max_length + margin)[1])
+        rows = [(0, int(math.ceil(corner_px)))]
+
+        for x, y, w, h in regions:
+            top = mm_to_px.transform_point(x, y - margin)[1]
+            bottom = mm_to_px.transform_point(x, y + h + margin)[1]
+            top, bottom = min(top, bottom), max(top, bottom)
+            rows.append((max(0, int(math.floor(top))), min(height - 1, int(math.ceil(bottom)))))
+
+        rows.extend([(height - 1 - last, height - 1 - first) for first, last in rows])
+
+        return rows
+
     def calculate_matrix(self):
         if self.obj.ignored:
             self.obj.matrix.set_px_to_mm(None)
@@ -382,19 +613,47 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
             # matrix for the resolution estimation.
             self.obj.matrix.set_px_to_mm(None)
 
-            matrix = image.calculate_matrix(
-                self.obj.surface.surface,
-                self.obj.matrix.mm_to_px(),
-                self.obj.sheet.survey.defs.corner_mark_left, self.obj.sheet.survey.defs.corner_mark_top,
-                self.obj.sheet.survey.defs.paper_width - self.obj.sheet.survey.defs.corner_mark_left - self.obj.sheet.survey.defs.corner_mark_right,
-                self.obj.sheet.survey.defs.paper_height - self.obj.sheet.survey.defs.corner_mark_top - self.obj.sheet.survey.defs.corner_mark_bottom,
-            )
+            surf = self.obj.surface.surface
+            if _warm_start_corners is not None:
+                key = (self.obj.filename, surf.get_width(), surf.get_height())
+                hints = _warm_start_corners.get(key)
+            else:
+                hints = None
+
+            corners = image.find_corner_markers(surf, self.obj.matrix.mm_to_px(), hints)
+            # The list is modified to contain an estimate for a missing corner
+            matrix = image.matrix_from_corners_2d(list(corners), *self.corner_mark_box())
+
+            if _warm_start_corners is not None:
+                _warm_start_corners[key] = corners
         except AssertionError:
             self.obj.matrix.set_px_to_mm(None)
             raise RecognitionError
         else:
             self.obj.matrix.set_px_to_mm(matrix)
 
+    def rotate(self):
+        """Rotate the loaded surface by 180 degree in place. This needs to
+        be done after the image has been detected as rotated, so that the
+        surface matches what :py:meth:`surface.Image.load` returns.
+
+        The matrix is rotated too if it is known, otherwise it is detected
+        again (raising a RecognitionError if that fails)."""
+        surface = self.obj.surface.surface
+        image.rotate_180(surface)
+
+        # The surface object stays the same, but the content changed
+        self._barcode_surface = None
+        self._barcodes = {}
+
+        matrix = self.obj.matrix.px_to_mm(fallback=False)
+        if matrix is None:
+            self.calculate_matrix()
+        else:
+            self.obj.matrix.set_px_to_mm(image.rotate_matrix_180(
+                matrix, surface.get_width(), surface.get_height(),
+                *self.corner_mark_box()))
+
     def get_coverage(self, x, y, width, height):
         assert(not self.obj.ignored)
 
@@ -441,6 +700,30 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
             x, y
         )
 
+    def read_barcode(self, x, y, width, height, btype="CODE128"):
+        """Read a barcode in the given area (in mm) using the fallback matrix.
+        The result is cached for each area until the surface is reloaded or
+        the matrix changes, so that each barcode only needs to be decoded once
+        even if it is used for multiple pieces of information."""
+        assert(not self.obj.ignored)
+
+        surface = self.obj.surface.surface
+        matrix = self.obj.matrix.mm_to_px()
+
+        if self._barcode_surface is not surface:
+            self._barcode_surface = surface
+            self._barcodes = {}
+
+        key = (tuple(matrix), x, y, width, height, btype)
+        try:
+            return self._barcodes[key]
+        except KeyError:
+            pass
+
+        code = read_barcode(surface, matrix, x, y, width, height, btype)
+        self._barcodes[key] = code
+        return code
+
     def find_box_corners(self, x, y, width, height):
         assert(not self.obj.ignored)
 
@@ -473,9 +756,10 @@ class Questionnaire(model.buddy.Buddy, metaclass=model.buddy.Register):
     obj_class = model.questionnaire.Questionnaire
 
     def identify(self, clean=True):
-        # recognize image
+        # recognize image, if the images are not used afterwards it is enough
+        # to only decode the parts needed for identification
         try:
-            self.obj.sheet.recognize.recognize()
+            self.obj.sheet.recognize.recognize(partial=clean and defs.identify_partial_load)
             result = True
 
             # Mark sheet as invalid if any page is missing,
@@ -511,8 +795,15 @@ class Questionnaire(model.buddy.Buddy, metaclass=model.buddy.Register):
         if res:
             # iterate over qobjects
             self.obj.sheet.recognize.filter_image = image
+
+            # All checkboxes are done together
+            checkboxes = []
             for qobject in self.obj.qobjects:
-                qobject.recognize.recognize()
+                checkboxes.extend(qobject.recognize.get_checkboxes())
+            self.obj.sheet.recognize.recognize_checkboxes(checkboxes)
+
+            for qobject in self.obj.qobjects:
+                qobject.recognize.recognize(checkboxes=False)
             self.obj.sheet.recognize.filter_image = None
 
             quality = 1
@@ -523,6 +814,8 @@ class Questionnaire(model.buddy.Buddy, metaclass=model.buddy.Register):
         # Mark the image as "recognized". It might have failed, but even if that
         # happened, we don't want to retry all the time.
         self.obj.sheet.recognized = True
+        # Remember the inputs, so that incremental runs can skip the sheet
+        self.obj.sheet.recognize.update_fingerprint()
         # Any newly recognized sheet is definately not verified.
         # This is relevant for reruns.
         for img in self.obj.sheet.images:
@@ -537,83 +830,102 @@ class QObject(model.buddy.Buddy, metaclass=model.buddy.Register):
     name = 'recognize'
     obj_class = model.questionnaire.QObject
 
-    def recognize(self):
+    def recognize(self, checkboxes=True):
+        """Recognize the object. If *checkboxes* is False, then the boxes
+        returned by :py:meth:`get_checkboxes` are skipped, because they have
+        been recognized already."""
         pass
 
-    def get_quality(self):
-        return 1
-
-
-class Question(model.buddy.Buddy, metaclass=model.buddy.Register):
-
-    name = 'recognize'
-    obj_class = model.questionnaire.Question
-
-    def recognize(self):
-        # iterate over boxes
-        for box in self.obj.boxes:
-            box.recognize.recognize()
+    def get_checkboxes(self):
+        return []
 
     def get_quality(self):
-        result = 1
-        for box in self.obj.boxes:
-            result = min(result, box.data.quality)
-        return result
-
-
-class Box(model.buddy.Buddy, metaclass=model.buddy.Register):
-
-    name = 'recognize'
-    obj_class = model.questionnaire.Box
-
-    def recognize(self):
-        pass
+        return 1
 
 
-class Checkbox(Box, metaclass=model.buddy.Register):
+def coverage_final_ranges(checkmode):
+    """Returns a list of (lower, upper) coverage ranges in which the coverage
+    metric gives at least the quality that any of the other metrics can
+    give. The other metrics cannot change the result of
+    :py:meth:`Checkbox.classify` in these ranges, as it only replaces the
+    result of the first metric in :py:data:`defs.checkbox_metrics` (coverage)
+    with a strictly better one."""
+    # The definitions may be changed at runtime, so they are part of the key
+    metrics = defs.checkbox_metrics[checkmode]
+    key = tuple((metric, tuple(tuple(point) for point in points))
+                for metric, points in metrics.items())
+    return _coverage_final_ranges(key)
+
+
+@functools.lru_cache()
+def _coverage_final_ranges(metrics):
+    metrics = dict(metrics)
+    assert next(iter(metrics)) == 'coverage'
+
+    best = max(point[2] for metric, points in metrics.items() if metric != 'coverage'
+               for point in points)
+
+    ranges = []
+    points = metrics['coverage']
+    for lower, upper in zip(points[:-1], points[1:]):
+        if lower[2] == upper[2]:
+            # The interpolation is exact
+            if lower[2] >= best:
+                ranges.append((lower[0], upper[0]))
+            continue
+
+        # Be conservative, the interpolation is not exact
+        threshold = best + 1e-9
+        if lower[2] < threshold and upper[2] < threshold:
+            continue
+
+        # The value at which the threshold is crossed
+        cross = lower[0] + (upper[0] - lower[0]) * (threshold - lower[2]) / (upper[2] - lower[2])
+        if lower[2] >= threshold and upper[2] >= threshold:
+            ranges.append((lower[0], upper[0]))
+        elif lower[2] >= threshold:
+            ranges.append((lower[0], cross))
+        else:
+            ranges.append((cross, upper[0]))
 
-    name = 'recognize'
-    obj_class = model.questionnaire.Checkbox
+    return ranges
 
-    def prepare_mask(self):
-        img = self.obj.sheet.recognize.get_page_image(self.obj.page_number)
-        width, height = self.obj.width, self.obj.height
-        line_width = self.obj.lw
 
-        matrix = list(img.recognize.matrix)
-        # Remove any offset from the matrix
-        matrix[4] = 0
-        matrix[5] = 0
-        matrix = cairo.Matrix(*matrix)
+@functools.lru_cache(maxsize=256)
+def render_checkbox_mask(inner, form, width, height, line_width, linear):
+    """Render the A1 mask of the outline or (if *inner* is set) the inside of
+    a checkbox. *linear* is the linear part of the page matrix as a tuple.
 
-        px_width, px_height = matrix.transform_distance(width, height)
-        px_width, px_height = int(math.ceil(px_width)), int(math.ceil(px_height))
+    The masks are cached, so the returned surface must not be modified.
 
-        surf = cairo.ImageSurface(cairo.FORMAT_A1, px_width, px_height)
-        cr = cairo.Context(surf)
-        cr.set_source_rgba(0, 0, 0, 0)
-        cr.set_operator(cairo.OPERATOR_SOURCE)
-        cr.paint()
+    :return: The mask surface and the x and y offset of the box in it (in mm).
+    """
+    matrix = cairo.Matrix(*linear)
 
-        # Move to center and apply matrix
-        cr.translate(0.5 * px_width, 0.5 * px_height)
-        cr.transform(matrix)
+    px_width, px_height = matrix.transform_distance(width, height)
+    px_width, px_height = int(math.ceil(px_width)), int(math.ceil(px_height))
 
-        cr.set_source_rgba(0, 0, 0, 1)
+    surf = cairo.ImageSurface(cairo.FORMAT_A1, px_width, px_height)
+    cr = cairo.Context(surf)
+    cr.set_source_rgba(0, 0, 0, 0)
+    cr.set_operator(cairo.OPERATOR_SOURCE)
+    cr.paint()
 
-        cr.set_line_width(line_width)
+    # Move to center and apply matrix
+    cr.translate(0.5 * px_width, 0.5 * px_height)
+    cr.transform(matrix)
 
-        matrix.invert()
-        xoff, yoff = matrix.transform_distance(px_width / 2.0, px_height / 2.0)
-        xoff = xoff - width / 2
-        yoff = yoff - height / 2
+    cr.set_source_rgba(0, 0, 0, 1)
 
-        return cr, surf, line_width, width, height, xoff, yoff
+    cr.set_line_width(line_width)
 
-    def get_outline_mask(self):
-        cr, surf, line_width, width, height, xoff, yoff = self.prepare_mask()
+    matrix.invert()
+    xoff, yoff = matrix.transform_distance(px_width / 2.0, px_height / 2.0)
+    xoff = xoff - width / 2
+    yoff = yoff - height / 2
 
-        if self.obj.form == "ellipse":
+    if not inner:
+        if form == "ellipse":
             cr.save()
 
             cr.scale((width - line_width) / 2.0, (height - line_width) / 2.0)
@@ -626,16 +938,9 @@ class Checkbox(Box, metaclass=model.buddy.Register):
             cr.rectangle(line_width / 2, line_width / 2, width - line_width / 2, height - line_width / 2)
 
         cr.stroke()
-        surf.flush()
-        del cr
-
-        return surf, xoff, yoff
-
-    def get_inner_mask(self):
-        """Note this discards half a line width inside the box!"""
-        cr, surf, line_width, width, height, xoff, yoff = self.prepare_mask()
-
-        if self.obj.form == "ellipse":
+    else:
+        # Note this discards half a line width inside the box!
+        if form == "ellipse":
             cr.save()
 
             cr.scale((width - 3*line_width) / 2.0, (height - 3*line_width) / 2.0)
@@ -648,13 +953,83 @@ class Checkbox(Box, metaclass=model.buddy.Register):
             cr.rectangle(1.5 * line_width, 1.5 * line_width, width - 3 * line_width, height - 3 * line_width)
 
         cr.fill()
-        surf.flush()
-        del cr
 
-        return surf, xoff, yoff
+    surf.flush()
+    del cr
 
+    return surf, xoff, yoff
+
+
+class Question(model.buddy.Buddy, metaclass=model.buddy.Register):
+
+    name = 'recognize'
+    obj_class = model.questionnaire.Question
+
+    def recognize(self, checkboxes=True):
+        if checkboxes:
+            self.obj.sheet.recognize.recognize_checkboxes(self.get_checkboxes())
+
+        # iterate over the other boxes
+        for box in self.obj.boxes:
+            if not isinstance(box, model.questionnaire.Checkbox):
+                box.recognize.recognize()
+
+    def get_checkboxes(self):
+        return [box for box in self.obj.boxes if isinstance(box, model.questionnaire.Checkbox)]
+
+    def get_quality(self):
+        result = 1
+        for box in self.obj.boxes:
+            result = min(result, box.data.quality)
+        return result
+
+
+class Box(model.buddy.Buddy, metaclass=model.buddy.Register):
+
+    name = 'recognize'
+    obj_class = model.questionnaire.Box
 
     def recognize(self):
+        pass
+
+
+class Checkbox(Box, metaclass=model.buddy.Register):
+
+    name = 'recognize'
+    obj_class = model.questionnaire.Checkbox
+
+    def get_mask_matrix(self):
+        """Returns the linear part of the page matrix (xx, yx, xy, yy), which
+        is everything that the masks depend on. It is quantized so that
+        boxes on pages with nearly identical matrices share their masks."""
+        img = self.obj.sheet.recognize.get_page_image(self.obj.page_number)
+        precision = defs.checkbox_mask_matrix_precision
+
+        return tuple(round(v / precision) * precision for v in list(img.recognize.matrix)[:4])
+
+    def get_outline_mask(self):
+        return render_checkbox_mask(False, self.obj.form,
+                                    self.obj.width, self.obj.height, self.obj.lw,
+                                    self.get_mask_matrix())
+
+    def get_inner_mask(self):
+        """Note this discards half a line width inside the box!"""
+        return render_checkbox_mask(True, self.obj.form,
+                                    self.obj.width, self.obj.height, self.obj.lw,
+                                    self.get_mask_matrix())
+
+    def recognize(self, debug=False):
+        """Recognize only this checkbox.
+
+        :param debug: Store the debug surfaces of the image module in the
+                      debug attribute (a dictionary with one entry per
+                      metric). Debug surface creation needs to be enabled in
+                      the image module for this (used by boxgallery).
+        """
+        if not debug:
+            self.obj.sheet.recognize.recognize_checkboxes([self.obj])
+            return
+
         img = self.obj.sheet.recognize.get_page_image(self.obj.page_number)
 
         if img is None or img.recognize.matrix is None:
@@ -666,12 +1041,6 @@ class Checkbox(Box, metaclass=model.buddy.Register):
             self.obj.x, self.obj.y,
             surf
         )
-        # Calculate some sort of quality for the checkbox position
-        if covered < defs.image_line_coverage:
-            pos_quality = 0
-        else:
-            pos_quality = min(covered + 0.2, 1)
-
         x, y = matrix.transform_point(self.obj.x, self.obj.y)
         width, height = matrix.transform_distance(self.obj.width, self.obj.height)
         self.obj.data.x = x + xoff
@@ -679,8 +1048,8 @@ class Checkbox(Box, metaclass=model.buddy.Register):
         self.obj.data.width = width
         self.obj.data.height = height
 
-        # The debug struct will be filled in if debugging is enabled in the
-        # C library. This is done by the boxgallery script currently.
+        # Every step is a separate call, so that the debug surfaces can be
+        # retrieved.
         self.debug = {}
 
         mask, xoff, yoff = self.get_inner_mask()
@@ -707,11 +1076,27 @@ class Checkbox(Box, metaclass=model.buddy.Register):
         self.obj.data.metrics['cov-min-size'] = coverage
         self.debug['cov-min-size'] = image.get_debug_surface()
 
+        self.classify(covered)
+
+    def classify(self, covered):
+        """Set the state and quality from the metrics. *covered* is how
+        much of the outline was found, which is used for the position
+        quality."""
+        # Calculate some sort of quality for the checkbox position
+        if covered < defs.image_line_coverage:
+            pos_quality = 0
+        else:
+            pos_quality = min(covered + 0.2, 1)
+
         state = 0
         quality = -1
-        # Iterate the ranges
-        for metric, value in self.obj.data.metrics.items():
-            metric = defs.checkbox_metrics[self.obj.sheet.survey.defs.checkmode][metric]
+        values = self.obj.data.metrics
+        # Iterate the ranges, in the order of the definition. The stored
+        # order is not used, so that ties are always resolved the same way.
+        for name, metric in defs.checkbox_metrics[self.obj.sheet.survey.defs.checkmode].items():
+            if name not in values:
+                continue
+            value = values[name]
 
             for lower, upper in zip(metric[:-1], metric[1:]):
                 if value >= lower[0] and value <= upper[0]:
@@ -735,131 +1120,6 @@ class Textbox(Box, metaclass=model.buddy.Register):
     obj_class = model.questionnaire.Textbox
 
     def recognize(self):
-        class Quadrilateral():
-            """This class iterates through small box areas in a quadriliteral.
-            This is usefull because some scanners have trapezoidal distortions."""
-            # Assumes top left, top right, bottom right, bottom left
-            # corner.
-            def __init__(self, p0, p1, p2, p3):
-                self.x0 = p0[0]
-                self.y0 = p0[1]
-                self.x1 = p1[0]
-                self.y1 = p1[1]
-                self.x2 = p2[0]
-                self.y2 = p2[1]
-                self.x3 = p3[0]
-                self.y3 = p3[1]
-
-                # 0 -> 1
-                self.m0 = (self.y1 - self.y0) / (self.x1 - self.x0)
-                self.m1 = (self.x2 - self.x1) / (self.y2 - self.y1)
-                self.m2 = (self.y3 - self.y2) / (self.x3 - self.x2)
-                self.m3 = (self.x0 - self.x3) / (self.y0 - self.y3)
-
-                self.top = min(self.y0, self.y1)
-                self.bottom = max(self.y2, self.y3)
-                self.left = min(self.x0, self.x3)
-                self.right = max(self.x1, self.x2)
-
-            def iterate_bb(self, step_x, step_y, test_width, test_height, padding):
-                y = self.top
-                while y + test_height < self.bottom:
-                    x = self.left
-                    while x + test_width < self.right:
-                        yield x, y
-                        x += step_x
-
-                    y += step_y
-
-            def iterate_outline(self, step_x, step_y, test_width, test_height, padding):
-                # Top
-                x, y = self.x0, self.y0
-                x += padding
-                y += padding
-
-                dest_x = self.x1 - padding - test_width
-                dest_y = self.y1 + padding
-
-                dist_x = dest_x - x
-                dist_y = dest_y - y
-
-                length = math.sqrt(dist_x ** 2 + dist_y ** 2)
-                for step in range(int(length / step_x)):
-                    yield x + dist_x * step / (length / step_x), y + dist_y * step / (length / step_x)
-                yield dest_x, dest_y
-
-                # Bottom
-                x, y = self.x3, self.y3
-                x = x + padding
-                y = y - padding - test_height
-
-                dest_x = self.x2 - padding - test_width
-                dest_y = self.y2 - padding - test_height
-
-                dist_x = dest_x - x
-                dist_y = dest_y - y
-
-                length = math.sqrt(dist_x ** 2 + dist_y ** 2)
-                for step in range(int(length / step_x)):
-                    yield x + dist_x * step / (length / step_x), y + dist_y * step / (length / step_x)
-                yield dest_x, dest_y
-
-                # Left
-                x, y = self.x0, self.y0
-                x += padding
-                y += padding
-
-                dest_x = self.x3 + padding
-                dest_y = self.y3 - padding - test_height
-
-                dist_x = dest_x - x
-                dist_y = dest_y - y
-
-                length = math.sqrt(dist_x ** 2 + dist_y ** 2)
-                for step in range(int(length / step_y)):
-                    yield x + dist_x * step / (length / step_y), y + dist_y * step / (length / step_y)
-                yield dest_x, dest_y
-
-                # Right
-                x, y = self.x1, self.y1
-                x = x - padding - test_width
-                y = y + padding
-
-                dest_x = self.x2 - padding - test_width
-                dest_y = self.y2 - padding - test_height
-
-                dist_x = dest_x - x
-                dist_y = dest_y - y
-
-                length = math.sqrt(dist_x ** 2 + dist_y ** 2)
-                for step in range(int(length / step_y)):
-                    yield x + dist_x * step / (length / step_y), y + dist_y * step / (length / step_y)
-                yield dest_x, dest_y
-
-            def iterate(self, step_x, step_y, test_width, test_height, padding):
-                for x, y in self.iterate_bb(step_x, step_y, test_width, test_height, padding):
-                    ly = self.y0 + self.m0 * (x - self.x0)
-                    if not ly + padding < y:
-                        continue
-
-                    ly = self.y2 + self.m2 * (x - self.x2)
-                    if not ly - padding > y + test_height:
-                        continue
-
-                    lx = self.x1 + self.m1 * (y - self.y1)
-                    if not lx - padding > x + test_width:
-                        continue
-
-                    lx = self.x3 + self.m3 * (y - self.y3)
-                    if not lx + padding < x:
-                        continue
-
-                    yield x, y
-
-                for x, y in self.iterate_outline(step_x, step_y, test_width, test_height, padding):
-                    yield x, y
-
-        bbox = None
         img = self.obj.sheet.recognize.get_page_image(self.obj.page_number)
 
         if img is None or img.recognize.matrix is None:
@@ -880,29 +1140,27 @@ class Textbox(Box, metaclass=model.buddy.Register):
         extra_padding = defs.textbox_extra_padding
         scan_padding = defs.textbox_scan_uncorrected_padding
 
-        quad = Quadrilateral((x, y), (x + width, y), (x + width, y + height), (x, y + height))
+        # Assumes top left, top right, bottom right, bottom left corner.
+        # Some scanners have trapezoidal distortions, so use the real corners
+        # if they can be found.
+        corners = ((x, y), (x + width, y), (x + width, y + height), (x, y + height))
         try:
-            quad = Quadrilateral(*img.recognize.find_box_corners(x, y, width, height))
+            corners = img.recognize.find_box_corners(x, y, width, height)
             # Lower padding, as we found the corners and are therefore more acurate
             scan_padding = defs.textbox_scan_padding
         except AssertionError:
             pass
 
-        surface = img.surface.surface
-        matrix = img.recognize.matrix
-        for x, y in quad.iterate(step_x, step_y, test_width, test_height, scan_padding):
-            # Use the image module directly as we are calling in *a lot*
-            coverage = image.get_coverage(surface, matrix, x, y, test_width, test_height)
-            if coverage > defs.textbox_scan_coverage:
-                if not bbox:
-                    bbox = [x, y, test_width, test_height]
-                else:
-                    bbox_x = min(bbox[0], x)
-                    bbox_y = min(bbox[1], y)
-                    bbox[2] = max(bbox[0] + bbox[2], x + test_width) - bbox_x
-                    bbox[3] = max(bbox[1] + bbox[3], y + test_height) - bbox_y
-                    bbox[0] = bbox_x
-                    bbox[1] = bbox_y
+        # Use the image module directly, this tests *a lot* of small areas
+        # inside the quadrilateral and along its outline.
+        bbox = image.find_textbox_writing(img.surface.surface,
+                                          img.recognize.matrix,
+                                          corners,
+                                          step_x, step_y,
+                                          test_width, test_height,
+                                          scan_padding,
+                                          defs.textbox_scan_coverage,
+                                          defs.textbox_scan_integral_image)
 
         if bbox and (bbox[2] > defs.textbox_minimum_writing_width or
                      bbox[3] > defs.textbox_minimum_writing_height):
@@ -97,6 +97,24 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
         # The classic style does not support a global ID property.
         return None
 
+    def get_identify_regions(self):
+        # Returns the regions (x, y, width, height in mm) that are read to
+        # identify the page, or None if the whole page is needed
+
+        survey_defs = self.obj.sheet.survey.defs
+        paper_width = survey_defs.paper_width
+        paper_height = survey_defs.paper_height
+
+        # The corner boxes at the top, and the corner boxes and codeboxes at
+        # the bottom of the page.
+        top = survey_defs.corner_mark_top + defs.corner_box_padding + defs.corner_box_height
+        bottom = paper_height - survey_defs.corner_mark_bottom - defs.corner_box_padding - defs.corner_box_height
+        if survey_defs.print_survey_id or survey_defs.print_questionnaire_id:
+            bottom = min(bottom, survey_defs.get_questionnaire_id_pos()[2])
+
+        return [(0, 0, paper_width, top),
+                (0, bottom, paper_width, paper_height - bottom)]
+
 
 ############################
 # Internal Helpers
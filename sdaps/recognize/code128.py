@@ -19,7 +19,6 @@ from sdaps import defs
 
 from sdaps import model
 from sdaps.utils.exceptions import RecognitionError
-from sdaps.utils.barcode import read_barcode
 
 
 # Reading the metainformation of CODE-128 style questionnaires. See classic.py
@@ -45,7 +44,7 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
         # Note that we cannot find another barcode this way, because the one in the
         # center of the page is not complete
         code = \
-            read_barcode(self.obj.surface.surface, self.obj.matrix.mm_to_px(),
+            self.obj.recognize.read_barcode(
                          paper_width / 2,
                          paper_height - self.obj.sheet.survey.defs.corner_mark_bottom - defs.code128_vpad - defs.code128_height - 5,
                          paper_width / 2,
@@ -54,7 +53,7 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
         if code is None:
             # Well, that failed, so try to search the upper left corner instead
             code = \
-                read_barcode(self.obj.surface.surface, self.obj.matrix.mm_to_px(),
+                self.obj.recognize.read_barcode(
                              0, 0,
                              paper_width / 2,
                              self.obj.sheet.survey.defs.corner_mark_bottom + defs.code128_vpad + defs.code128_height + 5)
@@ -76,7 +75,7 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
 
         # Search for the barcode in the lower right corner.
         code = \
-            read_barcode(self.obj.surface.surface, self.obj.matrix.mm_to_px(),
+            self.obj.recognize.read_barcode(
                          paper_width / 2,
                          paper_height - self.obj.sheet.survey.defs.corner_mark_bottom - defs.code128_vpad - defs.code128_height - 5,
                          paper_width / 2,
@@ -99,7 +98,7 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
 
         # Search for the barcode in the lower left corner.
         code = \
-            read_barcode(self.obj.surface.surface, self.obj.matrix.mm_to_px(),
+            self.obj.recognize.read_barcode(
                          paper_width / 2,
                          paper_height - self.obj.sheet.survey.defs.corner_mark_bottom - defs.code128_vpad - defs.code128_height - 5,
                          paper_width / 2,
@@ -119,7 +118,7 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
 
         # Search for the barcode on the bottom left of the page
         code = \
-            read_barcode(self.obj.surface.surface, self.obj.matrix.mm_to_px(),
+            self.obj.recognize.read_barcode(
                          0,
                          paper_height - self.obj.sheet.survey.defs.corner_mark_bottom - defs.code128_vpad - defs.code128_height - 5,
                          paper_width / 2,
@@ -138,7 +137,7 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
 
         # Search for the barcode in the bottom center of the page
         code = \
-            read_barcode(self.obj.surface.surface, self.obj.matrix.mm_to_px(),
+            self.obj.recognize.read_barcode(
                          paper_width / 4,
                          paper_height - self.obj.sheet.survey.defs.corner_mark_bottom - defs.code128_vpad - defs.code128_height - 5,
                          paper_width / 2,
@@ -146,3 +145,15 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
 
         # Simply return the code, it may be alphanumeric, we don't care here
         return code
+
+    def get_identify_regions(self):
+        # Returns the regions (x, y, width, height in mm) that are read to
+        # identify the page, or None if the whole page is needed
+
+        paper_width = self.obj.sheet.survey.defs.paper_width
+        paper_height = self.obj.sheet.survey.defs.paper_height
+        height = self.obj.sheet.survey.defs.corner_mark_bottom + defs.code128_vpad + defs.code128_height + 5
+
+        # The barcodes at the bottom, and the top for the rotation check
+        return [(0, 0, paper_width, height),
+                (0, paper_height - height, paper_width, height)]
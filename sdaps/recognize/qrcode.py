@@ -21,7 +21,6 @@ from sdaps import defs
 
 from sdaps import model
 from sdaps.utils.exceptions import RecognitionError
-from sdaps.utils.barcode import read_barcode
 
 
 class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
@@ -64,8 +63,13 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
     def get_global_id(self):
         return self.find_bottom_center_barcode()
 
+    def get_identify_regions(self):
+        # The barcodes are searched in the top and bottom quarter of the page
+        return [(0, 0, self.paper_width(), self.paper_height() * 0.25),
+                (0, self.paper_height() * 0.75, self.paper_width(), self.paper_height() * 0.25)]
+
     def find_bottom_right_barcode(self):
-      return read_barcode(self.obj.surface.surface, self.obj.matrix.mm_to_px(),
+      return self.obj.recognize.read_barcode(
                  self.paper_width() * 0.75,
                  self.paper_height() * 0.75,
                  self.paper_width() * 0.25,
@@ -73,14 +77,14 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
                  "QRCODE")
 
     def find_top_left_barcode(self):
-      return read_barcode(self.obj.surface.surface, self.obj.matrix.mm_to_px(),
+      return self.obj.recognize.read_barcode(
                      0, 0,
                      self.paper_width() * 0.25,
                      self.paper_height() * 0.25,
                      "QRCODE")
 
     def find_bottom_left_barcode(self):
-      return read_barcode(self.obj.surface.surface, self.obj.matrix.mm_to_px(),
+      return self.obj.recognize.read_barcode(
                      0,
                      self.paper_height() * 0.75,
                      self.paper_width() * 0.25,
@@ -88,7 +92,7 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
                      "QRCODE")
 
     def find_bottom_center_barcode(self):
-      return read_barcode(self.obj.surface.surface, self.obj.matrix.mm_to_px(),
+      return self.obj.recognize.read_barcode(
                      self.paper_width() * 0.375,
                      self.paper_height() * 0.75,
                      self.paper_width() * 0.25,
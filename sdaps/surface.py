@@ -22,10 +22,133 @@ to the model.sheet.Image and provides the surface via
 model.sheet.Image.surface.surface at runtime.
 """
 
+import collections
+import concurrent.futures
+
 from . import model
 from . import image
 
 
+class Prefetcher(object):
+    """Decodes the pages of the following sheets in background threads while
+    the current sheet is being processed. The image module releases the GIL,
+    so this overlaps the I/O and decoding with the recognition.
+
+    Which pages are decoded is set using :py:meth:`schedule`, see
+    :py:func:`prefetch_sheets`. Pages are always decoded unrotated, rotation
+    is done in memory if needed.
+
+    :param count: The maximum number of pages that are decoded in advance.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(count, 2))
+        self._pending = {}
+
+    def get_a1(self, filename, page, rotated):
+        """Returns the A1 surface of the page, using the prefetched one if
+        it was scheduled."""
+        future = self._pending.pop((filename, page), None)
+
+        surface = None
+        if future is not None:
+            try:
+                surface = future.result()
+            except AssertionError:
+                # Load it again below to raise the error in the right place
+                pass
+
+        if surface is None:
+            return image.get_a1_from_tiff(filename, page, rotated)
+
+        if rotated:
+            image.rotate_180(surface)
+        return surface
+
+    def schedule(self, pages):
+        """Decode the given (filename, page) pairs in the background, in
+        order. Pending pages that are not in the list are dropped."""
+        pages = list(pages)
+        wanted = set(pages)
+
+        # Throw away anything that is not going to be used anymore
+        for key in list(self._pending.keys()):
+            if key not in wanted:
+                self._pending.pop(key).cancel()
+
+        for key in pages:
+            if key not in self._pending:
+                self._pending[key] = \
+                    self._executor.submit(image.get_a1_from_tiff, key[0], key[1], False)
+
+    def close(self):
+        """Stops all background work."""
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = {}
+        self._executor.shutdown(wait=True)
+
+
+_prefetcher = None
+
+def start_prefetch(count):
+    """Start decoding up to *count* pages in advance when images are loaded.
+    Must be stopped again using :py:func:`stop_prefetch`. Do not fork while
+    prefetching is active."""
+    global _prefetcher
+
+    stop_prefetch()
+    if count > 0:
+        _prefetcher = Prefetcher(count)
+
+def stop_prefetch():
+    """Stop prefetching pages."""
+    global _prefetcher
+
+    if _prefetcher is not None:
+        _prefetcher.close()
+        _prefetcher = None
+
+def _sheet_pages(sheet):
+    return [(sheet.survey.path(img.filename), img.tiff_page)
+            for img in sheet.images if not img.ignored]
+
+def prefetch_sheets(sheets):
+    """Yield the sheets from the iterable *sheets*, and schedule the pages of
+    the sheets that come next to be decoded in the background. Only the
+    sheets that are actually going to be processed should be passed, i.e.
+    the ones of the rowids returned by
+    :py:meth:`model.survey.Survey.prefilter_rowids`. Does nothing unless
+    prefetching was started using :py:func:`start_prefetch`."""
+    prefetcher = _prefetcher
+    if prefetcher is None:
+        yield from sheets
+        return
+
+    sheets = iter(sheets)
+    # The current sheet and the following ones, with their pages
+    ahead = collections.deque()
+    while True:
+        if not ahead:
+            sheet = next(sheets, None)
+            if sheet is None:
+                return
+            ahead.append((sheet, _sheet_pages(sheet)))
+
+        current = len(ahead[0][1])
+        while sum(len(pages) for sheet, pages in ahead) < current + prefetcher.count:
+            sheet = next(sheets, None)
+            if sheet is None:
+                break
+            ahead.append((sheet, _sheet_pages(sheet)))
+
+        pages = [page for sheet, pages in ahead for page in pages]
+        prefetcher.schedule(pages[:current + prefetcher.count])
+
+        yield ahead.popleft()[0]
+
+
 class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
     """
     Buddy to load and cache image data. Do not forget to call :py:meth:`clean`
@@ -43,12 +166,34 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
         attribute.
         :py:meth`clean` needs to be called when the surface is
         no longer needed."""
+        if _prefetcher is not None:
+            self.surface = prefetcher.get_a1(
+                self.obj.sheet.survey.path(self.obj.filename),
+                self.obj.tiff_page,
+                True if self.obj.rotated else False
+            )
+            return
+
         self.surface = image.get_a1_from_tiff(
             self.obj.sheet.survey.path(self.obj.filename),
             self.obj.tiff_page,
             True if self.obj.rotated else False
         )
 
+    def load_partial(self, rows):
+        """Load the A1 cairo surface, but only decode the TIFF strips that
+        contain the given pixel rows. *rows* is a list of (first, last) row
+        ranges (inclusive), everything outside of them is left white. This is
+        only useful if nothing else is looked at, e.g. to read the IDs.
+        :py:meth:`clean` needs to be called when the surface is
+        no longer needed."""
+        self.surface = image.get_a1_from_tiff(
+            self.obj.sheet.survey.path(self.obj.filename),
+            self.obj.tiff_page,
+            True if self.obj.rotated else False,
+            rows
+        )
+
     def load_rgb(self):
         """Load the RGB24 cairo surface, which is accessible using the
         surface_rgb attribute.
@@ -73,13 +218,16 @@ class Image(model.buddy.Buddy, metaclass=model.buddy.Register):
 
     def get_size(self):
         """Read the size of the surface. If the surface is already loaded, it
-        will read the size from that. If it is not loaded, an uncached load will
-        be done, which may be rather slow."""
-        # Load uncached does not check the rgb surface
+        will read the size from that. If it is not loaded, the size is read
+        from the TIFF file without decoding the image."""
         if hasattr(self, 'surface_rgb'):
             s = self.surface_rgb
+        elif hasattr(self, 'surface'):
+            s = self.surface
         else:
-            s = self.load_uncached()
+            return image.get_tiff_size(
+                self.obj.sheet.survey.path(self.obj.filename),
+                self.obj.tiff_page)
         return s.get_width(), s.get_height()
 
     def clean(self):
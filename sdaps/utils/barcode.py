@@ -23,6 +23,8 @@ from sdaps.utils.ugettext import ugettext, ungettext
 _ = ugettext
 
 import os
+import ctypes
+import ctypes.util
 import tempfile
 import cairo
 import subprocess
@@ -76,17 +78,6 @@ def scan(surface, matrix, x, y, width, height, btype="CODE128", kfill=False):
 
         image.kfill_modified(a1_surface, barwidth)
 
-    pbm = image.get_pbm(a1_surface)
-    tmp = tempfile.mktemp(suffix='.png', prefix='sdaps-zbar-')
-    f = open(tmp, 'wb')
-    f.write(pbm)
-    f.close()
-
-    # Is the /dev/stdin sufficiently portable?
-    proc = subprocess.Popen(['zbarimg', '-q', '-Sdisable', '-S%s.enable' % btype.lower(), tmp], stdout=subprocess.PIPE)
-    stdout, stderr = proc.communicate()
-    os.unlink(tmp)
-
     # The following can be used to look at the images
     #rgb_surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
     #cr = cairo.Context(rgb_surface)
@@ -100,6 +91,22 @@ def scan(surface, matrix, x, y, width, height, btype="CODE128", kfill=False):
     #rgb_surface.write_to_png("/tmp/barcode-%03i.png" % b_count)
     #b_count += 1
 
+    return get_decoder()(a1_surface, btype)
+
+
+def decode_zbarimg(a1_surface, btype):
+    """Decode using the zbarimg command line tool."""
+    pbm = image.get_pbm(a1_surface)
+    tmp = tempfile.mktemp(suffix='.png', prefix='sdaps-zbar-')
+    f = open(tmp, 'wb')
+    f.write(pbm)
+    f.close()
+
+    # Is the /dev/stdin sufficiently portable?
+    proc = subprocess.Popen(['zbarimg', '-q', '-Sdisable', '-S%s.enable' % btype.lower(), tmp], stdout=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+    os.unlink(tmp)
+
     if proc.returncode == 4:
         return None
 
@@ -109,4 +116,138 @@ def scan(surface, matrix, x, y, width, height, btype="CODE128", kfill=False):
 
     return barcode.split(b':', 1)[1].decode('utf-8')
 
+
+class ZBarLibrary(object):
+    """Decode barcodes in-process by calling into the zbar library using
+    ctypes. This avoids writing a temporary file and spawning zbarimg for
+    every barcode that is read."""
+
+    # Y800 is 8 bit grayscale
+    _y800 = ord('Y') | ord('8') << 8 | ord('0') << 16 | ord('0') << 24
+
+    def __init__(self):
+        name = ctypes.util.find_library('zbar')
+        if name is None:
+            raise OSError('zbar library not found')
+        lib = ctypes.CDLL(name)
+
+        p = ctypes.c_void_p
+        c_int = ctypes.c_int
+        c_uint = ctypes.c_uint
+        c_ulong = ctypes.c_ulong
+
+        for func, restype, argtypes in [
+                ('zbar_parse_config', c_int, [ctypes.c_char_p, ctypes.POINTER(c_int), ctypes.POINTER(c_int), ctypes.POINTER(c_int)]),
+                ('zbar_image_scanner_create', p, []),
+                ('zbar_image_scanner_destroy', None, [p]),
+                ('zbar_image_scanner_set_config', c_int, [p, c_int, c_int, c_int]),
+                ('zbar_image_create', p, []),
+                ('zbar_image_destroy', None, [p]),
+                ('zbar_image_set_format', None, [p, c_ulong]),
+                ('zbar_image_set_size', None, [p, c_uint, c_uint]),
+                ('zbar_image_set_data', None, [p, p, c_ulong, p]),
+                ('zbar_scan_image', c_int, [p, p]),
+                ('zbar_image_first_symbol', p, [p]),
+                ('zbar_symbol_next', p, [p]),
+                ('zbar_symbol_get_type', c_int, [p]),
+                ('zbar_get_symbol_name', ctypes.c_char_p, [c_int]),
+                ('zbar_symbol_get_data', p, [p]),
+                ('zbar_symbol_get_data_length', c_uint, [p])]:
+            f = getattr(lib, func)
+            f.restype = restype
+            f.argtypes = argtypes
+
+        self._lib = lib
+        # The configured image scanners by barcode type. They are created
+        # lazily, and only used by the process that created them.
+        self._scanners = {}
+        self._pid = None
+
+    def _configure(self, scanner, config):
+        sym, cfg, val = ctypes.c_int(), ctypes.c_int(), ctypes.c_int()
+        if self._lib.zbar_parse_config(config.encode('ascii'), ctypes.byref(sym), ctypes.byref(cfg), ctypes.byref(val)) != 0:
+            raise AssertionError('Invalid zbar configuration %s' % config)
+
+        self._lib.zbar_image_scanner_set_config(scanner, sym, cfg, val)
+
+    def _get_scanner(self, btype):
+        pid = os.getpid()
+        if pid != self._pid:
+            # A forked worker must not share the scanners of its parent
+            self._scanners = {}
+            self._pid = pid
+
+        scanner = self._scanners.get(btype)
+        if scanner is None:
+            scanner = self._lib.zbar_image_scanner_create()
+            # This is the same configuration that is passed to zbarimg
+            try:
+                self._configure(scanner, 'disable')
+                self._configure(scanner, '%s.enable' % btype.lower())
+            except:
+                self._lib.zbar_image_scanner_destroy(scanner)
+                raise
+            self._scanners[btype] = scanner
+
+        return scanner
+
+    def __call__(self, a1_surface, btype):
+        lib = self._lib
+
+        scanner = self._get_scanner(btype)
+        wanted = btype.lower().encode('ascii')
+
+        y800 = image.get_y800(a1_surface)
+
+        img = lib.zbar_image_create()
+        try:
+            lib.zbar_image_set_format(img, self._y800)
+            lib.zbar_image_set_size(img, a1_surface.get_width(), a1_surface.get_height())
+            # No cleanup handler, the buffer stays owned by python
+            lib.zbar_image_set_data(img, y800, len(y800), None)
+
+            if lib.zbar_scan_image(scanner, img) <= 0:
+                return None
+
+            # Only the requested type is enabled, but do not rely on it and
+            # skip any other symbol that is found.
+            symbol = lib.zbar_image_first_symbol(img)
+            while symbol:
+                symbol_type = lib.zbar_get_symbol_name(lib.zbar_symbol_get_type(symbol))
+                if symbol_type.replace(b'-', b'').lower() == wanted:
+                    data = ctypes.string_at(lib.zbar_symbol_get_data(symbol), lib.zbar_symbol_get_data_length(symbol))
+                    return data.decode('utf-8')
+
+                symbol = lib.zbar_symbol_next(symbol)
+
+            return None
+        finally:
+            lib.zbar_image_destroy(img)
+
+
+_decoder = None
+
+def get_decoder():
+    """Returns the function that is used to decode a barcode from an A1
+    surface. Which one is used is configured using defs.barcode_decoder."""
+    global _decoder
+
+    if _decoder is not None:
+        return _decoder
+
+    if defs.barcode_decoder in ('auto', 'library'):
+        try:
+            _decoder = ZBarLibrary()
+        except OSError:
+            if defs.barcode_decoder == 'library':
+                raise
+            _decoder = decode_zbarimg
+    elif defs.barcode_decoder == 'zbarimg':
+        _decoder = decode_zbarimg
+    else:
+        raise AssertionError('Unknown barcode decoder %s' % defs.barcode_decoder)
+
+    return _decoder
+
+
 #b_count = 0
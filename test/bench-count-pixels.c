@@ -0,0 +1,150 @@
+/* SDAPS
+ * Copyright (C) 2026  Benjamin Berg <benjamin@sipsolutions.net>
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/* Microbenchmark for the pixel counting kernels. The areas are roughly the
+ * size of checkboxes and textbox test windows on a 300dpi A4 page. All the
+ * results are compared against a plain per pixel count first. */
+
+#include <stdlib.h>
+#include "surface.h"
+
+#define PAGE_WIDTH 2480
+#define PAGE_HEIGHT 3508
+#define AREAS 4096
+#define ROUNDS 200
+
+typedef struct {
+	gint x;
+	gint y;
+	gint width;
+	gint height;
+	cairo_surface_t *mask;
+} Area;
+
+static void
+fill_random(cairo_surface_t *surface, GRand *rand)
+{
+	guint32 *pixels;
+	gint stride;
+	gint height;
+	gint i;
+
+	cairo_surface_flush(surface);
+	pixels = (guint32*) cairo_image_surface_get_data(surface);
+	stride = cairo_image_surface_get_stride(surface);
+	height = cairo_image_surface_get_height(surface);
+
+	for (i = 0; i < stride / 4 * height; i++)
+		pixels[i] = g_rand_int(rand);
+	cairo_surface_mark_dirty(surface);
+}
+
+static gint
+count_reference(cairo_surface_t *surface, cairo_surface_t *mask, gint x, gint y, gint width, gint height)
+{
+	guint32 *pixels = (guint32*) cairo_image_surface_get_data(surface);
+	gint stride = cairo_image_surface_get_stride(surface);
+	guint32 *mask_pixels = NULL;
+	gint mask_stride = 0;
+	gint dx, dy;
+	gint count = 0;
+
+	if (mask) {
+		mask_pixels = (guint32*) cairo_image_surface_get_data(mask);
+		mask_stride = cairo_image_surface_get_stride(mask);
+	}
+
+	for (dy = 0; dy < height; dy++) {
+		for (dx = 0; dx < width; dx++) {
+			if (mask && !GET_PIXEL(mask_pixels, mask_stride, dx, dy))
+				continue;
+			count += GET_PIXEL(pixels, stride, x + dx, y + dy);
+		}
+	}
+
+	return count;
+}
+
+int
+main(int argc, char **argv)
+{
+	cairo_surface_t *page;
+	GRand *rand;
+	GTimer *timer;
+	Area *areas;
+	gint64 total;
+	gint round;
+	gint i;
+
+	rand = g_rand_new_with_seed(42);
+	page = cairo_image_surface_create(CAIRO_FORMAT_A1, PAGE_WIDTH, PAGE_HEIGHT);
+	fill_random(page, rand);
+
+	areas = g_new0(Area, AREAS);
+	for (i = 0; i < AREAS; i++) {
+		areas[i].width = g_rand_int_range(rand, 1, 400);
+		areas[i].height = g_rand_int_range(rand, 1, 100);
+		areas[i].x = g_rand_int_range(rand, 0, PAGE_WIDTH - areas[i].width);
+		areas[i].y = g_rand_int_range(rand, 0, PAGE_HEIGHT - areas[i].height);
+		areas[i].mask = cairo_image_surface_create(CAIRO_FORMAT_A1, areas[i].width, areas[i].height);
+		fill_random(areas[i].mask, rand);
+	}
+
+	for (i = 0; i < AREAS; i++) {
+		Area *a = &areas[i];
+
+		if (count_black_pixel(page, a->x, a->y, a->width, a->height) !=
+		    count_reference(page, NULL, a->x, a->y, a->width, a->height)) {
+			g_printerr("count_black_pixel mismatch at %i,%i %ix%i\n", a->x, a->y, a->width, a->height);
+			return 1;
+		}
+		if (count_black_pixel_masked(page, a->mask, a->x, a->y) !=
+		    count_reference(page, a->mask, a->x, a->y, a->width, a->height)) {
+			g_printerr("count_black_pixel_masked mismatch at %i,%i %ix%i\n", a->x, a->y, a->width, a->height);
+			return 1;
+		}
+	}
+
+	timer = g_timer_new();
+
+	total = 0;
+	g_timer_start(timer);
+	for (round = 0; round < ROUNDS; round++)
+		for (i = 0; i < AREAS; i++)
+			total += count_black_pixel(page, areas[i].x, areas[i].y, areas[i].width, areas[i].height);
+	g_timer_stop(timer);
+	g_print("count_black_pixel:        %8.1f ns/call (%" G_GINT64_FORMAT ")\n",
+	        g_timer_elapsed(timer, NULL) * 1e9 / (ROUNDS * AREAS), total);
+
+	total = 0;
+	g_timer_start(timer);
+	for (round = 0; round < ROUNDS; round++)
+		for (i = 0; i < AREAS; i++)
+			total += count_black_pixel_masked(page, areas[i].mask, areas[i].x, areas[i].y);
+	g_timer_stop(timer);
+	g_print("count_black_pixel_masked: %8.1f ns/call (%" G_GINT64_FORMAT ")\n",
+	        g_timer_elapsed(timer, NULL) * 1e9 / (ROUNDS * AREAS), total);
+
+	g_timer_destroy(timer);
+	for (i = 0; i < AREAS; i++)
+		cairo_surface_destroy(areas[i].mask);
+	g_free(areas);
+	cairo_surface_destroy(page);
+	g_rand_free(rand);
+
+	return 0;
+}
@@ -46,6 +46,12 @@ diff "$SRCDIR/data/tex/code128_test_ids" "$PROJECT/ids"
 # Add original PDF and convert
 "$SDAPS" add "$PROJECT" --convert "$PROJECT/stamped_1.pdf"
 
+# Copies for the recognition tests below
+for VARIANT in serial parallel incremental binary; do
+	rm -rf "projects/test-recognize-$VARIANT"
+	cp -r "$PROJECT" "projects/test-recognize-$VARIANT"
+done
+
 # Recognize the empty pages (ie. the barcodes)
 "$SDAPS" recognize "$PROJECT"
 
@@ -63,6 +69,31 @@ diff -qup "$SRCDIR/data/tex/ids_test_export.csv" "$PROJECT/data_1.csv"
 "$SDAPS" report reportlab "$PROJECT"
 "$SDAPS" report tex "$PROJECT"
 
+###########################################################
+# Test parallel and incremental recognition and the binary format
+###########################################################
+
+# These all need to give the same result as the serial recognition
+PROJECT="projects/test-recognize"
+
+"$SDAPS" recognize "$PROJECT-serial"
+"$SDAPS" export csv "$PROJECT-serial"
+
+"$SDAPS" recognize -j 2 "$PROJECT-parallel"
+"$SDAPS" export csv "$PROJECT-parallel"
+diff -u "$PROJECT-serial/data_1.csv" "$PROJECT-parallel/data_1.csv"
+
+# The second run has nothing left to do
+"$SDAPS" recognize --incremental "$PROJECT-incremental"
+"$SDAPS" recognize --incremental "$PROJECT-incremental"
+"$SDAPS" export csv "$PROJECT-incremental"
+diff -u "$PROJECT-serial/data_1.csv" "$PROJECT-incremental/data_1.csv"
+
+"$SDAPS" recognize "$PROJECT-binary"
+"$SDAPS" migrate --codec binary "$PROJECT-binary"
+"$SDAPS" export csv "$PROJECT-binary"
+diff -u "$PROJECT-serial/data_1.csv" "$PROJECT-binary/data_1.csv"
+
 ###########################################################
 # Test Tex without IDs
 ###########################################################